@@ -6,10 +6,31 @@ import platform
 import socket
 import getpass
 import glob
-import paramiko
+import re
+import collections
 import warnings
 import urllib
 import argparse
+import hashlib
+import json
+import math
+import mmap
+import shlex
+import shutil
+import stat
+import struct
+import itertools
+import random
+import time
+import queue
+import threading
+import concurrent.futures
+import functools
+import contextlib
+import heapq
+
+# Load time of MPFU, used to report startup cost in job mode
+starttime = time.time()
 
 # Detect platform
 plat_type = platform.system()
@@ -34,8 +55,232 @@ Provide the serverlist as a text file, with one server per line in the following
 
 protocol:Destination IP or hostname:/remote/upload/path/:username:password 
 
+Hostnames may contain a numeric range, e.g. web[001-300].example.com, which is expanded to one entry per host.
+Lines starting with # are comments, and a line like [web] starts a group of entries (see --group).
+Lines for the same host and login are merged, wherever they are in the list, and one login to the host
+uploads to all of their remote paths.
+
+""")
+parser.add_argument('-g','--group', required=False, help="""
+Only use serverlist entries from these groups (comma separated). Groups are sections of the serverlist
+started by a line with the group name in brackets, e.g. [web].
+
+""")
+parser.add_argument('-p','--parallel', required=False, type=int, default=1, help="""
+Maximum number of destinations from the serverlist to upload to, or run SSH commands on, at the same time
+(default 1, one after another). Each destination gets its own connection, and a per-host summary is printed
+once all transfers or commands finish.
+
+""")
+parser.add_argument('--cmd-timeout', required=False, type=int, default=0, help="""
+Seconds a remote SSH command may run on each host before it is abandoned (default 0, no limit).
+
+""")
+parser.add_argument('-c','--channels', required=False, type=int, default=1, help="""
+Number of SFTP channels to open per host when sending several files (default 1).
+Files are handed out to the channels from a shared queue, which hides per-file round trip latency.
+
+""")
+parser.add_argument('--ftp-sessions', required=False, type=int, default=1, help="""
+Number of logged-in FTP sessions to open per host when sending several files (default 1).
+Files are handed out to the sessions from a shared queue. Servers that refuse more sessions just get fewer.
+
+""")
+parser.add_argument('--ftp-block', required=False, type=int, default=64, help="""
+Block size in KB used to send FTP uploads (default 64)
+
+""")
+parser.add_argument('--ftps', required=False, action='store_true', help="""
+Secure FTP control and data connections with explicit TLS (AUTH TLS, PROT P). Data connections reuse the
+TLS session of the control connection where the server allows it, which saves a full handshake per file.
+
+""")
+parser.add_argument('--smb-connections', required=False, type=int, default=4, help="""
+Number of SMB connections per host used to upload several files at the same time (default 4).
+Servers that refuse more connections just get fewer.
+
+""")
+parser.add_argument('--no-preflight', required=False, action='store_true', help="""
+Skip the preflight check of serverlist destinations. Normally all hosts are resolved and their ports probed
+at the same time before anything is sent, SSH destinations are checked for enough free space, and hosts
+that fail are reported up front and left out.
+
+""")
+parser.add_argument('--probe-timeout', required=False, type=float, default=3, help="""
+Seconds to wait for a host's port to accept a connection during preflight (default 3)
+
+""")
+parser.add_argument('--ssh-profile', required=False, default="default", choices=["default", "throughput"], help="""
+SSH transport settings for SFTP, SCP and tar uploads. throughput opens larger SSH windows and packets, prefers
+AES-GCM/CTR ciphers (fastest on CPUs with AES instructions) and sends SFTP writes as larger pipelined requests.
+For fast links with high latency. default uses paramiko's settings.
+
+""")
+parser.add_argument('--compress', required=False, action='store_true', help="""
+Compress SSH connections (zlib). Helps with compressible files on slow links, costs CPU on fast ones.
+
+""")
+parser.add_argument('--pool-idle', required=False, type=int, default=300, help="""
+Seconds an unused SSH connection is kept open for reuse by later menu actions (default 300).
+
+""")
+parser.add_argument('--adaptive', required=False, action='store_true', help="""
+Tune parallelism while a serverlist upload runs. Starts with 2 destinations at a time and 1 stream per host
+(SFTP channels, FTP sessions, SMB connections, S3 objects) and adds one at a time while throughput keeps
+rising. Halves both when more than one transfer in ten fails or connecting to hosts gets much slower. -p sets the maximum
+number of destinations and --max-streams the maximum streams per host. Not used with --shared-read.
+
+""")
+parser.add_argument('--max-streams', required=False, type=int, default=8, help="""
+Most streams per host --adaptive may use (default 8)
+
+""")
+parser.add_argument('--adapt-interval', required=False, type=float, default=3, help="""
+Seconds between --adaptive adjustments (default 3)
+
+""")
+parser.add_argument('--retries', required=False, type=int, default=3, help="""
+Times to retry a serverlist destination after a network error such as a timeout or a dropped connection
+(default 3). Retries wait --retry-base seconds, doubling each time up to --retry-max, with random jitter.
+Files that already arrived are not sent again. Login and path errors are not retried.
+
+""")
+parser.add_argument('--retry-base', required=False, type=float, default=1, help="""
+Seconds to wait before the first retry (default 1)
+
+""")
+parser.add_argument('--retry-max', required=False, type=float, default=30, help="""
+Longest wait between retries in seconds (default 30)
+
+""")
+parser.add_argument('--breaker', required=False, type=int, default=3, help="""
+Network failures in a row after which a host is given up on for --breaker-cooldown seconds: its remaining
+retries, paths and logins fail right away instead of waiting on it (default 3)
+
+""")
+parser.add_argument('--breaker-cooldown', required=False, type=float, default=60, help="""
+Seconds before a host given up on by --breaker is tried again (default 60)
+
+""")
+parser.add_argument('--shared-read', required=False, action='store_true', help="""
+With --parallel, read each local file once for all destinations uploading at the same time, instead of once
+per destination. Chunks are handed to every destination as they are read; a destination may fall at most
+--shared-depth chunks behind before the read waits for it. Each destination then sends its files one at a
+time (no --channels, --ftp-sessions, --smb-connections or --s3-objects). Not used with --resume or --delta.
+
+""")
+parser.add_argument('--shared-depth', required=False, type=int, default=8, help="""
+Number of 1 MB chunks a destination may fall behind in --shared-read mode (default 8)
+
+""")
+parser.add_argument('--relay', required=False, type=int, default=0, help="""
+Relay serverlist uploads to SFTP/SCP hosts through a tree: MPFU uploads to the first N of them, and every host
+that has the files passes them on to N more hosts, so the data leaves this machine only N times. Hosts need
+python3 and must be able to reach each other on --relay-port. The hops between hosts use TLS with a certificate
+made for the run, and a host only serves the files to clients that send the run's token. Every copy is checked
+against the local SHA-256. A host whose relay fails gets the files from MPFU instead.
+
+""")
+parser.add_argument('--relay-port', required=False, type=int, default=0, help="""
+TCP port relay hosts serve the files on (default: any free port)
+
+""")
+parser.add_argument('--relay-wait', required=False, type=float, default=600, help="""
+Seconds a relay host waits for the host it pulls from to get the files, before MPFU sends them to it directly
+instead (default 600)
+
+""")
+parser.add_argument('--sync', required=False, action='store_true', help="""
+Directory upload only sends files that are new or have changed size or modification time since the last upload.
+A manifest of each synced tree is kept in the manifests folder next to MPFU; if the local tree has not changed
+since the last sync to a destination, the remote side is not even listed. Delete the folder to force a full compare.
+
+""")
+parser.add_argument('--delta', required=False, action='store_true', help="""
+SFTP and SCP uploads only send the parts of a file that differ from the copy already on the server (rsync-style).
+The server needs python3; otherwise, or if there is no remote copy yet, the whole file is sent as usual.
+
+""")
+parser.add_argument('--delta-block', required=False, type=int, default=0, help="""
+Block size in bytes used to compare files in --delta mode (default: chosen from the file size).
+
+""")
+parser.add_argument('--resume', required=False, action='store_true', help="""
+Make SFTP, FTP and S3 uploads resumable. Progress is recorded in journal.mpfu next to MPFU, and if an upload is
+interrupted, running the same upload again continues from the last confirmed offset instead of starting over.
+
+""")
+parser.add_argument('--skip-identical', required=False, action='store_true', help="""
+Don't send files whose remote copy is byte-identical. Local files are hashed (SHA-256) once and the hashes are
+cached in hashes.mpfu next to MPFU until a file changes. SFTP and SCP destinations are checked with one batched
+sha256sum on the server, S3 objects by their ETag or the checksum MPFU stores with each upload.
+
+""")
+parser.add_argument('--s3-chunk', required=False, type=int, default=8, help="""
+S3 multipart chunk size in MB (default 8). Files larger than one chunk are uploaded in parts.
+
+""")
+parser.add_argument('--s3-concurrency', required=False, type=int, default=10, help="""
+Number of parts of one S3 object uploaded at the same time (default 10).
+
+""")
+parser.add_argument('--s3-objects', required=False, type=int, default=1, help="""
+Number of S3 objects uploaded at the same time through one shared transfer manager (default 1).
+
+""")
+parser.add_argument('--tar', required=False, nargs='?', const='plain', choices=['plain', 'gz'], help="""
+Directory upload to SFTP servers streams the whole tree as one tar archive into 'tar -x' on the server over a
+single SSH channel, instead of one SFTP request per directory and file. Use --tar gz to compress the stream.
+The server needs tar in its PATH.
+
+""")
+parser.add_argument('--progress', required=False, default="auto", choices=["auto", "bar", "line", "quiet"], help="""
+How to show transfer progress. bar redraws one status line in place, line prints a status line now and then
+(for logs and CI), quiet shows none. auto (default) uses bar on a terminal and line otherwise.
+
+""")
+parser.add_argument('--progress-interval', required=False, type=float, help="""
+Minimum seconds between progress updates (default 0.2 for bar, 5 for line)
+
+""")
+parser.add_argument('--bwlimit', required=False, type=float, default=0, help="""
+Limit the upload rate of the whole run (all destinations together) to this many MB/s
+
+""")
+parser.add_argument('--host-bwlimit', required=False, type=float, default=0, help="""
+Limit the upload rate to each destination to this many MB/s
+
+""")
+parser.add_argument('--site-bwlimit', required=False, default="", help="""
+Limit the upload rate to each serverlist group ([groupname] sections) to this many MB/s, e.g. 50, or give
+a limit per group: dc1=100,branch=5 (groups not listed are not limited)
+
+""")
+parser.add_argument('--metrics', required=False, help="""
+Append a JSON record for every file transfer, destination and SSH command to this file (JSON lines).
+Records carry the host, protocol, bytes, duration, throughput, retries and outcome.
+
+""")
+parser.add_argument('--prom', required=False, help="""
+Write per host and protocol totals of this run to this file in Prometheus text format, e.g. for the
+node_exporter textfile collector. Rewritten after every upload or command run.
+
 """)
-args = parser.parse_args()
+parser.add_argument('-j','--job', required=False, help="""
+Run a job file non-interactively and exit (exit code 0 if everything succeeded, 1 otherwise). The job is JSON:
+
+{"destinations": ["sftp:host:/remote/path/:user:password", "s3:bucketname"],
+ "files": ["/local/path/*.tar.gz"],
+ "directory": "/local/dir", "remote_dir": "/remote/dir/",
+ "commands": ["bash /remote/path/deploy.sh"],
+ "options": {"parallel": 10, "sync": true}}
+
+Every key is optional. Without "destinations" the serverlist given with -l is used. "options" takes the long
+names of any of the CLI options above.
+
+""")
+# Only read argv when run as a script; importing MPFU as a library gets the defaults
+args = parser.parse_args() if __name__ == '__main__' else parser.parse_args([])
 
 # Color tags
 if plat_type == 'Linux':
@@ -52,6 +297,39 @@ _nc = '\033[0m'
 # Filter paramiko warnings until new version with bugfix released
 warnings.filterwarnings(action='ignore', module='.*paramiko.*')
 
+# Per-thread state for parallel upload workers. Workers run without progress bars or keypress pauses.
+workerstate = threading.local()
+
+# Set for job mode and library use, where every thread runs like a worker
+batchmode = False
+
+# SSH transport settings for each --ssh-profile: window and max packet size of SSH channels (None for
+# paramiko's 2 MB and 32 KB), ciphers to prefer over paramiko's order, the size of each SFTP write request
+# and the number of SFTP channels a large file is split over.
+sshprofiles = {
+    'default': {'window': None, 'packet': None, 'ciphers': (), 'request': 32768, 'streams': 1},
+    'throughput': {'window': 64 * pow(2, 20), 'packet': 256 * 1024, 'request': 128 * 1024, 'streams': 4,
+                   'ciphers': ('aes128-gcm@openssh.com', 'aes256-gcm@openssh.com', 'aes128-ctr', 'aes256-ctr')},
+}
+
+# Ports used for each service. Library users can point them elsewhere, e.g. at test servers on unprivileged ports.
+serviceports = {'ftp': 21, 'ssh': 22, 'smb': 445}
+
+def inWorker():
+    return batchmode or getattr(workerstate, 'active', False)
+
+# Called from inside an except block after the error has been printed. Remembers the error for the
+# per-host summary and retries, and waits for a keypress unless running inside a parallel worker or
+# any other serverlist destination task.
+def errPause():
+    workerstate.reason = str(sys.exc_info()[1])
+    workerstate.error = sys.exc_info()[1]
+    controller.error(sys.exc_info()[1])
+    if inWorker() or getattr(workerstate, 'fleet', False):
+        return
+    input("Press a key to continue...")
+    print(" ")
+
 # Tab completion code from https://gist.github.com/iamatypeofwalrus/5637895
 class tabCompleter(object):
 
@@ -238,24 +516,878 @@ def localfsPrompt():
     fs = dirvar, filevar, fileglob
     return fs
 
-# Modified progress provider for SCP. fname parameter added but left blank to align with scp module callback output
-# Annoyingly must be in global namespace because it's called by connection, not transfer
+# Session-wide pool of authenticated SSH connections, keyed by (host, port, user, auth).
+# Connections are reused by every menu action for as long as MPFU runs, checked before reuse,
+# and closed once no one holds a lease on them and they sit unused for longer than --pool-idle seconds.
+# Every get() takes a lease that is given back with release() (or use lease() in a with block).
+class sshConnPool(object):
+
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        # {key: [connection, time of last get or release, leases]}
+        self.conns = {}
+        self.lock = threading.Lock()
+        self.keylocks = {}
+
+    def poolKey(self, servvar, port, uservar, passvar):
+        auth = hashlib.sha256(passvar.encode()).hexdigest() if passvar else "key"
+        return (servvar.lower(), port, uservar, auth)
+
+    # A pooled connection is healthy if its transport is up and still accepts packets
+    def healthy(self, pssh):
+        import paramiko
+        transport = pssh.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (EOFError, OSError, paramiko.ssh_exception.SSHException):
+            return False
+        return True
+
+    def evictIdle(self):
+        now = time.time()
+        with self.lock:
+            stale = [k for k, (pssh, last, leases) in self.conns.items()
+                     if not leases and now - last > self.idle_timeout]
+            for k in stale:
+                self.conns.pop(k)[0].close()
+
+    def get(self, servvar, uservar, passvar="", port=None):
+        import paramiko
+        port = port or serviceports['ssh']
+        self.evictIdle()
+        key = self.poolKey(servvar, port, uservar, passvar)
+        with self.lock:
+            keylock = self.keylocks.setdefault(key, threading.Lock())
+        with keylock:
+            with self.lock:
+                candidates = [key]
+                # A key-only request may reuse a session that was opened with a password
+                if not passvar:
+                    candidates += [k for k in self.conns if k[:3] == key[:3] and k != key]
+                for k in candidates:
+                    if k not in self.conns:
+                        continue
+                    held = self.conns[k]
+                    pssh = held[0]
+                    if self.healthy(pssh):
+                        held[1] = time.time()
+                        held[2] += 1
+                        return pssh
+                    # Leaseholders of a dead connection get their errors from it, it just leaves the pool
+                    self.conns.pop(k)
+                    if not held[2]:
+                        pssh.close()
+
+            pssh = paramiko.SSHClient()
+            pssh.load_system_host_keys()
+            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
+            extra = {'transport_factory': sshTransport} if args.ssh_profile != "default" else {}
+            started = time.time()
+            pssh.connect(hostname=servvar, port=port, username=uservar,
+                         password=passvar or None, timeout=8, compress=args.compress, **extra)
+            controller.latency(time.time() - started)
+            with self.lock:
+                self.conns[key] = [pssh, time.time(), 1]
+            return pssh
+
+    # Give back the lease on pssh taken by get()
+    def release(self, pssh):
+        with self.lock:
+            for held in self.conns.values():
+                if held[0] is pssh:
+                    held[1] = time.time()
+                    held[2] = max(0, held[2] - 1)
+                    return
+
+    # get() for the length of a with block
+    @contextlib.contextmanager
+    def lease(self, servvar, uservar, passvar="", port=None):
+        pssh = self.get(servvar, uservar, passvar, port)
+        try:
+            yield pssh
+        finally:
+            self.release(pssh)
+
+    def closeAll(self):
+        with self.lock:
+            for pssh, last, leases in self.conns.values():
+                pssh.close()
+            self.conns.clear()
+
+connpool = sshConnPool(args.pool_idle)
+
+# Transport for SSHClient.connect with the window, packet size and cipher order of the --ssh-profile
+def sshTransport(sock, **kwargs):
+    import paramiko
+    profile = sshprofiles[args.ssh_profile]
+    transport = paramiko.Transport(sock, default_window_size=profile['window'] or paramiko.common.DEFAULT_WINDOW_SIZE,
+                                   default_max_packet_size=profile['packet'] or paramiko.common.DEFAULT_MAX_PACKET_SIZE,
+                                   **kwargs)
+    options = transport.get_security_options()
+    preferred = [c for c in profile['ciphers'] if c in options.ciphers]
+    options.ciphers = tuple(preferred + [c for c in options.ciphers if c not in preferred])
+    return transport
+
+# Get a pooled SSH connection for an interactive prompt. SSH keys are tried first, and the user is asked
+# for a password if the server does not accept them. Returns the connection (leased, see connpool.release)
+# and the password used.
+def sshLogin(servvar, uservar):
+    import paramiko
+    try:
+        return connpool.get(servvar, uservar), ""
+    except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
+        print(
+            f"\n{y_}No SSH key matching this host to authenticate with.{_nc}\n\nEnter password for {y_}{uservar}{_nc}: ", end=" ")
+        passvar = getpass.getpass('')
+        return connpool.get(servvar, uservar, passvar), passvar
+
+# Run a command over a pooled SSH connection. Returns exit code, stdout and stderr.
+# With echo, output is printed as it arrives. Raises socket.timeout if timeout seconds pass first.
+def sshExec(pssh, cmdvar, echo=False, timeout=0):
+    chan = pssh.get_transport().open_session()
+    chan.exec_command(cmdvar)
+    out, err = [], []
+    started = time.time()
+    while True:
+        if timeout and time.time() - started > timeout:
+            chan.close()
+            raise socket.timeout(f"command timed out after {timeout}s")
+        got = False
+        if chan.recv_ready():
+            data = chan.recv(32768).decode(errors='replace')
+            out.append(data)
+            got = True
+            if echo:
+                sys.stdout.write(data)
+                sys.stdout.flush()
+        if chan.recv_stderr_ready():
+            data = chan.recv_stderr(32768).decode(errors='replace')
+            err.append(data)
+            got = True
+            if echo:
+                sys.stderr.write(data)
+                sys.stderr.flush()
+        if not got:
+            # The exit status can arrive before the last output, so read on until the server ends the streams
+            if (chan.eof_received or chan.closed) and not chan.recv_ready() and not chan.recv_stderr_ready():
+                break
+            time.sleep(0.01)
+    rc = chan.recv_exit_status()
+    chan.close()
+    return rc, "".join(out), "".join(err)
+
+# sshExec on the pooled connection for servvar, with a metrics record of the run
+def sshCommand(servvar, uservar, passvar, cmdvar, echo=False, timeout=0):
+    started = time.time()
+    try:
+        with connpool.lease(servvar, uservar, passvar) as pssh:
+            rc, cmdout, cmderr = sshExec(pssh, cmdvar, echo, timeout)
+    except Exception as e:
+        metrics.record("command", "ssh", servvar, "failed", 0, time.time() - started, command=cmdvar, rc=None,
+                       reason=str(e) or type(e).__name__)
+        raise
+    metrics.record("command", "ssh", servvar, "ok" if rc == 0 else "failed", 0, time.time() - started,
+                   command=cmdvar, rc=rc, reason="")
+    return rc, cmdout, cmderr
+
+# On-disk journal of unfinished uploads for --resume, keyed by protocol, destination, remote path and local
+# file (with its size and mtime, so a changed local file starts over). Entries are removed once an upload completes.
+class transferJournal(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as jf:
+                self.entries = json.load(jf)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def key(self, protvar, servvar, remotefile, localfile):
+        fstat = os.stat(localfile)
+        return f"{protvar}|{servvar}|{remotefile}|{os.path.abspath(localfile)}|{fstat.st_size}|{int(fstat.st_mtime)}"
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def set(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.save()
+
+    def drop(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.save()
+
+    # Write to a temp file first so an interrupted write never corrupts the journal
+    def save(self):
+        with open(self.path + '.tmp', 'w') as jf:
+            json.dump(self.entries, jf)
+        os.replace(self.path + '.tmp', self.path)
+
+journal = transferJournal(os.path.join(homepath, 'journal.mpfu'))
+
+# Cache of local file hashes for --skip-identical, keyed by path, inode, size and mtime, so each file is read
+# once until it changes. Loaded on first use; save() writes it back when something was added.
+class hashCache(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = None
+        self.dirty = False
+
+    def key(self, localfile):
+        fstat = os.stat(localfile)
+        return f"{os.path.abspath(localfile)}|{fstat.st_ino}|{fstat.st_size}|{fstat.st_mtime_ns}"
+
+    def load(self):
+        try:
+            with open(self.path) as hf:
+                self.entries = json.load(hf)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    # {'sha256': ..., 'md5': ...} of localfile, read now if it isn't cached
+    def get(self, localfile):
+        key = self.key(localfile)
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            if key not in self.entries:
+                sha256, md5 = hashlib.sha256(), hashlib.md5()
+                with open(localfile, 'rb') as file:
+                    for data in iter(lambda: file.read(pow(2, 20)), b""):
+                        sha256.update(data)
+                        md5.update(data)
+                self.entries[key] = {'sha256': sha256.hexdigest(), 'md5': md5.hexdigest()}
+                self.dirty = True
+            return self.entries[key]
+
+    # The ETag S3 gives localfile when it is uploaded in parts of chunk bytes, read now if it isn't cached
+    def etag(self, localfile, chunk):
+        entry = self.get(localfile)
+        if str(chunk) not in entry.get('etags', {}):
+            parts = []
+            with open(localfile, 'rb') as file:
+                for data in iter(lambda: file.read(chunk), b""):
+                    parts.append(hashlib.md5(data).digest())
+            with self.lock:
+                entry.setdefault('etags', {})[str(chunk)] = hashlib.md5(b"".join(parts)).hexdigest() + f"-{len(parts)}"
+                self.dirty = True
+        return entry['etags'][str(chunk)]
+
+    # Write new hashes back, dropping entries of files that have changed or gone since
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            for key in list(self.entries):
+                try:
+                    current = self.key(key.rsplit('|', 3)[0])
+                except OSError:
+                    current = None
+                if current != key:
+                    del self.entries[key]
+            with open(self.path + '.tmp', 'w') as hf:
+                json.dump(self.entries, hf)
+            os.replace(self.path + '.tmp', self.path)
+            self.dirty = False
+
+hashes = hashCache(os.path.join(homepath, 'hashes.mpfu'))
+
+# One compiled serverlist destination. Lines for the same protocol, host and login are merged into one entry
+# (remdirs holds all their remote paths), so a single connection serves them all.
+invEntry = collections.namedtuple('invEntry', 'protvar servvar remdirs uservar passvar group')
+
+serverlist_protocols = ("ftp", "sftp", "scp", "smb", "s3")
+hostrange = re.compile(r'\[(\d+)-(\d+)\]')
+
+# Expand numeric host ranges such as web[001-300].example.com or 10.0.0.[1-20], keeping zero padding
+def expandHosts(servvar):
+    match = hostrange.search(servvar)
+    if not match:
+        yield servvar
+        return
+    low, high = match.group(1), match.group(2)
+    width = len(low) if low.startswith('0') else 0
+    for n in range(int(low), int(high) + 1):
+        yield from expandHosts(servvar[:match.start()] + str(n).zfill(width) + servvar[match.end():])
+
+# Parse serverlist lines one at a time, without holding the whole list in memory. Yields
+# (protvar, servvar, remdirvar, uservar, passvar, group) per host after range expansion.
+# Invalid lines are reported with their line number and skipped.
+def iterServerlist(lines):
+    group = ""
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('[') and line.endswith(']') and ':' not in line:
+            group = line[1:-1].strip()
+            continue
+
+        # The password is the last field, so it may contain colons
+        elem = [e.strip() for e in line.split(":", 4)]
+        protvar = elem[0].lower()
+        problem = ""
+        if protvar not in serverlist_protocols:
+            problem = f"unknown protocol '{elem[0]}'"
+        elif protvar == "s3":
+            if len(elem) < 2 or not elem[1]:
+                problem = "missing bucket name"
+        elif len(elem) < 5:
+            problem = "expected protocol:host:/remote/path/:username:password"
+        elif not elem[1]:
+            problem = "missing host"
+        if problem:
+            print(f"{y_}Skipping serverlist line {lineno}{_nc}: {problem}")
+            continue
+
+        if protvar == "s3":
+            yield protvar, "", elem[1], "", "", group
+            continue
+        for servvar in expandHosts(elem[1]):
+            yield protvar, servvar, elem[2], elem[3], elem[4], group
+
+# Compile serverlist lines into a list of invEntry, keeping only the selected groups (all if groups is empty).
+# Lines are parsed as they are read, but the entries are collected so that duplicates anywhere are merged.
+def compileServerlist(lines, groups=()):
+    entries = {}
+    for protvar, servvar, remdirvar, uservar, passvar, group in iterServerlist(lines):
+        if groups and group not in groups:
+            continue
+        key = (protvar, servvar.lower(), uservar, passvar) if protvar != "s3" else (protvar, remdirvar)
+        if key not in entries:
+            entries[key] = invEntry(protvar, servvar, [remdirvar], uservar, passvar, group)
+        elif remdirvar not in entries[key].remdirs:
+            entries[key].remdirs.append(remdirvar)
+    return list(entries.values())
+
+# Compiled inventories by (path, mtime, size, groups), so the serverlist is only parsed again when it changes
+inventorycache = {}
+
+# The compiled inventory of the -l serverlist (or path), restricted to --group if given
+def loadInventory(path=None):
+    path = path or args.list
+    groups = tuple(g.strip() for g in args.group.split(",")) if args.group else ()
+    fstat = os.stat(path)
+    key = (os.path.abspath(path), fstat.st_mtime, fstat.st_size, groups)
+    if key not in inventorycache:
+        with open(path, 'r') as serv_file:
+            inventorycache[key] = compileServerlist(serv_file, groups)
+    return inventorycache[key]
+
+# Byte counter for one file being sent, handed to the protocol library as its progress callback
+class fileProgress(object):
+
+    def __init__(self, renderer, prot, dest, localfile, size):
+        self.renderer = renderer
+        self.prot = prot
+        self.dest = dest
+        self.localfile = localfile
+        self.size = size
+        self.bytes = 0
+        self.skipped = 0
+        self.retries = 0
+        self.remote = ""
+        self.done = None
+        self.throttled = 0.0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    # Count n more bytes sent (boto3 and pysmb report increments). Waits here if that puts the destination
+    # over a bandwidth limit, which holds the library back before it sends more. Safe to call from several
+    # threads sending parts of the same file; only the counting is serialized, not the wait.
+    def add(self, n):
+        throttled = shaper.take(n, self.dest)
+        with self.lock:
+            self.throttled += throttled
+            self.bytes += n
+        self.renderer.feed(self.dest, n, 0)
+
+    # Callback for libraries that report the running total (paramiko, scp)
+    def to(self, transferred, total=None):
+        self.add(transferred - self.bytes)
+
+    # Callback for ftplib, which passes each block it sent
+    def block(self, buf):
+        self.add(len(buf))
+
+    # Count bytes the destination already has from an interrupted upload. They count towards
+    # completion but not throughput.
+    def skip(self, n):
+        self.bytes += n
+        self.skipped += n
+        self.renderer.feed(self.dest, n, n)
+
+    def finish(self):
+        self.renderer.fileDone(self.dest, max(0, self.size - self.bytes))
+        self.record("ok", self.size - self.skipped)
+        controller.transferred()
+        self.arrived()
+
+    # Remember that the destination has the file, so a retry doesn't send it again
+    def arrived(self):
+        if self.done is not None:
+            self.done.add((self.remote, self.localfile))
+
+    # Another destination passed the file on (--relay). Counts as done, with nothing sent from here.
+    def relayed(self):
+        self.skip(self.size - self.bytes)
+        self.renderer.fileDone(self.dest, 0)
+        self.record("relayed", 0)
+        self.arrived()
+
+    # The destination already has an identical copy (--skip-identical). Counts as done, with nothing sent.
+    def identical(self):
+        self.skip(self.size - self.bytes)
+        self.renderer.fileDone(self.dest, 0, sent=False)
+        self.record("identical", 0)
+        self.arrived()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            controller.error(exc_value)
+            self.fail()
+        else:
+            self.finish()
+
+    # The upload failed, count the file as done without its missing bytes
+    def fail(self):
+        self.renderer.fileDone(self.dest, 0, sent=False)
+        self.record("failed", self.bytes - self.skipped)
+
+    def record(self, outcome, sent):
+        seconds = time.time() - self.started
+        metrics.record("file", self.prot, self.dest, outcome, sent, seconds, retries=self.retries,
+                       local=self.localfile, size=self.size, skipped=self.skipped, throttled=round(self.throttled, 3))
+
+
+# Read-only file wrapper that reports what is read from it, for libraries without a progress callback
+class progressReader(object):
+
+    def __init__(self, file, fp):
+        self.file = file
+        self.fp = fp
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.fp.add(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+# Progress of every upload goes through one renderer. Upload code reports bytes per file (begin() returns
+# a fileProgress) and the renderer redraws at most every --progress-interval seconds, so fast links and
+# small files don't turn into terminal I/O. Shows the total, throughput and ETA, and with several
+# destinations the slowest ones. A fan-out shares one renderer between all its workers.
+class progressRenderer(object):
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.reset()
+
+    # Forget all destinations and restart the clock
+    def reset(self):
+        with self.lock:
+            self.dests = collections.OrderedDict()
+            self.started = time.time()
+            self.drawn = 0.0
+            self.item = ""
+
+    def mode(self):
+        if args.progress != "auto":
+            return args.progress
+        return "bar" if sys.stdout.isatty() else "line"
+
+    # Start reporting prot uploads to dest from this thread. Outside a fan-out this starts a new run, with
+    # the sizes of files (if given) as its total.
+    def start(self, prot, dest, files=()):
+        if not inWorker():
+            self.reset()
+            if files:
+                self.expect(dest, sum(localSize(f) for f in files))
+        self.local.prot = prot
+        self.local.dest = dest
+
+    # Set what files begun from this thread are tagged with: attempt (the retry they are sent in), remote (the
+    # remote path) and done (a set that gets the (remote, local file) of every file that completes)
+    def scope(self, **fields):
+        for name, value in fields.items():
+            setattr(self.local, name, value)
+
+    # This thread's protocol, destination and scope, to hand to helper threads with adopt()
+    def context(self):
+        return (getattr(self.local, 'prot', ""), getattr(self.local, 'dest', ""), getattr(self.local, 'attempt', 0),
+                getattr(self.local, 'remote', ""), getattr(self.local, 'done', None))
+
+    # Report from this helper thread to the protocol and destination taken from another thread with context()
+    def adopt(self, context):
+        self.local.prot, self.local.dest, self.local.attempt, self.local.remote, self.local.done = context
+
+    def destState(self, dest):
+        if dest not in self.dests:
+            self.dests[dest] = {'bytes': 0, 'skipped': 0, 'total': 0, 'planned': False, 'files': 0,
+                                'active': 0, 'started': None, 'finished': None}
+        return self.dests[dest]
+
+    # Announce nbytes that will be sent to dest, so the ETA is known before its files start
+    def expect(self, dest, nbytes):
+        with self.lock:
+            state = self.destState(dest)
+            state['total'] += nbytes
+            state['planned'] = True
+
+    # Start tracking one file sent to dest (by default this thread's destination)
+    def begin(self, localfile, size=None, dest=None):
+        dest = dest or getattr(self.local, 'dest', "")
+        size = localSize(localfile) if size is None else size
+        with self.lock:
+            state = self.destState(dest)
+            if not state['planned']:
+                state['total'] += size
+            state['active'] += 1
+            state['started'] = state['started'] or time.time()
+            state['finished'] = None
+            self.item = os.path.basename(localfile)
+        self.local.file = fileProgress(self, getattr(self.local, 'prot', ""), dest, localfile, size)
+        self.local.file.retries = getattr(self.local, 'attempt', 0)
+        self.local.file.remote = getattr(self.local, 'remote', "")
+        self.local.file.done = getattr(self.local, 'done', None)
+        return self.local.file
+
+    # Bytes sent so far in this run, not counting what destinations already had
+    def sent(self):
+        with self.lock:
+            return sum(state['bytes'] - state['skipped'] for state in self.dests.values())
+
+    # The file this thread is sending, for callbacks that aren't tied to a transfer (scp)
+    def current(self):
+        return getattr(self.local, 'file', None)
+
+    def feed(self, dest, nbytes, skipped):
+        with self.lock:
+            state = self.dests[dest]
+            state['bytes'] += nbytes
+            state['skipped'] += skipped
+            self.draw()
+
+    def fileDone(self, dest, remainder, sent=True):
+        with self.lock:
+            state = self.dests[dest]
+            state['bytes'] += remainder
+            state['files'] += 1 if sent else 0
+            state['active'] -= 1
+            if state['active'] == 0:
+                state['finished'] = time.time()
+            self.draw()
+
+    # Stop waiting for the rest of dest's bytes, e.g. after it failed
+    def abandon(self, dest):
+        with self.lock:
+            if dest in self.dests:
+                state = self.dests[dest]
+                state['total'] = state['bytes']
+                state['finished'] = state['finished'] or time.time()
+
+    # Show what is being worked on (a file or directory name) in the status line
+    def note(self, item):
+        with self.lock:
+            self.item = item
+            self.draw()
+
+    # Print per-file output of a serial upload. In a fan-out the status line stands in for it.
+    def say(self, text):
+        if not inWorker():
+            print(text)
+
+    # Print a line of output without tearing the status line
+    def println(self, text):
+        with self.lock:
+            if self.mode() == "bar" and self.drawn:
+                sys.stdout.write("\r" + " " * (shutil.get_terminal_size().columns - 1) + "\r")
+                self.drawn = 0.0
+            print(text)
+
+    # Draw the current state now, e.g. before printing the end of a serial upload
+    def flush(self):
+        with self.lock:
+            self.draw(force=not inWorker())
+
+    # Draw the final state of a run and end the status line
+    def finish(self):
+        with self.lock:
+            self.draw(force=True)
+            if self.mode() == "bar" and self.drawn:
+                sys.stdout.write("\n")
+                sys.stdout.flush()
+            self.drawn = 0.0
+
+    def draw(self, force=False):
+        mode = self.mode()
+        if mode == "quiet" or not self.dests:
+            return
+        now = time.time()
+        interval = args.progress_interval if args.progress_interval is not None else 0.2 if mode == "bar" else 5
+        if not force and now - self.drawn < interval:
+            return
+        self.drawn = now
+        text = self.status(now)
+        if mode == "line":
+            print(text)
+            return
+        width = shutil.get_terminal_size().columns - 1
+        sys.stdout.write("\r" + text[:width].ljust(width) + "\r")
+        sys.stdout.flush()
+
+    def status(self, now):
+        states = self.dests.values()
+        total = sum(state['total'] for state in states)
+        done = sum(state['bytes'] for state in states)
+        rate = sum(state['bytes'] - state['skipped'] for state in states) / max(now - self.started, 0.001)
+        parts = []
+        if total:
+            percent = min(1.0, float(done) / total)
+            hashes = '#' * int(round(percent * 25))
+            parts.append(f"[{hashes.ljust(25)}] {round(percent * 100, 1)}%")
+        parts.append(f"{mbytes(done)}/{mbytes(total)} MB")
+        parts.append(f"{mbytes(rate)} MB/s" + (f" (limit {args.bwlimit})" if args.bwlimit else ""))
+        parts.append(f"ETA {etaText(total - done, rate if now - self.started >= 1 else 0)}")
+        parts.append(f"{sum(state['files'] for state in states)} files")
+        if len(self.dests) == 1:
+            if self.item:
+                parts.append(self.item)
+            return " || ".join(parts)
+
+        # Per destination throughput, slowest unfinished destinations first
+        finished = len([state for state in states if state['finished'] and state['bytes'] >= state['total']])
+        parts.append(f"{finished}/{len(self.dests)} destinations done")
+        running = []
+        for dest, state in self.dests.items():
+            if not state['started'] or (state['finished'] and state['bytes'] >= state['total']):
+                continue
+            destrate = (state['bytes'] - state['skipped']) / max((state['finished'] or now) - state['started'], 0.001)
+            running.append(((state['total'] - state['bytes']) / destrate if destrate else float('inf'),
+                            f"{dest} {mbytes(destrate)} MB/s{f' (limit {args.host_bwlimit})' if args.host_bwlimit else ''} ETA {etaText(state['total'] - state['bytes'], destrate)}"))
+        for eta, text in sorted(running, reverse=True)[:3]:
+            parts.append(text)
+        # Throughput of each serverlist group with a bandwidth limit
+        limits = shaper.siteLimits()
+        sitebytes = collections.OrderedDict()
+        for dest, state in self.dests.items():
+            site = shaper.sites.get(dest)
+            if state['started'] and site and (site in limits or None in limits):
+                sitebytes[site] = sitebytes.get(site, 0) + state['bytes'] - state['skipped']
+        for site, sent in sitebytes.items():
+            parts.append(f"site {site} {mbytes(sent / max(now - self.started, 0.001))} MB/s "
+                         f"(limit {limits.get(site, limits.get(None))})")
+        return " || ".join(parts)
+
+
+# Bytes as MB with 2 decimals, for progress output
+def mbytes(nbytes):
+    return round(float(nbytes) / pow(2, 20), 2)
+
+# Time left for remaining bytes at rate bytes/s, as m:ss
+def etaText(remaining, rate):
+    if remaining <= 0:
+        return "0:00"
+    if not rate:
+        return "--:--"
+    seconds = int(remaining / rate)
+    return f"{seconds // 60}:{str(seconds % 60).zfill(2)}"
+
+progress = progressRenderer()
+
+
+# Structured record of every file transfer, destination and SSH command, written as JSON lines to --metrics.
+# Also keeps totals per host and protocol for the --prom textfile, and bytes per destination so a
+# destination's record can report what its files sent.
+class metricsSink(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.destbytes = {}
+        self.file = None
+
+    def enabled(self):
+        return bool(args.metrics or args.prom)
+
+    # Add one record. kind is file, destination or command; throughput is in bytes per second.
+    def record(self, kind, prot, host, outcome, nbytes, seconds, retries=0, **fields):
+        if not self.enabled():
+            return
+        rec = {'time': round(time.time(), 3), 'kind': kind, 'protocol': prot, 'host': host, 'outcome': outcome,
+               'bytes': nbytes, 'seconds': round(seconds, 4),
+               'throughput': round(nbytes / seconds) if seconds > 0 else 0, 'retries': retries}
+        rec.update(fields)
+        with self.lock:
+            if kind == "file":
+                sent = self.destbytes.setdefault(host, [0, 0])
+                sent[0] += nbytes
+                sent[1] += 1 if outcome == "ok" else 0
+            total = self.totals.setdefault((kind, prot, host, outcome), [0, 0, 0.0, 0])
+            total[0] += 1
+            total[1] += nbytes
+            total[2] += seconds
+            total[3] += retries
+            if args.metrics:
+                # --metrics can differ between library calls (see libraryCall)
+                if self.file and self.file.name != args.metrics:
+                    self.file.close()
+                    self.file = None
+                if not self.file:
+                    self.file = open(args.metrics, 'a')
+                self.file.write(json.dumps(rec) + "\n")
+
+    # Bytes and files sent to host since the last call, for its destination record
+    def takeDest(self, host):
+        with self.lock:
+            return self.destbytes.pop(host, [0, 0])
+
+    # Flush the --metrics file and rewrite the --prom textfile with the totals so far. The textfile is
+    # written to a temp file and renamed, so a collector never reads a half written file.
+    def flush(self):
+        with self.lock:
+            if self.file:
+                self.file.flush()
+        if not args.prom:
+            return
+        names = {'file': "mpfu_file_transfers", 'destination': "mpfu_destination_uploads",
+                 'command': "mpfu_ssh_commands"}
+        lines = []
+        with self.lock:
+            for kind, name in names.items():
+                rows = sorted((key, total) for key, total in self.totals.items() if key[0] == kind)
+                if not rows:
+                    continue
+                for suffix, index, help in (("total", 0, "Number of"), ("bytes_total", 1, "Bytes sent by"),
+                                            ("seconds_total", 2, "Seconds spent in"), ("retries_total", 3, "Retries of")):
+                    if kind == "command" and suffix == "bytes_total":
+                        continue
+                    lines.append(f"# HELP {name}_{suffix} {help} {kind} {'runs' if kind == 'command' else 'uploads'} in this MPFU run")
+                    lines.append(f"# TYPE {name}_{suffix} counter")
+                    for (k, prot, host, outcome), total in rows:
+                        labels = f'host="{promLabel(host)}",protocol="{promLabel(prot)}",outcome="{outcome}"'
+                        lines.append(f"{name}_{suffix}{{{labels}}} {round(total[index], 4)}")
+        with open(args.prom + ".tmp", 'w') as promfile:
+            promfile.write("\n".join(lines) + "\n")
+        os.replace(args.prom + ".tmp", args.prom)
+
+# Escape a Prometheus label value
+def promLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = metricsSink()
+
+# Token bucket filling at rate bytes/s, holding at most a quarter second's worth. Senders reserve what they send
+# and sleep for the returned time, so a bucket can be shared by any number of threads without waiting on a lock.
+class tokenBucket(object):
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.burst = self.rate / 4
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate) - nbytes
+            self.stamp = now
+            return max(0.0, -self.tokens / self.rate)
+
+# Bandwidth limits of the run (--bwlimit, --host-bwlimit, --site-bwlimit): one token bucket for everything, one per
+# destination and one per serverlist group. Bytes sent are taken from every bucket that applies, and the sender
+# waits as long as the slowest of them needs.
+class bandwidthShaper(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.sites = {}
+        self.parsed = ("", {})
+
+    # Remember the serverlist group of every destination of inventory, for --site-bwlimit
+    def assign(self, inventory):
+        for entry in inventory:
+            for dest in ([f"s3://{remdir}" for remdir in entry.remdirs] if entry.protvar == "s3" else [entry.servvar]):
+                self.sites[dest] = entry.group
+
+    # --site-bwlimit as {group: MB/s}, where group None is a limit for each group
+    def siteLimits(self):
+        spec = str(args.site_bwlimit or "")
+        if self.parsed[0] != spec:
+            limits = {}
+            for part in spec.split(','):
+                if not part.strip():
+                    continue
+                name, sep, rate = part.rpartition('=')
+                try:
+                    limits[name.strip() if sep else None] = float(rate)
+                except ValueError:
+                    print(f"{r_}Ignoring --site-bwlimit {part}{_nc}: not a number of MB/s")
+            self.parsed = (spec, limits)
+        return self.parsed[1]
+
+    def bucket(self, key, rate):
+        with self.lock:
+            if (key, rate) not in self.buckets:
+                self.buckets[(key, rate)] = tokenBucket(rate * pow(2, 20))
+            return self.buckets[(key, rate)]
+
+    # The limits that apply to dest, as (bucket key, MB/s) pairs
+    def limits(self, dest):
+        found = []
+        if args.bwlimit:
+            found.append(("", args.bwlimit))
+        if args.host_bwlimit:
+            found.append(("host:" + dest, args.host_bwlimit))
+        site = self.sites.get(dest)
+        limits = self.siteLimits()
+        if site and (site in limits or None in limits):
+            found.append(("site:" + site, limits.get(site, limits.get(None))))
+        return found
+
+    # Bytes/s one of streams transfers to dest can count on under the limits, if every destination that may run
+    # at the same time uses its share. None if no limit applies.
+    def share(self, dest, streams=1):
+        shares = [rate * pow(2, 20) / (streams if key.startswith("host:") else streams * max(1, args.parallel))
+                  for key, rate in self.limits(dest)]
+        return min(shares) if shares else None
+
+    # Account nbytes sent to dest (by default this thread's destination) and wait if that is over a limit.
+    # Returns the seconds waited.
+    def take(self, nbytes, dest=None):
+        if nbytes <= 0 or not (args.bwlimit or args.host_bwlimit or args.site_bwlimit):
+            return 0.0
+        buckets = [self.bucket(key, rate) for key, rate in self.limits(dest or progress.context()[1])]
+        delay = max([bucket.reserve(nbytes) for bucket in buckets] or [0.0])
+        if delay:
+            time.sleep(delay)
+        return delay
+
+shaper = bandwidthShaper()
+
+# Progress callback for SCP. The scp module calls it per connection rather than per transfer, so bytes are
+# counted for the file this thread is sending.
 def sbar(fname, total_bytes, transfered_bytes):
-    bar_length = 35
-    percent = float(transfered_bytes) / total_bytes
-    hashes = '#' * int(round(percent * bar_length))
-    spaces = ' ' * (bar_length - len(hashes))
-    message = "\rSize: " + str(total_bytes) + " bytes("\
-        + str(round(float(total_bytes) / pow(2, 20), 2)) + " MB)"
-    message += " || Amount of file transferred: [{}] {}%\r".format(hashes + spaces,
-                                                                    round(percent * 100, 2))
-    if transfered_bytes == total_bytes:
-        message = "\rSize: " + str(total_bytes) + " bytes("\
-            + str(round(float(total_bytes) / pow(2, 20), 2)) + " MB)"
-        message += " || File transferred. [{}] {}%                    \r"\
-            .format(hashes + spaces, round(percent * 100, 2))
-    sys.stdout.write(message)
-    sys.stdout.flush()
+    fp = progress.current()
+    if fp:
+        fp.to(transfered_bytes)
 
 
 # Single destination upload function. Routes to protocol-specific upload worker functions.
@@ -282,33 +1414,18 @@ def mpfuUpload():
 
         uservar = input("\nUsername: ")
 
+        pssh, passvar = sshLogin(servvar, uservar)
         try:
-            pssh = paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-            pssh.connect(hostname=servvar, username=uservar,
-                        timeout=8)
-            passvar = ""
-            sftpc = pssh.open_sftp()
-        except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
-            print(
-                f"\n{y_}No SSH key matching this host to authenticate with.{_nc}\n\nEnter password for {y_}{uservar}{_nc}: ", end=" ")
-            
-            passvar = getpass.getpass('')
-
-            pssh = paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-            pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                        timeout=8)
             sftpc = pssh.open_sftp()
 
-        remdirvar = input(
-            "\nRemote upload directory (remote dir must be specified with leading and trailing slash): ")
+            remdirvar = input(
+                "\nRemote upload directory (remote dir must be specified with leading and trailing slash): ")
 
-        dirvar, filevar, fileglob = localfsPrompt()
+            dirvar, filevar, fileglob = localfsPrompt()
 
-        return sftpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob, sftpc)
+            return sftpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob, sftpc)
+        finally:
+            connpool.release(pssh)
 
     elif protvar == "scp":
 
@@ -319,32 +1436,18 @@ def mpfuUpload():
 
         import scp
 
+        pssh, passvar = sshLogin(servvar, uservar)
         try:
-            pssh = paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-            pssh.connect(hostname=servvar, username=uservar,
-                        timeout=8)
-            passvar = ""
             pscp = scp.SCPClient(pssh.get_transport(), progress=sbar)
-        except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
-            print(
-                f"\n{y_}No SSH key matching this host to authenticate with.{_nc}\n\nEnter password for {y_}{uservar}{_nc}: ", end=" ")
-            passvar = getpass.getpass('')
 
-            pssh = paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-            pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                        timeout=8)
-            pscp = scp.SCPClient(pssh.get_transport(), progress=sbar)
+            remdirvar = input(
+                "\nRemote upload directory (remote dir must be specified with leading and trailing slash): ")
 
-        remdirvar = input(
-            "\nRemote upload directory (remote dir must be specified with leading and trailing slash): ")
-
-        dirvar, filevar, fileglob = localfsPrompt()
+            dirvar, filevar, fileglob = localfsPrompt()
 
-        return scpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob, pscp)
+            return scpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob, pscp)
+        finally:
+            connpool.release(pssh)
 
     
     elif protvar == "smb":
@@ -414,247 +1517,888 @@ def mpfuUpload():
         return s3Upload(dirvar, filevar, fileglob, remdirvar)
 
 
-# fbar_bytes initialized in global namespace to make fbar() work
-fbar_bytes = 0
-
-def ftpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob):
+def ftpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob, logins=None):
     import ftplib
 
-    # Modified progress provider for ftplib. fbar_bytes set to 0 initially to make func work
-    def fbar(ftpbytes):
-        global fbar_bytes
-        total_bytes = bar_f_size
-        fbar_bytes += 8192
-        bar_length = 35
-        percent = float(fbar_bytes) / total_bytes
-        hashes = '#' * int(round(percent * bar_length))
-        spaces = ' ' * (bar_length - len(hashes))
-        message = "\rSize: " + str(total_bytes) + " bytes("\
-                + str(round(float(total_bytes) / pow(2, 20), 2)) + " MB)"
-        message += " || Amount of file transferred: [{0}] {1}%\r".format(hashes + spaces,
-                                                                        round(percent * 100, 2))
-        if fbar_bytes >= total_bytes:
-            message = "\rSize: " + str(total_bytes) + " bytes("\
-                    + str(round(float(total_bytes) / pow(2, 20), 2)) + " MB)"
-            message += " || File transferred. [{0}] {1}%                    \r"\
-                    .format(hashes + spaces, round(percent * 100))
-            fbar_bytes = 0
-        sys.stdout.write(message)
-        sys.stdout.flush()
+    own = logins is None
+    logins = logins or entryLogins()
     try:
-        session = ftplib.FTP_TLS()
-        session.connect(servvar, 21)
-        session.sendcmd(f'USER {uservar}')
-        session.sendcmd(f'PASS {passvar}')
-        if remdirvar != "":
-            session.sendcmd(f'cwd {remdirvar}')
-        resp_pwd = session.sendcmd('pwd')
-        ftp_pwd = resp_pwd.lstrip('0123456789" ').rstrip('"')
+        sendlist = [g for g in fileglob if not localDir(g)]
+        progress.start(protvar, servvar, sendlist)
+        session, ftp_pwd = ftpLogin(logins, servvar, uservar, passvar, remdirvar)
         if plat_type == 'Linux':
             os.system('setterm -cursor off')
-        for g in fileglob:
-            if os.path.isdir(g):
-                continue
-            gfile = str(os.path.basename(g))
-            file = open(f'{g}', 'rb')
-            global bar_f_size
-            global transfered_bytes
-            transfered_bytes = 0
-            bar_f_size = os.path.getsize(g)
-            if remdirvar == "":
-                remdirvar = "[default]"
-            print(
+        sessions = streamCount(args.ftp_sessions)
+        if sessions > 1 and len(sendlist) > 1 and not sharedMember():
+            progress.say(f"Sending {y_}{len(sendlist)}{_nc} files to {b_}{servvar}{_nc}:{p_}{ftp_pwd}{_nc} over {y_}{protvar.upper()}{_nc} "
+                         f"using {y_}{sessions}{_nc} sessions =>")
+            ftpMultiSession(logins, servvar, uservar, passvar, ftp_pwd, sendlist, sessions)
+            progress.flush()
+            progress.say("\n")
+            sendlist = []
+        for g in sendlist:
+            progress.say(
                 f"Sending {g_}{g}{_nc} to {b_}{servvar}{_nc}:{p_}{ftp_pwd}{_nc} over {y_}{protvar.upper()}{_nc} =>")
-            session.storbinary('STOR ' + gfile, file, callback=fbar)
-            print("\n\n")
-            file.close()
-        session.quit()
+            ftpStor(session, servvar, ftp_pwd, g)
+            progress.flush()
+            progress.say("\n\n")
         if plat_type == 'Linux':
             os.system('setterm -cursor on')
+        return True
     except ftplib.all_errors as e:
+        # The sessions may be broken, the next remote path logs in again
+        logins.close()
         print(f"""
 {r_}<ERROR>
 The server raised an exception: {e} {_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        errPause()
+        return False
+    finally:
+        if own:
+            logins.close()
 
 
-def sftpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob, sftpc):
+# Open a logged-in FTP session in remdirvar. Returns the session and the server's working directory.
+# With --ftps the control and data connections are encrypted, and data connections offer the control
+# connection's TLS session for resumption.
+def ftpConnect(servvar, uservar, passvar, remdirvar):
+    import ftplib
 
-    # Transfer progress provider from https://github.com/jonDel/ssh_paramiko
-    def pbar(transfered_bytes, total_bytes):
-        bar_length = 35
-        percent = float(transfered_bytes) / total_bytes
-        hashes = '#' * int(round(percent * bar_length))
-        spaces = ' ' * (bar_length - len(hashes))
-        message = "\rSize: " + str(total_bytes) + " bytes("\
-                + str(round(float(total_bytes) / pow(2, 20), 2)) + " MB)"
-        message += " || Amount of file transferred: [{0}] {1}%\r".format(hashes + spaces,
-                                                                        round(percent * 100, 2))
-        if transfered_bytes == total_bytes:
-            message = "\rSize: " + str(total_bytes) + " bytes("\
-                    + str(round(float(total_bytes) / pow(2, 20), 2)) + " MB)"
-            message += " || File transferred. [{0}] {1}%                    \r"\
-                    .format(hashes + spaces, round(percent * 100, 2))
-        sys.stdout.write(message)
-        sys.stdout.flush()
+    class ReusedSessionFTP(ftplib.FTP_TLS):
+        def ntransfercmd(self, cmd, rest=None):
+            conn, size = ftplib.FTP.ntransfercmd(self, cmd, rest)
+            if self._prot_p:
+                conn = self.context.wrap_socket(conn, server_hostname=self.host, session=self.sock.session)
+            return conn, size
+
+    session = ReusedSessionFTP()
+    started = time.time()
+    session.connect(servvar, serviceports['ftp'])
+    if args.ftps:
+        session.auth()
+    session.sendcmd(f'USER {uservar}')
+    session.sendcmd(f'PASS {passvar}')
+    controller.latency(time.time() - started)
+    if args.ftps:
+        session.prot_p()
+    if remdirvar != "":
+        session.sendcmd(f'cwd {remdirvar}')
+    return session, session.pwd()
+
+
+# The main FTP session of logins, logged in to servvar on first use, in remdirvar (relative to the directory
+# the login starts in). Returns the session and the server's working directory.
+def ftpLogin(logins, servvar, uservar, passvar, remdirvar):
+    if not logins.ftp:
+        session, logins.ftphome = ftpConnect(servvar, uservar, passvar, "")
+        logins.ftp.append(session)
+    session = logins.ftp[0]
+    if session.pwd() != logins.ftphome:
+        session.sendcmd(f'cwd {logins.ftphome}')
+    if remdirvar != "":
+        session.sendcmd(f'cwd {remdirvar}')
+    return session, session.pwd()
+
+
+# Upload one file over an FTP session, through the resume journal when --resume is set
+def ftpStor(session, servvar, ftp_pwd, g):
+    gfile = str(os.path.basename(g))
+    with progress.begin(g) as fp, localSource(g) as file:
+        if args.resume:
+            ftpResumeStor(session, servvar, ftp_pwd, g, gfile, file, fp)
+        else:
+            session.storbinary('STOR ' + gfile, file, blocksize=args.ftp_block * 1024, callback=fp.block)
+
+
+# Send files to ftp_pwd over several FTP sessions to the same server: the sessions of logins (the first one
+# being the main session), and more logged in as needed. Works like sftpMultiChannel: each session takes the
+# next file from a shared queue, and the first error is re-raised once all sessions have stopped.
+def ftpMultiSession(logins, servvar, uservar, passvar, ftp_pwd, sendlist, sessions):
+    import ftplib
+    clients = logins.ftp[:min(sessions, len(sendlist))]
+    for client in clients[1:]:
+        client.sendcmd(f'cwd {ftp_pwd}')
+    while len(clients) < min(sessions, len(sendlist)):
+        try:
+            client = ftpConnect(servvar, uservar, passvar, ftp_pwd)[0]
+        except ftplib.error_temp:
+            # Server limits connections per user or address (421), carry on with what we have
+            break
+        logins.ftp.append(client)
+        clients.append(client)
+
+    work = queue.Queue()
+    for g in sendlist:
+        work.put(g)
+    errors = []
+
+    def sessionWorker(client):
+        progress.adopt(context)
+        while not errors:
+            try:
+                g = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                ftpStor(client, servvar, ftp_pwd, g)
+            except Exception as e:
+                errors.append(e)
+                return
+
+    context = progress.context()
+    threads = [threading.Thread(target=sessionWorker, args=(client,), daemon=True) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+# Resumable FTP upload. The server's SIZE of a journaled partial upload is the confirmed offset, and
+# the transfer restarts there with REST.
+def ftpResumeStor(session, servvar, ftp_pwd, g, gfile, file, fp):
+    import ftplib
+    key = journal.key("ftp", servvar, ftp_pwd.rstrip('/') + '/' + gfile, g)
+    offset = 0
+    if journal.get(key):
+        try:
+            session.voidcmd('TYPE I')
+            offset = session.size(gfile) or 0
+        except ftplib.error_perm:
+            offset = 0
+    offset = min(offset, localSize(g))
+    if offset and not inWorker():
+        print(f"Resuming at byte {y_}{offset}{_nc} of {y_}{localSize(g)}{_nc}")
+    journal.set(key, {'offset': offset})
+    file.seek(offset)
+    fp.skip(offset)
+    session.storbinary('STOR ' + gfile, file, blocksize=args.ftp_block * 1024, callback=fp.block, rest=offset or None)
+    journal.drop(key)
+
+
+def sftpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob, sftpc):
+    import paramiko
 
     try:
         if plat_type == 'Linux':
             os.system('setterm -cursor off')
-        for g in fileglob:
-            if os.path.isdir(g):
-                continue
+        sendlist = [g for g in fileglob if not localDir(g)]
+        progress.start(protvar, servvar, sendlist)
+        if args.skip_identical:
+            sendlist = skipIdentical(sendlist, sshHashes(sftpc.get_channel().get_transport(),
+                                                         {g: remdirvar + str(os.path.basename(g)) for g in sendlist}))
+        channels = streamCount(args.channels)
+        if channels > 1 and len(sendlist) > 1 and not args.delta and not sharedMember():
+            progress.say(f"Sending {y_}{len(sendlist)}{_nc} files to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} over {y_}{protvar.upper()}{_nc} "
+                         f"using {y_}{channels}{_nc} channels =>")
+            sftpMultiChannel(sftpc, sendlist, remdirvar, channels)
+            progress.flush()
+            progress.say("\n")
+            sendlist = []
+        for g in sendlist:
             gfile = str(os.path.basename(g))
-            print(f"Sending {g_}{g}{_nc} to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} over {y_}{protvar.upper()}{_nc} =>")
-            sftpc.put(g, remdirvar + gfile, callback=pbar)
-            print("\n\n")
+            progress.say(f"Sending {g_}{g}{_nc} to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} over {y_}{protvar.upper()}{_nc} =>")
+            if args.delta and deltaUpload(sftpc.get_channel().get_transport(), g, remdirvar + gfile):
+                progress.say("\n")
+                continue
+            sftpPut(sftpc, g, remdirvar + gfile)
+            progress.flush()
+            progress.say("\n\n")
         sftpc.close()
         if plat_type == 'Linux':
             os.system('setterm -cursor on')
+        return True
     except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.BadAuthenticationType):
         print(f"""
 {r_}<ERROR>
 Username, password, or SSH key are incorrect, or the server is not accepting the type of authentication attempted{_nc}.\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        errPause()
+        return False
     except (BlockingIOError, socket.timeout):
         print(f"""
 {r_}<ERROR>
 Server is offline, unavailable, or otherwise not responding. Check the hostname or IP and try again.{_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        errPause()
+        return False
     except socket.gaierror as e:
         print(f"""
 {r_}<ERROR>
 The server raised an exception: {e} {_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        errPause()
+        return False
+
+
+# Send files over several SFTP channels opened on the transport of sftpc. Each channel pulls the next file
+# from a shared queue as soon as it is done with the last one, so every channel stays busy until the queue
+# is drained. The first error raised by any channel is re-raised once all channels have stopped.
+def sftpMultiChannel(sftpc, sendlist, remdirvar, channels):
+    import paramiko
+    transport = sftpc.get_channel().get_transport()
+    clients = [sftpc]
+    for c in range(min(channels, len(sendlist)) - 1):
+        try:
+            clients.append(paramiko.SFTPClient.from_transport(transport))
+        except paramiko.ssh_exception.SSHException:
+            # Server limits sessions per connection (OpenSSH MaxSessions), carry on with what we have
+            break
+
+    work = queue.Queue()
+    for g in sendlist:
+        work.put(g)
+    errors = []
+
+    def channelWorker(client):
+        progress.adopt(context)
+        while not errors:
+            try:
+                g = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                sftpPut(client, g, remdirvar + str(os.path.basename(g)))
+            except Exception as e:
+                errors.append(e)
+                return
+
+    context = progress.context()
+    threads = [threading.Thread(target=channelWorker, args=(client,), daemon=True) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for client in clients[1:]:
+        client.close()
+    if errors:
+        raise errors[0]
+
+
+# Upload one file over SFTP, through the resume journal when --resume is set, reporting to the progress renderer
+def sftpPut(sftpc, localfile, remotefile):
+    with progress.begin(localfile) as fp:
+        if sharedMember():
+            with localSource(localfile) as file:
+                attrs = sftpc.putfo(file, remotefile, file_size=fp.size, callback=fp.to)
+        elif args.resume:
+            attrs = sftpResumePut(sftpc, localfile, remotefile, fp)
+        elif sshprofiles[args.ssh_profile]['request'] > 32768:
+            attrs = sftpPutLarge(sftpc, localfile, remotefile, fp)
+        else:
+            # put() without its own stat of the file
+            with open(localfile, 'rb') as file:
+                attrs = sftpc.putfo(file, remotefile, file_size=fp.size, callback=fp.to)
+    return attrs
+
+# SFTP upload like sftpc.put for the throughput --ssh-profile. Writes are sent as larger pipelined requests
+# (put() uses 32 KB). The server's SSH window (2 MB for OpenSSH) limits one channel to window/RTT, so files of
+# 16 MB and up are split into byte ranges written over several SFTP channels at once, each with its own window.
+# Each writer opens its own channel, so their setup round trips overlap.
+def sftpPutLarge(sftpc, localfile, remotefile, fp):
+    import paramiko
+    profile = sshprofiles[args.ssh_profile]
+    size = localSize(localfile)
+    sftpc.open(remotefile, 'wb').close()
+    streams = profile['streams'] if size >= 16 * pow(2, 20) else 1
+    span = -(-size // streams)
+    ranges = queue.Queue()
+    for n in range(streams):
+        ranges.put((n * span, min(size, (n + 1) * span)))
+    errors = []
+
+    def rangeWriter(client):
+        try:
+            if client is None:
+                try:
+                    client = paramiko.SFTPClient.from_transport(sftpc.get_channel().get_transport())
+                except paramiko.ssh_exception.SSHException:
+                    # Server limits sessions per connection (OpenSSH MaxSessions), the others take this range
+                    return
+            with open(localfile, 'rb') as lf, client.open(remotefile, 'r+', bufsize=0) as rf:
+                rf.MAX_REQUEST_SIZE = profile['request']
+                rf.set_pipelined(True)
+                while not errors:
+                    try:
+                        start, end = ranges.get_nowait()
+                    except queue.Empty:
+                        return
+                    lf.seek(start)
+                    rf.seek(start)
+                    while start < end and not errors:
+                        data = lf.read(min(profile['request'], end - start))
+                        if not data:
+                            break
+                        rf.write(data)
+                        start += len(data)
+                        fp.add(len(data))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if client is not None and client is not sftpc:
+                client.close()
+
+    threads = [threading.Thread(target=rangeWriter, args=(sftpc if n == 0 else None,), daemon=True)
+               for n in range(streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    attrs = sftpc.stat(remotefile)
+    if attrs.st_size != size:
+        raise IOError(f"size mismatch in put! {attrs.st_size} != {size}")
+    return attrs
+
+# Split sendlist into files to send and files whose remote copy is identical, going by remotehashes
+# ({local path: SHA-256 of the remote copy}). Identical files are reported to the progress renderer as done.
+def skipIdentical(sendlist, remotehashes):
+    tosend = []
+    for g in sendlist:
+        if remotehashes.get(g) and remotehashes[g] == hashes.get(g)['sha256']:
+            progress.begin(g).identical()
+        else:
+            tosend.append(g)
+    hashes.save()
+    if len(tosend) < len(sendlist):
+        progress.say(f"{y_}{len(sendlist) - len(tosend)}{_nc} files are already identical on the destination, skipped.\n")
+    return tosend
+
+# SHA-256 of the remote copies of {local path: remote path} on an SSH host, from sha256sum runs of up to
+# 64 KB of arguments each. Files that are missing (or a host without sha256sum) are left out.
+def sshHashes(transport, remotes):
+    byremote = {}
+    for local, remote in remotes.items():
+        byremote.setdefault(remote, []).append(local)
+    found = {}
+    batch = []
+    quoted = [shlex.quote(remote) for remote in byremote]
+    for n, arg in enumerate(quoted):
+        batch.append(arg)
+        if n + 1 < len(quoted) and sum(len(a) + 1 for a in batch) < 65536:
+            continue
+        chan = transport.open_session()
+        chan.exec_command("sha256sum -- " + " ".join(batch) + " 2>/dev/null")
+        cmdout = chan.makefile('rb').read().decode(errors='replace')
+        chan.recv_exit_status()
+        chan.close()
+        batch = []
+        for line in cmdout.split("\n"):
+            # "<hash>  <path>"; names with special characters come back escaped ("\<hash>") and are just resent
+            if len(line) > 66 and line[64:66] in ("  ", " *"):
+                found[line[66:]] = line[:64]
+    return {local: found[remote] for remote, locals_ in byremote.items() if remote in found for local in locals_}
+
+# SHA-256 of the objects {local path: key} in bucket, for the ones that could be identical. listed holds the
+# keys' sizes and ETags ({key: (size, ETag)}) when the caller has already listed them, otherwise one listing of
+# the keys' range gets them. An ETag that is the local file's MD5, or its multipart ETag for a part size that
+# gives the object's part count, decides it; other objects of the right size (e.g. KMS-encrypted ones) are
+# asked for the mpfu-sha256 metadata MPFU stores on upload. Local hashes and ETags come from the hash cache.
+def s3Hashes(s3, bucket, keys, listed=None):
+    from botocore.exceptions import ClientError
+    if not keys:
+        return {}
+    bykey = {objkey: local for local, objkey in keys.items()}
+    if listed is None:
+        first, last = min(bykey), max(bykey)
+        prefix = os.path.commonprefix([first, last])
+        listed = {}
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, StartAfter=first[:-1]):
+            for obj in page.get('Contents', []):
+                if obj['Key'] in bykey:
+                    listed[obj['Key']] = (obj['Size'], obj['ETag'])
+            if page.get('Contents') and page['Contents'][-1]['Key'] >= last:
+                break
+
+    found = {}
+    for objkey, (size, etag) in listed.items():
+        local = bykey.get(objkey)
+        if local is None or size != localSize(local):
+            continue
+        etag = etag.strip('"')
+        if etag == hashes.get(local)['md5'] or etag in (hashes.etag(local, chunk) for chunk in s3PartSizes(size, etag)):
+            found[local] = hashes.get(local)['sha256']
+            continue
+        try:
+            head = s3.head_object(Bucket=bucket, Key=objkey)
+        except ClientError:
+            continue
+        if head.get('Metadata', {}).get('mpfu-sha256'):
+            found[local] = head['Metadata']['mpfu-sha256']
+    return found
+
+# Part sizes that could have given an object of size bytes its multipart ETag: --s3-chunk, then the ones that
+# give the ETag's part count, the smallest whole MB and the powers of two (8 MB is the AWS CLI's default).
+# Empty for a single-part ETag.
+def s3PartSizes(size, etag):
+    if '-' not in etag:
+        return []
+    partcount = int(etag.split('-')[1])
+    chunks = []
+    smallest = int(math.ceil(float(size) / partcount / pow(2, 20)))
+    for mb in [args.s3_chunk, smallest] + [pow(2, n) for n in range(13)]:
+        if mb * pow(2, 20) not in chunks and int(math.ceil(float(size) / (mb * pow(2, 20)))) == partcount:
+            chunks.append(mb * pow(2, 20))
+    return chunks
+
+# Metadata MPFU stores with an uploaded object: the file's SHA-256, so later runs can recognize the object
+# whatever its ETag
+def s3Metadata(localfile):
+    return {'Metadata': {'mpfu-sha256': hashes.get(localfile)['sha256']}}
+
+# Resumable SFTP upload. Continues an interrupted upload of the same file at the smaller of the journaled
+# offset and the remote size. Writes are pipelined and the file is sent in 16 MB segments; closing the remote
+# handle after each segment waits for the server to acknowledge it, and then the new offset is journaled.
+def sftpResumePut(sftpc, localfile, remotefile, fp):
+    servvar = sftpc.get_channel().get_transport().getpeername()[0]
+    key = journal.key("sftp", servvar, remotefile, localfile)
+    size = localSize(localfile)
+    offset = 0
+    entry = journal.get(key)
+    if entry:
+        try:
+            offset = min(entry['offset'], sftpc.stat(remotefile).st_size)
+        except IOError:
+            offset = 0
+    if offset and not inWorker():
+        print(f"Resuming at byte {y_}{offset}{_nc} of {y_}{size}{_nc}")
+    journal.set(key, {'offset': offset})
+    fp.skip(offset)
+
+    segment = 16 * pow(2, 20)
+    with open(localfile, 'rb') as lf:
+        lf.seek(offset)
+        while True:
+            with sftpc.open(remotefile, 'r+' if offset else 'w') as rf:
+                rf.MAX_REQUEST_SIZE = sshprofiles[args.ssh_profile]['request']
+                rf.set_pipelined(True)
+                if offset:
+                    rf.truncate(offset)
+                    rf.seek(offset)
+                end = offset + segment
+                while offset < end:
+                    data = lf.read(min(262144, end - offset))
+                    if not data:
+                        break
+                    rf.write(data)
+                    offset += len(data)
+                    fp.add(len(data))
+            if offset >= size:
+                break
+            journal.set(key, {'offset': offset})
+    journal.drop(key)
+    return sftpc.stat(remotefile)
+
+
+# Remote half of --delta mode. Prints a weak rolling checksum and an MD5 for every full block of the remote file.
+DELTA_SIG_SCRIPT = '''
+import sys, hashlib, itertools
+path, bs = sys.argv[1], int(sys.argv[2])
+try:
+    f = open(path, 'rb')
+except IOError:
+    print('MISSING')
+    sys.exit()
+out = sys.stdout
+while True:
+    d = f.read(bs)
+    if len(d) < bs:
+        break
+    a = sum(d) % 65536
+    b = sum(itertools.accumulate(d)) % 65536
+    out.write('%d %s\\n' % (a + (b << 16), hashlib.md5(d).hexdigest()))
+'''
+
+# Remote half of --delta mode. Rebuilds the file next to the old copy from block copies and literal data
+# read on stdin, checks the SHA-256 of the result and only then moves it into place.
+DELTA_APPLY_SCRIPT = '''
+import sys, os, hashlib, struct
+path, bs = sys.argv[1], int(sys.argv[2])
+tmp = path + '.mpfu-delta'
+old = open(path, 'rb')
+new = open(tmp, 'wb')
+h = hashlib.sha256()
+r = sys.stdin.buffer
+while True:
+    op = r.read(1)
+    if op == b'C':
+        old.seek(struct.unpack('>Q', r.read(8))[0] * bs)
+        d = old.read(bs)
+    elif op == b'L':
+        d = r.read(struct.unpack('>I', r.read(4))[0])
+    else:
+        new.close()
+        if op == b'E' and r.read(32) == h.digest():
+            os.chmod(tmp, os.stat(path).st_mode)
+            os.replace(tmp, path)
+            print('OK')
+        else:
+            os.remove(tmp)
+            print('BADSUM')
+        break
+    new.write(d)
+    h.update(d)
+'''
+
+# Run one of the delta scripts on the server. Returns the exit code and stdout; stdin is fed from feeder.
+def deltaRemote(transport, script, remotefile, blocksize, feeder=None):
+    chan = transport.open_session()
+    chan.exec_command(f"python3 -c {shlex.quote(script)} {shlex.quote(remotefile)} {blocksize}")
+    if feeder:
+        feeder(chan)
+        chan.shutdown_write()
+    cmdout = chan.makefile('rb').read().decode(errors='replace')
+    rc = chan.recv_exit_status()
+    chan.close()
+    return rc, cmdout
+
+# Start of the first block of the remote copy found within blocksize bytes after pos in data, by rolling the
+# weak checksum forward a byte at a time and checking candidates by MD5. None if there is none.
+def deltaSearch(data, pos, size, blocksize, blocks):
+    window = data[pos:pos + blocksize]
+    a = sum(window) % 65536
+    b = sum(itertools.accumulate(window)) % 65536
+    for start in range(pos, min(pos + blocksize, size - blocksize)):
+        outbyte, inbyte = data[start], data[start + blocksize]
+        a = (a - outbyte + inbyte) % 65536
+        b = (b - blocksize * outbyte + a) % 65536
+        weak = a + (b << 16)
+        if weak in blocks and hashlib.md5(data[start + 1:start + 1 + blocksize]).hexdigest() in blocks[weak]:
+            return start + 1
+    return None
+
+# Upload localfile to remotefile by sending only the blocks the remote copy does not already have.
+# Returns False if the delta could not be used (no remote copy, no python3 on the server), in which case
+# the caller sends the whole file.
+def deltaUpload(transport, localfile, remotefile):
+    size = localSize(localfile)
+    blocksize = args.delta_block or max(2048, min(131072, int(math.sqrt(size)) // 1024 * 1024))
+    if size < blocksize * 2:
+        return False
+    rc, cmdout = deltaRemote(transport, DELTA_SIG_SCRIPT, remotefile, blocksize)
+    if rc != 0 or cmdout.startswith('MISSING'):
+        return False
+
+    # Weak checksum -> {strong checksum: block index}, and strong checksum -> block index
+    blocks = {}
+    strong = {}
+    for index, line in enumerate(cmdout.split("\n")):
+        if not line:
+            continue
+        weak, md5 = line.split()
+        blocks.setdefault(int(weak), {}).setdefault(md5, index)
+        strong.setdefault(md5, index)
+
+    filehash = hashlib.sha256()
+
+    # Steps through the file a block at a time, looking each block up by MD5. When a block has no match, the
+    # next blocksize bytes are searched one byte at a time (deltaSearch) for data that was inserted or removed;
+    # while nothing matches, the distance to the next such search doubles, so unmatched data costs about one
+    # MD5 pass rather than a Python loop over every byte.
+    def feeder(chan):
+
+        def literal(chunk):
+            if chunk:
+                fp.add(len(chunk))
+                chan.sendall(b'L' + struct.pack('>I', len(chunk)) + chunk)
+
+        with open(localfile, 'rb') as lf, mmap.mmap(lf.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            filehash.update(data)
+            pos = 0
+            passed = gap = blocksize
+            while pos + blocksize <= size:
+                index = strong.get(hashlib.md5(data[pos:pos + blocksize]).hexdigest())
+                if index is not None:
+                    chan.sendall(b'C' + struct.pack('>Q', index))
+                    pos += blocksize
+                    passed = gap = blocksize
+                    continue
+                if passed >= gap:
+                    found = deltaSearch(data, pos, size, blocksize, blocks)
+                    if found is not None:
+                        literal(data[pos:found])
+                        pos = found
+                        continue
+                    passed, gap = 0, gap * 2
+                literal(data[pos:pos + blocksize])
+                pos += blocksize
+                passed += blocksize
+            literal(data[pos:size])
+        chan.sendall(b'E' + filehash.digest())
+
+    # Only the literal bytes count as sent; the blocks matched on the server count like resumed bytes
+    with progress.begin(localfile, size) as fp:
+        rc, cmdout = deltaRemote(transport, DELTA_APPLY_SCRIPT, remotefile, blocksize, feeder)
+        if rc != 0 or not cmdout.startswith('OK'):
+            raise IOError(f"delta rebuild of {remotefile} failed on the server ({cmdout.strip() or 'exit ' + str(rc)})")
+        sent = fp.bytes
+        fp.skip(size - sent)
+    if not inWorker():
+        print(f"Delta transfer: sent {y_}{sent}{_nc} of {y_}{size}{_nc} bytes "
+              f"({round(100 - 100.0 * sent / size, 2)}% matched the remote copy)")
+    return True
+
 
-    
 def scpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob, pscp):
+    import paramiko
+    import scp
 
     try:
         if plat_type == 'Linux':
             os.system('setterm -cursor off')
-        for g in fileglob:
-            if os.path.isdir(g):
-                continue
+        sendlist = [g for g in fileglob if not localDir(g)]
+        progress.start(protvar, servvar, sendlist)
+        if args.skip_identical:
+            sendlist = skipIdentical(sendlist, sshHashes(pscp.transport, {g: os.path.join(
+                remdirvar, str(os.path.basename(g))).replace('\\', '/') for g in sendlist}))
+        for g in sendlist:
             gfile = str(os.path.basename(g))
-            print(
+            progress.say(
                 f"Sending {g_}{g}{_nc} to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} over {y_}{protvar.upper()}{_nc} =>")
-            pscp.put(g, remote_path=remdirvar)
-            print("\n\n")
+            if args.delta and deltaUpload(pscp.transport, g, os.path.join(remdirvar, gfile).replace('\\', '/')):
+                progress.say("\n")
+                continue
+            with progress.begin(g):
+                if sharedMember():
+                    with localSource(g) as file:
+                        pscp.putfo(file, os.path.join(remdirvar, gfile).replace('\\', '/'), size=localSize(g))
+                else:
+                    pscp.put(g, remote_path=remdirvar)
+            progress.flush()
+            progress.say("\n\n")
         pscp.close()
         if plat_type == 'Linux':
             os.system('setterm -cursor on')
+        return True
     except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.BadAuthenticationType):
         print(f"""
 {r_}<ERROR>
 Username, password, or SSH key are incorrect, or the server is not accepting the type of authentication attempted{_nc}.\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        errPause()
+        return False
     except (BlockingIOError, socket.timeout):
         print(f"""
 {r_}<ERROR>
 Server is offline, unavailable, or otherwise not responding. Check the hostname or IP and try again.{_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        errPause()
+        return False
     except scp.SCPException as e:
         print(f"""
 {r_}<ERROR>
 The server raised an exception: {e} {_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        errPause()
+        return False
     except socket.gaierror as e:
         print(f"""
 {r_}<ERROR>
 The server raised an exception: {e} {_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        errPause()
+        return False
 
-def smbUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob):
-    from smb.SMBConnection import SMBConnection
+def smbUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob, logins=None):
+    from smb.base import SMBTimeout, NotConnectedError
     from smb.smb_structs import OperationFailure
-    from halo import Halo
 
+    own = logins is None
+    logins = logins or entryLogins()
     try:
-        # Sanitize username in case of domain inclusion
-        if "\\" in uservar:
-            uservar = uservar.split("\\")[1]
-            domain = uservar.split("\\")[0]
-
-        # Get local hostname and remote IP for pysmb
-        host_n = socket.gethostname()
-        target_ip = socket.gethostbyname(servvar)
-
-        # Fake a NetBIOS name
-        netbios_n = servvar.split('.')
-        netbios_n = netbios_n[0].upper()
-
-        # Extract service name from input
-        share_n = remdirvar.replace(
-            '\\\\', '/').replace('\\', '/').split('/')[1].replace('/', '')
-
-        # Extract path from input
-        path_n = remdirvar.replace(
-            '\\\\', '/').replace('\\', '/').split('/')[2:]
-        path_n = '/' + '/'.join(path_n)
-
-        # Establish actual SMB connection
-        smbc = SMBConnection(uservar, passvar, host_n,
-                                netbios_n, use_ntlm_v2=True, is_direct_tcp=True)
-        assert smbc.connect(target_ip, 445)
+        sendlist = [g for g in fileglob if not localDir(g)]
+        count = 1 if sharedMember() else max(1, min(streamCount(args.smb_connections), len(sendlist)))
+        if not logins.smb:
+            logins.smb = smbConnections(servvar, uservar, passvar, remdirvar, count)[0]
+        conns = logins.smb[:count]
+        share_n, path_n = smbPath(remdirvar)
 
         if plat_type == 'Linux':
             os.system('setterm -cursor off')
-        for g in fileglob:
-            if os.path.isdir(g):
-                continue
+        progress.start(protvar, servvar, sendlist)
+        if len(conns) > 1:
+            progress.say(f"Sending {y_}{len(sendlist)}{_nc} files to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} over {y_}{protvar.upper()}{_nc} "
+                         f"using {y_}{len(conns)}{_nc} connections =>")
+            smbEngine(conns, share_n, [(g, path_n + str(os.path.basename(g))) for g in sendlist])
+            progress.flush()
+            progress.say("\n")
+            sendlist = []
+        for g in sendlist:
             gfile = str(os.path.basename(g))
-            print(
+            progress.say(
                 f"Sending {g_}{g}{_nc} to {b_}{servvar}{_nc}:{p_}{remdirvar}{_nc} over {y_}{protvar.upper()}{_nc} =>")
-            sizedisplay = "Size: " + str(os.path.getsize(g)) + " bytes(" + str(
-                round(float(os.path.getsize(g)) / pow(2, 20), 2)) + " MB) ||"
-            spinner = Halo(text=sizedisplay, placement='right',
-                            color='yellow', spinner='dots')
-            spinner.start()
-            with open(g, 'rb') as file:
-                smbc.storeFile(share_n, path_n + gfile, file, timeout=15)
-
-            if plat_type == 'Windows':
-                spinner.stop_and_persist(
-                    '√', sizedisplay + ' Transfer complete.')
-            elif plat_type == 'Linux':
-                spinner.succeed(sizedisplay + ' Transfer complete.')
-            print("\n")
+            smbStore(conns[0], share_n, g, path_n + gfile)
+            progress.flush()
+            progress.say("\n")
         if plat_type == 'Linux':
             os.system('setterm -cursor on')
-        print("\n")
-    except (socket.gaierror, socket.timeout):
+        progress.say("\n")
+        return True
+    except (socket.gaierror, socket.timeout, ConnectionError, NotConnectedError, SMBTimeout):
+        # The connections may be broken, the next remote path connects again
+        logins.close()
         print(f"""
 {r_}<ERROR>
 Server is offline, unavailable, or otherwise not responding. Check the hostname or IP and try again.{_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        errPause()
+        return False
+
+    except PermissionError:
+        print(f"""
+{r_}<ERROR>
+Username or password are incorrect, or the server is not accepting the type of authentication attempted{_nc}.\n""")
+        errPause()
+        return False
 
     except OperationFailure:
         print(f"""
 {r_}<ERROR>
 Unable to connect to share. Permissions may be invalid or share name may be wrong.
 Please use the following format (do NOT include server name): {p_}/share/path/to/target/ {_nc}\n""")
-        input("Press a key to continue...")
-        print(" ")
-        return
+        errPause()
+        return False
+    finally:
+        if own:
+            logins.close()
+
+
+# Share name and path in the share of an SMB remote path (/share/path/to/target/)
+def smbPath(remdirvar):
+    parts = remdirvar.replace('\\\\', '/').replace('\\', '/').split('/')
+    return parts[1], '/' + '/'.join(parts[2:])
+
+
+# Open up to count authenticated SMB connections to servvar for remdirvar (/share/path/to/target/). More than
+# one connection is only a bonus, so once the first is up a failure just stops opening more. Returns the
+# connections, the share name and the path in the share. Raises PermissionError if the login is refused.
+def smbConnections(servvar, uservar, passvar, remdirvar, count=1):
+    from smb.SMBConnection import SMBConnection
+
+    # Sanitize username in case of domain inclusion
+    domain = ""
+    if "\\" in uservar:
+        domain, uservar = uservar.split("\\", 1)
+
+    # Get local hostname and remote IP for pysmb
+    host_n = socket.gethostname()
+    target_ip = resolveHost(servvar)
+
+    # Fake a NetBIOS name
+    netbios_n = servvar.split('.')
+    netbios_n = netbios_n[0].upper()
+
+    share_n, path_n = smbPath(remdirvar)
+
+    conns = []
+    for c in range(count):
+        # Establish actual SMB connection
+        smbc = SMBConnection(uservar, passvar, host_n, netbios_n, domain=domain,
+                             use_ntlm_v2=True, is_direct_tcp=True)
+        try:
+            started = time.time()
+            if not smbc.connect(target_ip, serviceports['smb']):
+                smbc.close()
+                raise PermissionError(f"SMB login to {servvar} refused")
+            controller.latency(time.time() - started)
+        except Exception:
+            if not conns:
+                raise
+            break
+        conns.append(smbc)
+    return conns, share_n, path_n
+
+
+# Upload one local file to remotefile on share_n, as one of streams transfers to the server. pysmb's timeout
+# covers the whole transfer, so it grows with the file size at 1 MB/s, or at the share of the bandwidth limits
+# this transfer gets if that is slower, instead of cutting large files off.
+def smbStore(smbc, share_n, localfile, remotefile, streams=1):
+    rate = min(pow(2, 20), shaper.share(progress.context()[1], streams) or pow(2, 20))
+    with progress.begin(localfile) as fp, localSource(localfile) as file:
+        smbc.storeFile(share_n, remotefile, progressReader(file, fp),
+                       timeout=15 + int(localSize(localfile) / rate))
+
+
+# Upload (local path, remote path) pairs to share_n over several SMB connections to the same server. Works
+# like sftpMultiChannel: each connection takes the next file from a shared queue, and the first error is
+# re-raised once all connections have stopped.
+def smbEngine(conns, share_n, pairs):
+    work = queue.Queue()
+    for pair in pairs:
+        work.put(pair)
+    errors = []
+
+    def connWorker(smbc):
+        progress.adopt(context)
+        while not errors:
+            try:
+                localfile, remotefile = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                smbStore(smbc, share_n, localfile, remotefile, len(conns))
+            except Exception as e:
+                errors.append(e)
+                return
+
+    context = progress.context()
+    threads = [threading.Thread(target=connWorker, args=(smbc,), daemon=True) for smbc in conns]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+# Create remdir and any missing parents on share_n. made holds the directories already created (or found)
+# during this upload, so each one costs at most one request. Returns the number of directories created.
+def smbMakeDirs(smbc, share_n, remdir, made):
+    from smb.smb_structs import OperationFailure
+
+    created = 0
+    path = ""
+    for part in remdir.strip('/').split('/'):
+        if not part:
+            continue
+        path += '/' + part
+        if path in made:
+            continue
+        try:
+            smbc.createDirectory(share_n, path)
+            created += 1
+        except OperationFailure:
+            # Already exists; if it really couldn't be created, the uploads into it will fail instead
+            pass
+        made.add(path)
+    return created
+
+
+# Upload the local directory dirvar (recursively) into remdirvar under the entry's share path, over a pool of
+# --smb-connections connections. Directories are created first, then the files are sent concurrently.
+# Gives the same layout as sftpDirPut.
+def smbDirUpload(entry, dirvar, remdirvar):
+    base, parent = localRoot(dirvar)
+    localfiles, localdirs = localTree(os.path.join(base, parent))
+    conns, share_n, path_n = smbConnections(entry.servvar, entry.uservar, entry.passvar, entry.remdirs[0],
+                                            max(1, min(streamCount(args.smb_connections), len(localfiles))))
+    remroot = "/".join(p for p in (path_n.strip('/'), remdirvar.replace('\\', '/').strip('/'), parent) if p)
+    print(f"\nStarting directory transfer to {b_}{entry.servvar}{_nc}:{p_}/{share_n}/{remroot}{_nc}: ")
+    progress.start("smb", entry.servvar)
+    progress.expect(entry.servvar, sum(size for size, mtime in localfiles.values()))
+
+    if plat_type == 'Linux':
+        os.system('setterm -cursor off')
+    made = set()
+    dirnum = 0
+    for rel in localdirs:
+        dirnum += smbMakeDirs(conns[0], share_n, remroot + '/' + rel if rel else remroot, made)
+    try:
+        smbEngine(conns, share_n, [(os.path.join(base, parent, rel), remroot + '/' + rel) for rel in localfiles])
+    finally:
+        for smbc in conns:
+            smbc.close()
+        if plat_type == 'Linux':
+            os.system('setterm -cursor on')
+    if not inWorker():
+        progress.finish()
+    print(f"Finished transferring {y_}{dirnum}{_nc} directories and {y_}{len(localfiles)}{_nc} files.")
+    return True
 
 
 def s3Upload(dirvar, filevar, fileglob, remdirvar):
@@ -662,44 +2406,43 @@ def s3Upload(dirvar, filevar, fileglob, remdirvar):
     import boto3
     from botocore.exceptions import NoCredentialsError, ClientError
 
-    # Modified progress provider for S3. boto3 only sends transferred bytes each update.
-    def s3bar(t_bytes):
-        global s3_bytes
-        s3_bytes += t_bytes
-        bar_length = 35
-        percent = float(s3_bytes) / s3_f_size
-        hashes = '#' * int(round(percent * bar_length))
-        spaces = ' ' * (bar_length - len(hashes))
-        message = "\rSize: " + str(s3_f_size) + " bytes("\
-                + str(round(float(s3_f_size) / pow(2, 20), 2)) + " MB)"
-        message += " || Amount of file transferred: [{}] {}%\r".format(hashes + spaces,
-                                                                    round(percent * 100, 2))
-        if s3_bytes == s3_f_size:
-            message = "\rSize: " + str(s3_f_size) + " bytes("\
-                    + str(round(float(s3_f_size) / pow(2, 20), 2)) + " MB)"
-            message += " || File transferred. [{}] {}%                    \r"\
-                    .format(hashes + spaces, round(percent * 100, 2))
-        sys.stdout.write(message)
-        sys.stdout.flush()
-
     try:
         s3 = boto3.client('s3')
         if plat_type == 'Linux':
             os.system('setterm -cursor off')
-        for g in fileglob:
-            if os.path.isdir(g):
-                continue
+        sendlist = [g for g in fileglob if not localDir(g)]
+        progress.start("s3", f"s3://{remdirvar}", sendlist)
+        extra = {}
+        if args.skip_identical:
+            sendlist = skipIdentical(sendlist, s3Hashes(s3, remdirvar, {g: str(os.path.basename(g)) for g in sendlist}))
+            extra = {str(os.path.basename(g)): s3Metadata(g) for g in sendlist}
+        objects = streamCount(args.s3_objects)
+        if objects > 1 and len(sendlist) > 1 and not args.resume and not sharedMember():
+            progress.say(f"Sending {y_}{len(sendlist)}{_nc} files to {b_}s3://{_nc}:{p_}{remdirvar}{_nc} over {y_}HTTPS{_nc}, "
+                         f"{y_}{objects}{_nc} at a time =>")
+            s3Engine(s3, [(g, str(os.path.basename(g))) for g in sendlist], remdirvar, extra=extra, objects=objects)
+            progress.flush()
+            progress.say("\n")
+            sendlist = []
+        for g in sendlist:
             gfile = str(os.path.basename(g))
-            global s3_f_size
-            s3_f_size = os.path.getsize(g)
-            global s3_bytes
-            s3_bytes = 0
-            print(
+            progress.say(
                 f"Sending {g_}{g}{_nc} to {b_}s3://{_nc}:{p_}{remdirvar}{_nc} over {y_}HTTPS{_nc} =>")
-            s3.upload_file(g, remdirvar, gfile, Callback=s3bar)
-            print("\n\n")
+            with progress.begin(g) as fp:
+                if sharedMember():
+                    with localSource(g) as file:
+                        s3.upload_fileobj(file, remdirvar, gfile, Callback=fp.add, Config=s3TransferConfig(),
+                                          ExtraArgs=extra.get(gfile))
+                elif args.resume:
+                    s3ResumeUpload(s3, g, remdirvar, gfile, fp, extra.get(gfile))
+                else:
+                    s3.upload_file(g, remdirvar, gfile, Callback=fp.add, Config=s3TransferConfig(),
+                                   ExtraArgs=extra.get(gfile))
+            progress.flush()
+            progress.say("\n\n")
         if plat_type == 'Linux':
             os.system('setterm -cursor on')
+        return True
     except NoCredentialsError:
         print(f"""
 {r_}Could not determine valid credentials for AWS{_nc}.
@@ -714,26 +2457,116 @@ To install {y_}awscli{_nc} through Python:
 
 pip install awscli\n""")
 
-        input("Press a key to continue...")
-        print(" ")
-        return
+        errPause()
+        return False
     except ClientError as e:
         if e.response['Error']['Code'] == "NoSuchBucket" or "AccessDenied":
             print(f"""
 {r_}<ERROR>
 Bucket name doesn't exist or access was denied. Check the bucket name and your permissions and try again.{_nc}
     """)
-            input("Press a key to continue...")
-            print(" ")
-            return
+            errPause()
+            return False
         elif e.response['Error']['Code'] != "":
             print(f"""
 {r_}<ERROR>
 Unknown error. Check your credentials and bucketname and try again.{_nc}
 """)
-            input("Press a key to continue...")
-            print(" ")
-            return
+            errPause()
+            return False
+
+# Multipart chunk size and part concurrency for S3 uploads, from the --s3-* options
+def s3TransferConfig(objects=1):
+    from boto3.s3.transfer import TransferConfig
+    chunk = args.s3_chunk * pow(2, 20)
+    return TransferConfig(multipart_threshold=chunk, multipart_chunksize=chunk,
+                          max_concurrency=args.s3_concurrency * objects)
+
+# Upload many (local path, key) pairs to bucket through one shared TransferManager, with up to --s3-objects
+# objects in flight, all reported to the progress renderer. Raises the first error once every upload
+# has finished or failed.
+def s3Engine(s3, pairs, bucket, extra=None, objects=None):
+    from s3transfer.manager import TransferManager
+    from s3transfer.subscribers import BaseSubscriber
+
+    objects = objects or args.s3_objects
+    slots = threading.Semaphore(max(1, objects))
+
+    class engineSubscriber(BaseSubscriber):
+        def __init__(self, fp):
+            self.fp = fp
+
+        def on_progress(self, future, bytes_transferred, **kwargs):
+            self.fp.add(bytes_transferred)
+
+        def on_done(self, future, **kwargs):
+            try:
+                future.result()
+                self.fp.finish()
+            except Exception:
+                self.fp.fail()
+            slots.release()
+
+    futures = []
+    with TransferManager(s3, s3TransferConfig(objects)) as manager:
+        for g, objkey in pairs:
+            slots.acquire()
+            futures.append(manager.upload(g, bucket, objkey, extra_args=(extra or {}).get(objkey),
+                                          subscribers=[engineSubscriber(progress.begin(g))]))
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+    if errors:
+        raise errors[0]
+
+# Resumable S3 upload using a multipart upload in --s3-chunk parts whose UploadId is kept in the journal. On a
+# rerun the parts S3 already has are listed and only the missing ones are sent. Files smaller than two parts are
+# uploaded normally. extra holds the object's ExtraArgs (s3Metadata), if any.
+def s3ResumeUpload(s3, g, bucket, objkey, fp, extra=None):
+    from botocore.exceptions import ClientError
+
+    partsize = args.s3_chunk * pow(2, 20)
+    size = localSize(g)
+    if size < partsize * 2:
+        return s3.upload_file(g, bucket, objkey, Callback=fp.add, ExtraArgs=extra)
+
+    key = journal.key("s3", bucket, objkey, g)
+    entry = journal.get(key)
+    done = {}
+    if entry:
+        try:
+            paginator = s3.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=bucket, Key=objkey, UploadId=entry['upload_id']):
+                for part in page.get('Parts', []):
+                    done[part['PartNumber']] = part['ETag']
+            partsize = entry['partsize']
+        except ClientError:
+            entry = None
+            done = {}
+    if not entry:
+        upload = s3.create_multipart_upload(Bucket=bucket, Key=objkey, **(extra or {}))
+        entry = {'upload_id': upload['UploadId'], 'partsize': partsize}
+        journal.set(key, entry)
+    elif done and not inWorker():
+        print(f"Resuming with {y_}{len(done)}{_nc} parts already uploaded")
+
+    with open(g, 'rb') as file:
+        for partnum in range(1, int(math.ceil(float(size) / partsize)) + 1):
+            if partnum in done:
+                fp.skip(min(partsize, size - (partnum - 1) * partsize))
+                continue
+            file.seek((partnum - 1) * partsize)
+            data = file.read(partsize)
+            part = s3.upload_part(Bucket=bucket, Key=objkey, UploadId=entry['upload_id'],
+                                  PartNumber=partnum, Body=data)
+            done[partnum] = part['ETag']
+            fp.add(len(data))
+    s3.complete_multipart_upload(Bucket=bucket, Key=objkey, UploadId=entry['upload_id'],
+                                 MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': done[n]} for n in sorted(done)]})
+    journal.drop(key)
 
 # MPFU multi-file upload function
 def mpfuMultiUpload():
@@ -754,54 +2587,14 @@ Enter server list in the format above:""")
 
     dirvar, filevar, fileglob = localfsPrompt()
 
-    # Loop through input list and parse into variables
-    split_input = inputlistvar.split(",")
-    for e in range(len(split_input)):
-        pop_input = split_input.pop()
-        elem = pop_input.split(":")
-        protvar = elem[0].strip()
-        if protvar != "s3":
-            servvar = elem[1].strip()
-            remdirvar = elem[2].strip()
-            uservar = elem[3].strip()
-            passvar = elem[4].strip()
-        if protvar == "s3":
-            remdirvar = elem[1].strip()
-
-        # Perform uploads
-        if protvar == "ftp":
-            print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-            ftpUpload(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob)
-        elif protvar == "sftp":
-            pssh=paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(
-                paramiko.WarningPolicy())
-            print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-            pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                        timeout=8)
-            sftpc=pssh.open_sftp()
-            sftpUpload(protvar, servvar, uservar, passvar,
-                        dirvar, filevar, remdirvar, fileglob, sftpc)
-        elif protvar == "scp":
-            import scp
-            pssh=paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-            pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                         timeout=8)
-            pscp=scp.SCPClient(pssh.get_transport(), progress=sbar)
-            print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-            scpUpload(protvar, servvar, uservar, passvar,
-                      dirvar, filevar, remdirvar, fileglob, pscp)
-        elif protvar == "smb":
-            print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-            smbUpload(protvar, servvar, uservar, passvar,
-                      dirvar, filevar, remdirvar, fileglob)
-        if protvar == "s3":
-            print(f"Starting transfers to {y_}s3://{_nc}:{p_}{remdirvar}{_nc}: \n")
-            servvar, uservar, passvar = (" ", " ", " ")
-            s3Upload(dirvar, filevar, fileglob, remdirvar)
+    # Parse input list and perform uploads
+    results = []
+    started = time.time()
+    for entry in compileServerlist(inputlistvar.split(",")):
+        results.append(destTaskRetrying(entry.protvar, entry.servvar, ",".join(entry.remdirs),
+                                        functools.partial(mpfuSendEntry, entry, dirvar, filevar, fileglob, None, set())))
+    if [res for res in results if not res['ok']]:
+        fanOutSummary(results, time.time() - started)
 
 # MPFU multi-file upload to destination list file
 def mpfuMultiUploadFile():
@@ -822,68 +2615,1334 @@ AWS S3:
         print(" ")
         return
     elif args.list:
-        with open(args.list, 'r') as serv_file:
-            ufile_input = serv_file.read()
-            sfile_input = ufile_input.strip()
+        inventory = loadInventory()
 
-            dirvar, filevar, fileglob = localfsPrompt()
+        dirvar, filevar, fileglob = localfsPrompt()
 
-            # Loop through input list and parse into variables
-            split_input = sfile_input.split("\n")
-            for e in range(len(split_input)):
-                pop_input = split_input.pop()
-                elem = pop_input.split(":")
-                protvar = elem[0].strip()
-                if protvar != "s3":
-                    servvar = elem[1].strip()
-                    remdirvar = elem[2].strip()
-                    uservar = elem[3].strip()
-                    passvar = elem[4].strip()
-                if protvar == "s3":
-                    remdirvar = elem[1].strip()
-                    servvar = ""
-                    uservar = ""
-                    passvar = ""
-
-                # Perform uploads
-                if protvar == "ftp":
-                    print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-                    ftpUpload(protvar, servvar, uservar, passvar,
-                            dirvar, filevar, remdirvar, fileglob)
-                elif protvar == "sftp":
-                    pssh = paramiko.SSHClient()
-                    pssh.load_system_host_keys()
-                    pssh.set_missing_host_key_policy(
-                        paramiko.WarningPolicy())
-                    print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-                    pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                                timeout=8)
-                    sftpc = pssh.open_sftp()
-                    sftpUpload(protvar, servvar, uservar, passvar,
+        # Perform uploads, several destinations at a time if requested
+        if args.parallel > 1:
+            mpfuFanOut(inventory, dirvar, filevar, fileglob)
+            return
+        with statOnce(fileglob) as (fileglob, sizes):
+            inventory, skipped = preflight(inventory, 0 if args.delta else sum(sizes))
+            results = []
+            started = time.time()
+            for entry in inventory:
+                results.append(destTaskRetrying(entry.protvar, entry.servvar, ",".join(entry.remdirs),
+                                                functools.partial(mpfuSendEntry, entry, dirvar, filevar, fileglob,
+                                                                  None, set())))
+        fanOutSummary(results + skipped, time.time() - started)
+        metrics.flush()
+
+
+# FTP sessions and SMB connections to one server, opened by the first remote path that needs them and reused
+# by the others, since these protocols have no connection pool. close() logs out of all of them.
+class entryLogins(object):
+
+    def __init__(self):
+        self.ftp = []
+        self.ftphome = ""
+        self.smb = []
+
+    def close(self):
+        for session in self.ftp:
+            try:
+                session.quit()
+            except Exception:
+                session.close()
+        for smbc in self.smb:
+            smbc.close()
+        self.ftp = []
+        self.smb = []
+
+# Connect to and upload fileglob to one serverlist destination. Returns True if every file was sent.
+def mpfuSendDest(protvar, servvar, uservar, passvar, dirvar, filevar, remdirvar, fileglob, logins=None):
+    if protvar == "ftp":
+        progress.say(f"Starting transfers to {b_}{servvar}{_nc}: \n")
+        return ftpUpload(protvar, servvar, uservar, passvar,
+                        dirvar, filevar, remdirvar, fileglob, logins)
+    elif protvar == "sftp":
+        progress.say(f"Starting transfers to {b_}{servvar}{_nc}: \n")
+        with connpool.lease(servvar, uservar, passvar) as pssh:
+            sftpc = pssh.open_sftp()
+            return sftpUpload(protvar, servvar, uservar, passvar,
                             dirvar, filevar, remdirvar, fileglob, sftpc)
-                elif protvar == "scp":
-                    import scp
-                    pssh = paramiko.SSHClient()
-                    pssh.load_system_host_keys()
-                    pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-                    pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                                timeout=8)
-                    pscp = scp.SCPClient(pssh.get_transport(), progress=sbar)
-                    print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-                    scpUpload(protvar, servvar, uservar, passvar,
+    elif protvar == "scp":
+        import scp
+        with connpool.lease(servvar, uservar, passvar) as pssh:
+            pscp = scp.SCPClient(pssh.get_transport(), progress=sbar)
+            progress.say(f"Starting transfers to {b_}{servvar}{_nc}: \n")
+            return scpUpload(protvar, servvar, uservar, passvar,
                             dirvar, filevar, remdirvar, fileglob, pscp)
-                elif protvar == "smb":
-                    print(f"Starting transfers to {b_}{servvar}{_nc}: \n")
-                    smbUpload(protvar, servvar, uservar, passvar,
-                            dirvar, filevar, remdirvar, fileglob)
-                if protvar == "s3":
-                    print(
-                        f"Starting transfers to {y_}s3://{_nc}:{p_}{remdirvar}{_nc}: \n")
-                    servvar, uservar, passvar = (" ", " ", " ")
-                    s3Upload(dirvar, filevar, fileglob, remdirvar)
+    elif protvar == "smb":
+        progress.say(f"Starting transfers to {b_}{servvar}{_nc}: \n")
+        return smbUpload(protvar, servvar, uservar, passvar,
+                        dirvar, filevar, remdirvar, fileglob, logins)
+    elif protvar == "s3":
+        progress.say(
+            f"Starting transfers to {y_}s3://{_nc}:{p_}{remdirvar}{_nc}: \n")
+        return s3Upload(dirvar, filevar, fileglob, remdirvar)
+    workerstate.reason = f"unknown protocol '{protvar}'"
+    return False
+
+# Upload fileglob to every remote path of one inventory entry. Returns True if all of them succeeded.
+# With sharedReads, the first remote path sent joins a shared read of the files and any others read
+# from disk, since one thread can only keep up with one place in the shared read. done collects the
+# files that arrived, and a retry of the entry (with the same done) only sends the others. SSH entries share
+# a pooled connection between their remote paths, FTP and SMB entries the logins held here.
+def mpfuSendEntry(entry, dirvar, filevar, fileglob, reads=None, done=None):
+    ok = True
+    logins = entryLogins()
+    try:
+        for remdirvar in entry.remdirs:
+            sendlist = [g for g in fileglob if done is None or (remdirvar, g) not in done]
+            if done and not [g for g in sendlist if not localDir(g)]:
+                continue
+            shared = reads.join() if reads else None
+            reads = None
+            workerstate.member = shared
+            progress.scope(remote=remdirvar, done=done)
+            try:
+                ok = mpfuSendDest(entry.protvar, entry.servvar, entry.uservar, entry.passvar,
+                                  dirvar, filevar, remdirvar, sendlist, logins) and ok
+            finally:
+                workerstate.member = None
+                progress.scope(remote="", done=None)
+                if shared:
+                    shared.leave()
+    finally:
+        logins.close()
+    return ok
+
+# Runs one destination's task inside the fan-out worker pool and returns its result row. ticket is the task's
+# place in the fan-out, which --adaptive starts tasks in, and attempt the retry it is.
+def fanOutWorker(protvar, servvar, remdirvar, task, ticket=0, attempt=0):
+    workerstate.active = True
+    controller.acquire(ticket)
+    try:
+        return destTask(protvar, servvar, remdirvar, task, attempt)
+    finally:
+        controller.release()
+
+# Run the upload task for one destination (attempt is the retry number), record it in the metrics and return
+# its result row. 'transient' in the row tells whether the failure was a network error worth retrying.
+# Errors don't stop the caller: outside a worker they are printed here, and the next destination goes on.
+# A task with a settle attribute has it called when the attempt is over, also when the task never ran because
+# the host's circuit breaker is open, so tasks that wait for this one (--relay) can go on.
+def destTask(protvar, servvar, remdirvar, task, attempt=0):
+    workerstate.reason = ""
+    workerstate.error = None
+    workerstate.fleet = True
+    progress.scope(attempt=attempt)
+    host = servvar if protvar != "s3" else f"s3://{remdirvar}"
+    started = time.time()
+    error = None
+    try:
+        breakers.check(host)
+        ok = task()
+    except Exception as e:
+        ok, error = False, e
+        workerstate.reason = str(e)
+        workerstate.error = e
+    finally:
+        workerstate.fleet = False
+        progress.scope(attempt=0)
+        if getattr(task, 'settle', None):
+            task.settle()
+    if ok is None:
+        ok = False
+    if error:
+        controller.error(error)
+    transient = not ok and transientError(workerstate.error)
+    if ok:
+        breakers.success(host)
+    elif transient:
+        breakers.failure(host)
+    res = {'prot': protvar, 'host': host, 'remote': remdirvar, 'ok': ok,
+           'reason': "" if ok else (workerstate.reason or "upload failed"),
+           'seconds': time.time() - started, 'transient': transient}
+    sent, files = metrics.takeDest(host)
+    metrics.record("destination", protvar, host, "ok" if ok else "failed", sent, res['seconds'], retries=attempt,
+                   remote=remdirvar, files=files, reason=res['reason'])
+    if error and not inWorker():
+        print(f"\n{r_}<ERROR>\n{errorText(error)}{_nc}\n")
+    return res
+
+# destTask outside a fan-out, retrying a network failure after a backoff. Returns the last result row.
+def destTaskRetrying(protvar, servvar, remdirvar, task):
+    for attempt in itertools.count():
+        res = destTask(protvar, servvar, remdirvar, task, attempt)
+        delay = retryDelay(res, attempt)
+        if delay is None:
+            return res
+        print(f"{y_}{res['host']}{_nc}: {res['reason']}. Retry {attempt + 1} of {args.retries} in {round(delay, 1)}s")
+        time.sleep(delay)
+
+# Seconds to wait before retrying the destination of result row res after attempt, or None if it shouldn't be:
+# it worked, failed for a reason a retry won't fix, is out of retries or its host's circuit breaker is open.
+# The wait doubles from --retry-base up to --retry-max, and a random half of it is jitter, so hosts that
+# failed together don't all come back at once.
+def retryDelay(res, attempt):
+    if res['ok'] or not res.get('transient') or attempt >= args.retries or breakers.isOpen(res['host']):
+        return None
+    delay = min(args.retry_max, args.retry_base * pow(2, attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+# Network errors (timeouts, resets, dropped SSH sessions, temporary FTP errors) that may go away on their own,
+# as opposed to a refused login, a missing path or a name that doesn't resolve
+def transientError(e):
+    if e is None:
+        return False
+    if type(e).__name__ in ("SSHException", "error_temp"):
+        return True
+    return isinstance(e, (OSError, EOFError)) and not isinstance(
+        e, (FileNotFoundError, PermissionError, IsADirectoryError, NotADirectoryError, socket.gaierror))
+
+# Message for an error that ended a destination's task
+def errorText(e):
+    paramiko = sys.modules.get('paramiko')
+    if paramiko and isinstance(e, (paramiko.ssh_exception.AuthenticationException,
+                                   paramiko.ssh_exception.BadAuthenticationType)):
+        return ("Username, password, or SSH key are incorrect, or the server is not accepting the type of "
+                "authentication attempted.")
+    if isinstance(e, (BlockingIOError, socket.timeout)):
+        return "Server is offline, unavailable, or otherwise not responding. Check the hostname or IP and try again."
+    return f"The server raised an exception: {e}"
+
+# Per-host circuit breakers. After --breaker network failures in a row a host's circuit opens, and work for it
+# fails right away (CircuitOpenError) for --breaker-cooldown seconds. After that one attempt is let through;
+# a success closes the circuit again, a failure opens it for another cooldown.
+class circuitBreakers(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def state(self, host):
+        return self.hosts.setdefault(host, {'failures': 0, 'opened': None})
+
+    def isOpen(self, host):
+        with self.lock:
+            state = self.state(host)
+            return state['opened'] is not None and time.time() - state['opened'] < args.breaker_cooldown
+
+    def check(self, host):
+        with self.lock:
+            state = self.state(host)
+            if state['opened'] is not None and time.time() - state['opened'] < args.breaker_cooldown:
+                raise CircuitOpenError(f"{host} is set aside after {state['failures']} network failures in a row "
+                                       f"(tried again after {round(state['opened'] + args.breaker_cooldown - time.time())}s)")
+
+    def success(self, host):
+        with self.lock:
+            self.hosts[host] = {'failures': 0, 'opened': None}
+
+    def failure(self, host):
+        with self.lock:
+            state = self.state(host)
+            state['failures'] += 1
+            if args.breaker and state['failures'] >= args.breaker:
+                state['opened'] = time.time()
+
+breakers = circuitBreakers()
+
+# Raised for work on a host whose circuit breaker is open
+class CircuitOpenError(Exception):
+    pass
+
+# Sizes of the local files of the upload that is running, {path: size}, so that they are looked up once for all
+# of its destinations instead of once per destination (see localSize and localDir). Directories are never in it.
+uploadsizes = {}
+
+# Look up the files of fileglob once for every destination of an upload, for the length of a with block.
+# Gives the files (without directories) and their sizes.
+@contextlib.contextmanager
+def statOnce(fileglob):
+    files = [g for g in fileglob if not os.path.isdir(g)]
+    sizes = [os.path.getsize(g) for g in files]
+    uploadsizes.update(zip(files, sizes))
+    try:
+        yield files, sizes
+    finally:
+        uploadsizes.clear()
+
+# Size of localfile, from the running upload's sizes if it is one of its files
+def localSize(localfile):
+    size = uploadsizes.get(localfile)
+    return os.path.getsize(localfile) if size is None else size
+
+# True if path is a directory, without looking at the disk for files of the running upload
+def localDir(path):
+    return path not in uploadsizes and os.path.isdir(path)
+
+# One read of a set of files shared by several destinations (--shared-read). The first destination to open a file
+# starts a thread that reads the files in order, 1 MB at a time, and queues each chunk for every member. A member
+# whose queue holds --shared-depth chunks holds the read up, so the slowest destination sets the pace and no more
+# than that many chunks are buffered. Members that leave (finished or failed) are dropped from the read.
+class sharedRead(object):
+
+    def __init__(self, files, chunk=pow(2, 20)):
+        self.files = files
+        self.paths = set(path for path, size in files)
+        self.chunk = chunk
+        self.members = []
+        self.lock = threading.Lock()
+        self.started = False
+        self.error = None
+
+    # A new member, or None once the read has started and it is too late to join
+    def join(self):
+        with self.lock:
+            if self.started:
+                return None
+            member = sharedMemberQueue(self)
+            self.members.append(member)
+            return member
+
+    def start(self):
+        with self.lock:
+            if not self.started:
+                self.started = True
+                threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        try:
+            for path, size in self.files:
+                with open(path, 'rb') as file:
+                    while True:
+                        data = file.read(self.chunk)
+                        for member in self.members:
+                            member.put((path, data))
+                        if not data:
+                            break
+        except (IOError, OSError) as e:
+            self.error = e
+        for member in self.members:
+            member.put(None)
+
+
+# The shared reads of one fan-out. A destination joins the read that hasn't started yet when a worker picks
+# it up, so reads are only shared by destinations that are running. Once a read has started, destinations
+# that start after it join a new one.
+class sharedReads(object):
+
+    def __init__(self, files):
+        self.files = files
+        self.lock = threading.Lock()
+        self.current = None
+
+    def join(self):
+        with self.lock:
+            member = self.current.join() if self.current else None
+            if member is None:
+                self.current = sharedRead(self.files)
+                member = self.current.join()
+            return member
+
+
+# One destination's place in a sharedRead: its queue of (path, chunk) items, b"" ending each file and None
+# ending the read
+class sharedMemberQueue(object):
+
+    def __init__(self, shared):
+        self.shared = shared
+        self.queue = queue.Queue(maxsize=max(1, args.shared_depth))
+        self.pending = None
+        self.left = False
+
+    # Called by the read; waits while the queue is full unless the member leaves meanwhile
+    def put(self, item):
+        while not self.left:
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def next(self):
+        if self.pending is not None:
+            item, self.pending = self.pending, None
+            return item
+        return self.queue.get()
+
+    # Reader for path. Chunks of files this destination skipped (identical, failed) are passed over.
+    def open(self, path):
+        self.shared.start()
+        while True:
+            item = self.next()
+            if item is None:
+                raise IOError(f"shared read of {path} failed: {self.shared.error or 'no more files'}")
+            if item[0] == path:
+                self.pending = item
+                return sharedReader(self, path)
+
+    def leave(self):
+        self.left = True
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+
+# Read-only file over the chunks of one file from a sharedMemberQueue. Closing it skips to the end of the file,
+# so the next file starts in the right place even if the upload stopped reading early. Reads within the current
+# chunk are memoryview slices of it, so the chunk isn't copied for every read; only a read that runs on into the
+# next chunk is joined into new bytes.
+class sharedReader(object):
+
+    def __init__(self, member, path):
+        self.member = member
+        self.path = path
+        self.chunk = memoryview(b"")
+        self.offset = 0
+        self.position = 0
+        self.done = False
+
+    def tell(self):
+        return self.position
+
+    # Move on to the file's next chunk. False at the end of the file.
+    def more(self):
+        if self.done:
+            return False
+        item = self.member.next()
+        if item is None:
+            raise IOError(f"shared read of {self.path} failed: {self.member.shared.error}")
+        if not item[1]:
+            self.done = True
+            return False
+        self.chunk, self.offset = memoryview(item[1]), 0
+        return True
+
+    def read(self, size=-1):
+        if self.offset == len(self.chunk):
+            self.more()
+        if 0 <= size <= len(self.chunk) - self.offset:
+            data = self.chunk[self.offset:self.offset + size]
+            self.offset += size
+        else:
+            parts = [self.chunk[self.offset:]]
+            self.offset = len(self.chunk)
+            wanted = size - len(parts[0])
+            while (size < 0 or wanted > 0) and self.more():
+                self.offset = len(self.chunk) if size < 0 else min(len(self.chunk), wanted)
+                parts.append(self.chunk[:self.offset])
+                wanted -= self.offset
+            data = b"".join(parts)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        while not self.done:
+            item = self.member.next()
+            if item is None or not item[1]:
+                self.done = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# This worker's sharedRead member, if it is reading from one
+def sharedMember():
+    return getattr(workerstate, 'member', None)
+
+# Local file to send: from this worker's shared read if it has one covering localfile, else opened from disk
+def localSource(localfile):
+    member = sharedMember()
+    if member and localfile in member.shared.paths:
+        return member.open(localfile)
+    return open(localfile, 'rb')
+
+# Upload fileglob to every inventory entry, up to args.parallel destinations at a time
+def mpfuFanOut(inventory, dirvar, filevar, fileglob):
+    progress.reset()
+    with statOnce(fileglob) as (fileglob, sizes):
+        inventory, skipped = preflight(inventory, 0 if args.delta else sum(sizes))
+        for entry in inventory:
+            progress.expect(entry.servvar if entry.protvar != "s3" else f"s3://{entry.remdirs[0]}",
+                            sum(sizes) * len(entry.remdirs))
+        if args.relay > 0:
+            return relayFanOut(inventory, dirvar, filevar, fileglob, skipped)
+        reads = None
+        if args.shared_read and args.parallel > 1 and not args.resume and not args.delta and not args.adaptive:
+            reads = sharedReads(list(zip(fileglob, sizes)))
+        return fanOut([(entry.protvar, entry.servvar, ",".join(entry.remdirs),
+                        functools.partial(mpfuSendEntry, entry, dirvar, filevar, fileglob, reads, set()))
+                       for entry in inventory], "Uploading to", skipped)
+
+# Remote half of --relay on a host that has the files. Reads a token, the TLS key and certificate of the run and the
+# paths to serve from the first line of stdin, prints the port it listens on and sends the files over TLS to every
+# client that sends the token and the indexes it wants, each file as its 8-byte size and data. The key is only
+# written to a private temporary file while it is loaded. Stops when stdin is closed.
+RELAY_SERVE_SCRIPT = '''
+import sys, os, json, socket, struct, threading, hmac, ssl, tempfile
+spec = json.loads(sys.stdin.readline())
+token, paths = spec['token'].encode(), spec['paths']
+ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+if hasattr(ssl, 'TLSVersion'):
+    ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+fd, pem = tempfile.mkstemp()
+try:
+    with os.fdopen(fd, 'w') as f:
+        f.write(spec['key'] + spec['cert'])
+    ctx.load_cert_chain(pem)
+finally:
+    os.remove(pem)
+srv = socket.socket()
+srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+srv.bind(('', int(sys.argv[1])))
+srv.listen(64)
+print(srv.getsockname()[1])
+sys.stdout.flush()
+def serve(conn):
+    try:
+        conn.settimeout(120)
+        conn = ctx.wrap_socket(conn, server_side=True)
+        r = conn.makefile('rb')
+        if not hmac.compare_digest(r.readline().strip(), token):
+            return
+        for index in json.loads(r.readline().decode()):
+            conn.sendall(struct.pack('>Q', os.path.getsize(paths[index])))
+            with open(paths[index], 'rb') as f:
+                while True:
+                    d = f.read(1048576)
+                    if not d:
+                        break
+                    conn.sendall(d)
+    except (IOError, OSError, ValueError):
+        pass
+    finally:
+        conn.close()
+def accept():
+    while True:
+        conn = srv.accept()[0]
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+threading.Thread(target=accept, daemon=True).start()
+sys.stdin.read()
+'''
+
+# Remote half of --relay on a host that pulls the files. Reads the relay token, the certificate of the run, the
+# files (index on the server, name and SHA-256) and the directories to write to from stdin. Only a server with
+# that certificate is trusted. Each file is written next to its final name and only moved into place if its
+# SHA-256 matches. Prints OK or BADSUM per file, and stops at the first bad one.
+RELAY_PULL_SCRIPT = '''
+import sys, os, json, socket, struct, hashlib, ssl
+spec = json.loads(sys.stdin.read())
+ctx = ssl.create_default_context(cadata=spec['cert'])
+conn = ctx.wrap_socket(socket.create_connection((sys.argv[1], int(sys.argv[2])), timeout=120),
+                       server_hostname='mpfu-relay')
+conn.sendall(spec['token'].encode() + b'\\n' + json.dumps([f[0] for f in spec['files']]).encode() + b'\\n')
+r = conn.makefile('rb')
+for d in spec['dirs']:
+    if d and not os.path.isdir(d):
+        os.makedirs(d)
+for index, name, want in spec['files']:
+    head = r.read(8)
+    left = struct.unpack('>Q', head)[0] if len(head) == 8 else -1
+    tmps = [os.path.join(d, name) + '.mpfu-relay' for d in spec['dirs']]
+    outs = [open(t, 'wb') for t in tmps]
+    h = hashlib.sha256()
+    while left > 0:
+        d = r.read(min(1048576, left))
+        if not d:
+            break
+        h.update(d)
+        left -= len(d)
+        for o in outs:
+            o.write(d)
+    for o in outs:
+        o.close()
+    if left or h.hexdigest() != want:
+        for t in tmps:
+            os.remove(t)
+        print('BADSUM')
+        break
+    for t in tmps:
+        os.replace(t, t[:-len('.mpfu-relay')])
+    print('OK')
+    sys.stdout.flush()
+'''
+
+# Key and self-signed certificate (both PEM) for the TLS of one --relay run. They only reach the relay hosts over
+# their SSH channels, and pulling hosts trust nothing but this certificate.
+def relayCertificate():
+    import datetime
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes as digests, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "mpfu-relay")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(hours=1)).not_valid_after(now + datetime.timedelta(days=7))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName("mpfu-relay")]), critical=False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+            .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(key.public_key()), critical=False)
+            .sign(key, digests.SHA256()))
+    return (cert.public_bytes(serialization.Encoding.PEM).decode(),
+            key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                              serialization.NoEncryption()).decode())
+
+# One SFTP/SCP destination in a --relay tree. A node without a parent gets the files from MPFU, the others pull
+# them from their parent's relay server. The first child to pull starts the server and the last one stops it.
+class relayNode(object):
+
+    def __init__(self, entry, parent, tls):
+        self.entry = entry
+        self.parent = parent
+        self.tls = tls
+        self.children = 0
+        self.done = threading.Event()
+        self.ok = False
+        self.pulled = False
+        self.asked = False
+        self.arrived = set()
+        self.lock = threading.Lock()
+        self.chan = None
+        self.pssh = None
+        self.error = None
+        self.port = None
+        self.token = os.urandom(16).hex()
+
+    # Start the relay server for fileglob (under the first remote path) if it isn't running. Returns its port.
+    def serve(self, fileglob):
+        with self.lock:
+            if self.error:
+                raise IOError(self.error)
+            if self.chan is None:
+                entry = self.entry
+                self.pssh = connpool.get(entry.servvar, entry.uservar, entry.passvar)
+                chan = self.pssh.get_transport().open_session()
+                chan.exec_command(f"python3 -c {shlex.quote(RELAY_SERVE_SCRIPT)} {args.relay_port}")
+                paths = [os.path.join(entry.remdirs[0], os.path.basename(g)).replace('\\', '/') for g in fileglob]
+                chan.sendall(json.dumps({'token': self.token, 'cert': self.tls[0], 'key': self.tls[1],
+                                        'paths': paths}).encode() + b"\n")
+                line = chan.makefile('rb').readline().strip()
+                if not line.isdigit():
+                    cmderr = chan.makefile_stderr('rb').read().decode(errors='replace').strip()
+                    chan.close()
+                    connpool.release(self.pssh)
+                    self.error = f"relay server on {entry.servvar} did not start: {cmderr or 'no python3?'}"
+                    raise IOError(self.error)
+                self.chan, self.port = chan, int(line)
+            return self.port
+
+    # A child is done with this node (pulled, fell back or failed)
+    def release(self):
+        with self.lock:
+            self.children -= 1
+            if self.children <= 0:
+                self.stop()
+
+    def stop(self):
+        if self.chan is not None:
+            self.chan.shutdown_write()
+            self.chan.close()
+            self.chan = None
+            connpool.release(self.pssh)
+
+# Upload to the SFTP/SCP entries of inventory through a --relay tree: the first args.relay of them get the
+# files from MPFU, and each node passes them to args.relay more. Other protocols are uploaded to directly.
+# Entries are started in tree order, so a node's parent is always running or done by the time it starts.
+def relayFanOut(inventory, dirvar, filevar, fileglob, skipped):
+    sums = {g: hashes.get(g)['sha256'] for g in fileglob}
+    hashes.save()
+    tls = relayCertificate()
+    nodes = []
+    tasklist = []
+    for entry in inventory:
+        if entry.protvar in ("sftp", "scp"):
+            parent = nodes[(len(nodes) - args.relay) // args.relay] if len(nodes) >= args.relay else None
+            node = relayNode(entry, parent, tls)
+            if parent:
+                parent.children += 1
+            nodes.append(node)
+            task = functools.partial(relaySendEntry, node, dirvar, filevar, fileglob, sums)
+            task.settle = node.done.set
+        else:
+            task = functools.partial(mpfuSendEntry, entry, dirvar, filevar, fileglob, None, set())
+        tasklist.append((entry.protvar, entry.servvar, ",".join(entry.remdirs), task))
+    try:
+        results = fanOut(tasklist, "Uploading to", skipped)
+    finally:
+        for node in nodes:
+            node.stop()
+    relayed = len([node for node in nodes if node.pulled])
+    print(f"Relay: {y_}{relayed}{_nc} destinations got the files from another host, "
+          f"{y_}{len(inventory) - relayed}{_nc} from here.\n")
+    return results
+
+# Upload to one node of a --relay tree: pull the files from its parent, then send whatever didn't arrive (or
+# everything, if the parent has no good copy or isn't done within --relay-wait) from here. A node with children
+# of its own has its copy checked against the local SHA-256 before they may pull from it. Retries of the node
+# only send from here. The node's done event is set by destTask when the attempt is over (the task's settle).
+def relaySendEntry(node, dirvar, filevar, fileglob, sums):
+    import paramiko
+    entry = node.entry
+    missing = [g for g in fileglob if any((remdir, g) not in node.arrived for remdir in entry.remdirs)]
+    if node.parent and not node.asked:
+        node.asked = True
+        try:
+            if not node.parent.done.wait(args.relay_wait):
+                progress.say(f"{y_}{node.parent.entry.servvar} is not done after {args.relay_wait:g}s{_nc}, "
+                             f"sending to {entry.servvar} from here.\n")
+            elif node.parent.ok:
+                missing = relayPull(node, fileglob, sums)
+        except (IOError, OSError, paramiko.ssh_exception.SSHException) as e:
+            progress.say(f"{y_}Relay to {entry.servvar} failed{_nc} ({e}), sending from here.\n")
+        finally:
+            node.parent.release()
+    node.pulled = node.pulled or len(missing) < len(fileglob)
+    ok = not missing or mpfuSendEntry(entry, dirvar, filevar, fileglob, None, node.arrived)
+    node.ok = ok
+    if ok and node.children and missing:
+        remotes = {g: os.path.join(entry.remdirs[0], os.path.basename(g)).replace('\\', '/') for g in fileglob}
+        with connpool.lease(entry.servvar, entry.uservar, entry.passvar) as pssh:
+            remotehashes = sshHashes(pssh.get_transport(), remotes)
+        if any(remotehashes.get(g) != sums[g] for g in fileglob):
+            progress.say(f"{y_}Copy on {entry.servvar} could not be verified{_nc}, "
+                         f"its relay hosts get the files from here.\n")
+            node.ok = False
+    return ok
+
+# Pull fileglob from node's parent into every remote path of node's entry. With --skip-identical, files the first
+# remote path already has are left out. Returns the files that did not arrive.
+def relayPull(node, fileglob, sums):
+    entry = node.entry
+    parent = node.parent
+    port = parent.serve(fileglob)
+    progress.start(entry.protvar, entry.servvar)
+    progress.say(f"Relaying to {b_}{entry.servvar}{_nc} from {b_}{parent.entry.servvar}{_nc}: \n")
+    with connpool.lease(entry.servvar, entry.uservar, entry.passvar) as pssh:
+        sendlist = list(fileglob)
+        if args.skip_identical and len(entry.remdirs) == 1:
+            sendlist = skipIdentical(sendlist, sshHashes(pssh.get_transport(), {g: os.path.join(
+                entry.remdirs[0], os.path.basename(g)).replace('\\', '/') for g in sendlist}))
+        if not sendlist:
+            return []
+        chan = pssh.get_transport().open_session()
+        chan.exec_command(f"python3 -c {shlex.quote(RELAY_PULL_SCRIPT)} {shlex.quote(parent.entry.servvar)} {port}")
+        chan.sendall(json.dumps({'token': parent.token, 'cert': node.tls[0], 'dirs': entry.remdirs,
+                                 'files': [[fileglob.index(g), os.path.basename(g), sums[g]] for g in sendlist]}).encode())
+        chan.shutdown_write()
+        cmdout = chan.makefile('rb')
+        missing = list(sendlist)
+        for g in sendlist:
+            fp = progress.begin(g)
+            if cmdout.readline().strip() != b"OK":
+                fp.fail()
+                break
+            fp.relayed()
+            node.arrived.update((remdir, g) for remdir in entry.remdirs)
+            missing.remove(g)
+        if missing:
+            cmderr = chan.makefile_stderr('rb').read().decode(errors='replace').strip()
+            progress.say(f"{y_}Relay to {entry.servvar} stopped{_nc} after {len(sendlist) - len(missing)} of "
+                         f"{len(sendlist)} files{': ' + cmderr.splitlines()[-1] if cmderr else ''}, sending the rest from here.\n")
+        chan.recv_exit_status()
+        chan.close()
+        return missing
+
+# DNS results of this run, so every host is looked up once: {hostname: address or the lookup error}
+dnscache = {}
+
+# Resolve servvar through dnscache. Raises socket.gaierror (again) if it can't be resolved.
+def resolveHost(servvar):
+    if servvar not in dnscache:
+        try:
+            dnscache[servvar] = socket.gethostbyname(servvar)
+        except socket.gaierror as e:
+            dnscache[servvar] = e
+    if isinstance(dnscache[servvar], Exception):
+        raise dnscache[servvar]
+    return dnscache[servvar]
+
+# Service port each serverlist protocol connects to
+def protocolPort(protvar):
+    return serviceports[{'ftp': 'ftp', 'sftp': 'ssh', 'scp': 'ssh', 'ssh': 'ssh', 'smb': 'smb'}[protvar]]
+
+# Kilobytes free on the filesystem holding remdir (or its nearest existing parent) on an SSH host,
+# or None if the host can't tell (no POSIX df, e.g. Windows)
+def remoteFreeKB(pssh, remdir):
+    import paramiko
+    try:
+        rc, cmdout, cmderr = sshExec(pssh, f"p={shlex.quote(remdir or '.')}; "
+                                           f"while [ ! -d \"$p\" ] && [ \"$p\" != / ] && [ \"$p\" != . ]; do p=$(dirname \"$p\"); done; "
+                                           f"df -Pk \"$p\" | tail -n 1", timeout=args.probe_timeout * 3)
+        return int(cmdout.split()[3]) if rc == 0 else None
+    except (paramiko.ssh_exception.SSHException, socket.timeout, IndexError, ValueError):
+        return None
+
+# Check an inventory before anything is sent. Every host is resolved and every (address, port) probed at the
+# same time, and then SSH destinations log in (the connection stays pooled for the upload) and check that the
+# remote paths (remdirs, or the entries' own) have nbytes free. Hosts that fail are reported and recorded
+# right away. Returns the healthy entries and a fan-out result row for each of the others. The entries' groups
+# are handed to the bandwidth shaper on the way, for --site-bwlimit.
+def preflight(inventory, nbytes=0, remdirs=None):
+    shaper.assign(inventory)
+    if args.no_preflight or not inventory:
+        return list(inventory), []
+    started = time.time()
+    reasons = [""] * len(inventory)
+    hosts = [n for n, entry in enumerate(inventory) if entry.protvar != "s3"]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, max(1, len(hosts)))) as pool:
+        def lookup(servvar):
+            try:
+                return resolveHost(servvar), ""
+            except (socket.gaierror, UnicodeError) as e:
+                return None, f"DNS lookup failed: {e}"
+        names = list(dict.fromkeys(inventory[n].servvar for n in hosts))
+        resolved = dict(zip(names, pool.map(lookup, names)))
+
+        def probe(target):
+            try:
+                socket.create_connection(target, timeout=args.probe_timeout).close()
+                return ""
+            except OSError as e:
+                return f"port {target[1]} unreachable: {e.strerror or e or 'timed out'}"
+        targets = list(dict.fromkeys((resolved[inventory[n].servvar][0], protocolPort(inventory[n].protvar))
+                                     for n in hosts if resolved[inventory[n].servvar][0]))
+        probed = dict(zip(targets, pool.map(probe, targets)))
+        for n in hosts:
+            ip, reason = resolved[inventory[n].servvar]
+            reasons[n] = reason or probed[(ip, protocolPort(inventory[n].protvar))]
+
+        def space(n):
+            entry = inventory[n]
+            try:
+                pssh = connpool.get(entry.servvar, entry.uservar, entry.passvar)
+            except Exception as e:
+                return f"SSH login failed: {e}"
+            try:
+                for remdir in remdirs or entry.remdirs:
+                    free = remoteFreeKB(pssh, remdir)
+                    if free is not None and free * 1024 < nbytes:
+                        return (f"only {round(free / 1024, 1)} MB free at {remdir or '~'}, "
+                                f"{round(nbytes / pow(2, 20), 1)} MB to send")
+                return ""
+            finally:
+                connpool.release(pssh)
+        sshhosts = [n for n in hosts if inventory[n].protvar in ("sftp", "scp") and not reasons[n]]
+        if nbytes:
+            for n, reason in zip(sshhosts, pool.map(space, sshhosts)):
+                reasons[n] = reason
+
+    healthy = [entry for entry, reason in zip(inventory, reasons) if not reason]
+    skipped = []
+    for entry, reason in zip(inventory, reasons):
+        if not reason:
+            continue
+        skipped.append({'prot': entry.protvar, 'host': entry.servvar, 'remote': ",".join(entry.remdirs),
+                        'ok': False, 'reason': reason, 'seconds': 0.0})
+        metrics.record("destination", entry.protvar, entry.servvar, "skipped", 0, 0,
+                       remote=",".join(entry.remdirs), files=0, reason=reason)
+    if skipped:
+        print(f"\nPreflight: {y_}{len(healthy)}{_nc} of {y_}{len(inventory)}{_nc} destinations ready "
+              f"({round(time.time() - started, 2)}s). Leaving out:")
+        for res in skipped:
+            print(f"  {b_}{res['host']}{_nc} over {y_}{res['prot'].upper()}{_nc}: {r_}{res['reason']}{_nc}")
+    return healthy, skipped
+
+# --adaptive tuning of a fan-out. Destination tasks take a slot before they start, in fan-out order, and every
+# --adapt-interval seconds the number of slots and the streams per host for destinations that start after it
+# are adjusted AIMD-style from the throughput, failures and connect times of the last interval: while throughput
+# keeps rising by 5% or more, one more destination (or, once that stops paying off, one more stream) is added;
+# a step that doesn't pay off is taken back and the other setting is tried. More than one failed transfer per ten
+# completed in the interval, or connections taking over three times as long as the quickest seen, halve both.
+class concurrencyController(object):
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.running = False
+        self.limit = 1
+        self.streams = 1
+        self.active = 0
+        self.next = 0
+
+    def begin(self, workers):
+        with self.cond:
+            self.running = bool(args.adaptive)
+            self.most = workers
+            self.limit = min(2, workers)
+            self.streams = 1
+            self.active = 0
+            self.next = 0
+            self.errors = set()
+            self.completed = 0
+            self.latencies = []
+            self.quickest = None
+            self.knob = "destinations"
+            self.stepped = False
+            self.lastrate = 0.0
+            self.lastsent = progress.sent()
+            self.laststamp = time.time()
+        if self.running:
+            threading.Thread(target=self.tuner, daemon=True).start()
+
+    def end(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    # Wait for a slot for the fan-out task numbered ticket. Tasks get slots in fan-out order (retries, which
+    # were started before, may go ahead), so a --relay node never holds a slot while its parent waits for one.
+    def acquire(self, ticket):
+        with self.cond:
+            while self.running and (ticket > self.next or self.active >= self.limit):
+                self.cond.wait(0.5)
+            self.next = max(self.next, ticket + 1)
+            self.active += 1
+            self.cond.notify_all()
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    # Count a failed transfer. Only network errors (transientError) say something about load; a refused login
+    # or a missing remote directory doesn't. The same error may be reported at several levels, so errors are
+    # kept by identity.
+    def error(self, e):
+        with self.cond:
+            if self.running and transientError(e):
+                self.errors.add(id(e))
+
+    # Count a completed transfer, which failures are weighed against
+    def transferred(self):
+        with self.cond:
+            if self.running:
+                self.completed += 1
+
+    def latency(self, seconds):
+        with self.cond:
+            if self.running:
+                self.latencies.append(seconds)
+                self.quickest = min(self.quickest or seconds, seconds)
+
+    def tuner(self):
+        while True:
+            time.sleep(args.adapt_interval)
+            with self.cond:
+                if not self.running:
+                    return
+                self.adjust()
+                self.cond.notify_all()
+
+    def adjust(self):
+        now = time.time()
+        sent = progress.sent()
+        rate = (sent - self.lastsent) / max(now - self.laststamp, 0.001)
+        self.lastsent, self.laststamp = sent, now
+        slow = [seconds for seconds in self.latencies if seconds > 3 * self.quickest and seconds > 0.05]
+        errors, completed = len(self.errors), self.completed
+        self.errors, self.completed, self.latencies = set(), 0, []
+        before = (self.limit, self.streams)
+        if errors * 10 > completed or slow:
+            why = f"{errors} failures in {errors + completed} transfers" if errors * 10 > completed else "slower connects"
+            self.limit = max(1, self.limit // 2)
+            self.streams = max(1, self.streams // 2)
+            self.stepped = False
+        elif self.active < self.limit:
+            # Not every slot is in use (the fan-out is ending), so throughput says nothing about the limit
+            self.lastrate = rate
+            return
+        elif rate >= self.lastrate * 1.05:
+            why = f"throughput {mbytes(rate)} MB/s"
+            if self.knob == "destinations" and self.limit >= self.most:
+                self.knob = "streams"
+            if self.knob == "streams" and self.streams >= args.max_streams:
+                self.knob = "destinations"
+            if self.knob == "destinations" and self.limit < self.most:
+                self.limit += 1
+                self.stepped = True
+            elif self.knob == "streams" and self.streams < args.max_streams:
+                self.streams += 1
+                self.stepped = True
+        else:
+            why = f"throughput {mbytes(rate)} MB/s, no gain"
+            if self.stepped:
+                if self.knob == "destinations":
+                    self.limit = max(1, self.limit - 1)
+                else:
+                    self.streams = max(1, self.streams - 1)
+            self.knob = "streams" if self.knob == "destinations" else "destinations"
+            self.stepped = False
+        self.lastrate = rate
+        if (self.limit, self.streams) != before:
+            progress.println(f"Adaptive: {y_}{self.limit}{_nc} destinations at a time, {y_}{self.streams}{_nc} "
+                             f"{'stream' if self.streams == 1 else 'streams'} per host ({why})")
+
+controller = concurrencyController()
+
+# Streams per host for a protocol setting (SFTP channels, FTP sessions, SMB connections, S3 objects): the
+# controller's current count during an --adaptive fan-out, else the setting itself
+def streamCount(configured):
+    return controller.streams if controller.running else configured
+
+# Run one task per destination, up to args.parallel at a time. tasklist holds (protocol, server, remote path,
+# task) tuples, where task returns True on success. Prints progress, then the per-host table, which also
+# lists the result rows of destinations skipped by preflight.
+def fanOut(tasklist, action, skipped=()):
+    workers = max(1, min(args.parallel, len(tasklist)))
+    if args.adaptive:
+        print(f"{action} {y_}{len(tasklist)}{_nc} destinations, up to {y_}{workers}{_nc} at a time (adaptive) =>\n")
+    else:
+        print(f"{action} {y_}{len(tasklist)}{_nc} destinations, {y_}{workers}{_nc} at a time =>\n")
+    results = []
+    started = time.time()
+    controller.begin(workers)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(fanOutWorker, *tasklist[ticket], ticket): (ticket, 0)
+                       for ticket in range(len(tasklist))}
+            # Destinations that failed with a network error wait here for their retry, (due time, ticket, attempt),
+            # without holding a worker, so the others keep going at full speed
+            waiting = []
+            while futures or waiting:
+                timeout = max(0, waiting[0][0] - time.time()) if waiting else None
+                if futures:
+                    finished, _ = concurrent.futures.wait(futures, timeout=timeout,
+                                                          return_when=concurrent.futures.FIRST_COMPLETED)
+                else:
+                    # Only retries are left, and wait() would return at once without futures
+                    finished = ()
+                    time.sleep(timeout)
+                for future in finished:
+                    ticket, attempt = futures.pop(future)
+                    res = future.result()
+                    delay = retryDelay(res, attempt)
+                    if delay is not None:
+                        heapq.heappush(waiting, (time.time() + delay, ticket, attempt + 1))
+                        progress.println(f"{y_}{res['host']}{_nc} over {y_}{res['prot'].upper()}{_nc}: {res['reason']}. "
+                                         f"Retry {attempt + 1} of {args.retries} in {round(delay, 1)}s")
+                        continue
+                    results.append(res)
+                    status = f"{g_}OK{_nc}" if res['ok'] else f"{r_}FAILED{_nc}"
+                    if not res['ok']:
+                        progress.abandon(res['host'])
+                    progress.println(f"[{len(results)}/{len(tasklist)}] {b_}{res['host']}{_nc} over "
+                                     f"{y_}{res['prot'].upper()}{_nc}: {status} ({round(res['seconds'], 2)}s)")
+                while waiting and waiting[0][0] <= time.time():
+                    due, ticket, attempt = heapq.heappop(waiting)
+                    futures[pool.submit(fanOutWorker, *tasklist[ticket], ticket, attempt)] = (ticket, attempt)
+    finally:
+        controller.end()
+    progress.finish()
+    results += skipped
+    fanOutSummary(results, time.time() - started)
+    metrics.flush()
+    return results
+
+# Print the per-host result table for a fan-out run
+def fanOutSummary(results, elapsed):
+    failed = [res for res in results if not res['ok']]
+    hostwidth = max([len(res['host']) for res in results] + [4])
+    print(f"\n{bld_}{'HOST'.ljust(hostwidth)}  PROTO  RESULT  TIME(s){_nc}")
+    for res in sorted(results, key=lambda res: (res['ok'], res['host'])):
+        status = f"{g_}OK    {_nc}" if res['ok'] else f"{r_}FAILED{_nc}"
+        line = f"{res['host'].ljust(hostwidth)}  {res['prot'].upper().ljust(5)}  {status}  {round(res['seconds'], 2)}"
+        if not res['ok']:
+            line += f"  {r_}{res['reason']}{_nc}"
+        print(line)
+    print(f"\nFinished {y_}{len(results) - len(failed)}{_nc} of {y_}{len(results)}{_nc} destinations "
+          f"in {y_}{round(elapsed, 2)}{_nc}s ({r_}{len(failed)}{_nc} failed).\n")
+
+
+# The SFTP, SMB and S3 entries of an inventory that pass preflight for uploading dirvar to remdirvar. With --sync
+# most files may already be there, so free space isn't checked. Returns them and the skipped rows.
+def dirPreflight(inventory, dirvar, remdirvar):
+    entries = [entry for entry in inventory if entry.protvar in ("sftp", "smb", "s3")]
+    nbytes = 0 if args.sync else sum(size for size, mtime in localTree(dirvar)[0].values())
+    return preflight(entries, nbytes, [remdirvar])
+
+# Upload the local directory dirvar (recursively) under remdirvar on one SFTP, SMB or S3 inventory entry
+def dirUploadEntry(entry, dirvar, remdirvar, term_width=80):
+    if entry.protvar == "s3":
+        return s3DirUpload(entry.remdirs[0], dirvar, remdirvar)
+    if entry.protvar == "smb":
+        return smbDirUpload(entry, dirvar, remdirvar)
+    with connpool.lease(entry.servvar, entry.uservar, entry.passvar) as pssh:
+        sftpDirUpload(pssh, pssh.open_sftp(), entry.servvar, entry.uservar, dirvar, remdirvar, term_width)
+    return True
+
+# Upload the local directory dirvar (recursively) to remdirvar over SFTP and print the summary line.
+# Returns the number of directories created and files sent.
+def sftpDirUpload(pssh, sftpc, servvar, uservar, dirvar, remdirvar, term_width):
+    progress.start("tar" if args.tar else "sftp", servvar)
+    base, parent = localRoot(dirvar)
+
+    if plat_type == 'Linux':
+        os.system('setterm -cursor off')
+    if not args.sync or args.tar:
+        progress.expect(servvar, sum(size for size, mtime in localTree(os.path.join(base, parent))[0].values()))
+    if args.tar:
+        dirnum, filenum = sshDirTar(pssh, base, parent, remdirvar, term_width)
+    elif args.sync:
+        dirnum, filenum, skipnum = sftpDirSync(pssh, sftpc, servvar, uservar, dirvar, base, parent, remdirvar,
+                                               term_width)
+    else:
+        dirnum, filenum = sftpDirPut(sftpc, base, parent, remdirvar, term_width)
+    if plat_type == 'Linux':
+        os.system('setterm -cursor on')
+    sftpc.close()
+    if not inWorker():
+        progress.finish()
+    summary = f"Finished transferring {y_}{dirnum}{_nc} directories and {y_}{filenum}{_nc} files."
+    if args.sync and not args.tar:
+        summary += f" {y_}{skipnum}{_nc} unchanged files skipped."
+    print(summary)
+    return dirnum, filenum
+
+# Show the remote directory being created in the progress line. Returns it shortened to fit the terminal.
+def remdirCreating(remdir_create, term_width):
+    pretty_remdir = (
+        remdir_create[:20] + "..." + remdir_create[-35:]) if len(remdir_create) > term_width - 15 else remdir_create
+    progress.note(f"creating {pretty_remdir}")
+    return pretty_remdir
+
+# Show the file being transferred in the progress line
+def fileTransferring(file, term_width):
+    progress.note(file)
+
+# Split the local directory dirvar into the absolute path of the directory holding it and its name, which
+# directory uploads recreate under the remote directory. Paths are kept absolute rather than changing into
+# the directory, since fan-out workers share the process's working directory.
+def localRoot(dirvar):
+    return os.path.split(os.path.abspath(dirvar.replace('\\', '/').rstrip("/")))
+
+# Send every directory and file under parent (in the local directory base) to remdirvar
+def sftpDirPut(sftpc, base, parent, remdirvar, term_width):
+    dirnum = 0
+    filenum = 0
+    for walker in os.walk(os.path.join(base, parent)):
+        reldir = os.path.relpath(walker[0], base)
+        remdir_create = os.path.normpath(os.path.join(
+            remdirvar, reldir)).replace('\\', '/')
+        try:
+            pretty_remdir = remdirCreating(remdir_create, term_width)
+            sftpc.mkdir(remdir_create)
+            dirnum += 1
+        except Exception as e:
+            progress.println(f"{r_}Can't create dir{_nc} {p_}{pretty_remdir}{_nc}{r_}; already exists or bad permissions{_nc}")
+            print("")
+
+        for file in walker[2]:
+            fileTransferring(file, term_width)
+            sftpPut(sftpc, os.path.normpath(os.path.join(walker[0], file)).replace(
+                '\\', '/'), os.path.join(remdirvar, reldir, file).replace('\\', '/'))
+            filenum += 1
+    return dirnum, filenum
+
+# File-like writer over an SSH channel, so tarfile can stream straight into it
+class channelWriter(object):
+
+    def __init__(self, chan):
+        self.chan = chan
+
+    def write(self, data):
+        shaper.take(len(data))
+        self.chan.sendall(data)
+        return len(data)
+
+# Stream parent (in the local directory base) to remdirvar as a tar archive piped into 'tar -x' on the server.
+# Produces the same remote layout as sftpDirPut. Returns the number of directories and files sent.
+def sshDirTar(pssh, base, parent, remdirvar, term_width):
+    import tarfile
+
+    remroot = remdirvar.replace('\\', '/') or "."
+    untar = "tar -xzf -" if args.tar == "gz" else "tar -xf -"
+    chan = pssh.get_transport().open_session()
+    chan.exec_command(f"mkdir -p {shlex.quote(remroot)} && cd {shlex.quote(remroot)} && {untar}")
+
+    dirnum = 0
+    filenum = 0
+    with tarfile.open(fileobj=channelWriter(chan), mode='w|gz' if args.tar == "gz" else 'w|',
+                      bufsize=256 * 1024) as tar:
+        for walker in os.walk(os.path.join(base, parent)):
+            reldir = os.path.relpath(walker[0], base)
+            remdirCreating(os.path.normpath(os.path.join(remdirvar, reldir)).replace('\\', '/'), term_width)
+            tar.add(walker[0], arcname=reldir.replace('\\', '/'), recursive=False)
+            dirnum += 1
+            for file in walker[2]:
+                fileTransferring(file, term_width)
+                tarpath = os.path.join(walker[0], file)
+                with progress.begin(tarpath):
+                    tar.add(tarpath, arcname=os.path.join(reldir, file).replace('\\', '/'), recursive=False)
+                filenum += 1
+    chan.shutdown_write()
+    cmderr = chan.makefile_stderr('rb').read().decode(errors='replace')
+    rc = chan.recv_exit_status()
+    chan.close()
+    if rc != 0:
+        raise IOError(f"remote tar exited with {rc}: {cmderr.strip()}")
+    return dirnum, filenum
+
+# Location of the sync manifest for one local tree and destination
+def manifestPath(servvar, uservar, dirvar, remdirvar):
+    destkey = f"{uservar}@{servvar}:{remdirvar}|{os.path.abspath(dirvar)}"
+    return os.path.join(homepath, 'manifests', hashlib.sha256(destkey.encode()).hexdigest()[:32] + '.json')
+
+# Local tree under parent as ({path relative to parent: [size, mtime]}, [relative dirs, parents first])
+def localTree(parent):
+    files = {}
+    dirs = []
+    for root, dirnames, filenames in os.walk(parent):
+        rel = os.path.relpath(root, parent).replace('\\', '/')
+        rel = "" if rel == "." else rel
+        dirs.append(rel)
+        for file in filenames:
+            fstat = os.stat(os.path.join(root, file))
+            files[rel + '/' + file if rel else file] = [fstat.st_size, int(fstat.st_mtime)]
+    return files, dirs
+
+# Remote tree under remroot in the same shape as localTree, from a single find over SSH.
+# Returns None if the server can't run find -printf, e.g. SFTP-only or non-GNU hosts.
+def remoteTree(pssh, remroot):
+    import paramiko
+    try:
+        rc, cmdout, cmderr = sshExec(pssh, f"cd {shlex.quote(remroot)} 2>/dev/null || exit 0; "
+                                           f"find . -mindepth 1 -printf '%y\\t%s\\t%T@\\t%P\\n'")
+    except paramiko.ssh_exception.SSHException:
+        return None
+    if rc != 0:
+        return None
+    files = {}
+    dirs = set([""]) if cmdout else set()
+    for line in cmdout.split("\n"):
+        elem = line.split("\t", 3)
+        if len(elem) != 4:
+            continue
+        if elem[0] == 'd':
+            dirs.add(elem[3])
+        elif elem[0] == 'f':
+            files[elem[3]] = [int(elem[1]), int(float(elem[2]))]
+    return files, dirs
+
+# Fallback for remoteTree that lists each remote directory over SFTP (one round trip per directory)
+def remoteTreeSftp(sftpc, remroot):
+    files = {}
+    dirs = set()
+    pending = [""]
+    while pending:
+        rel = pending.pop()
+        try:
+            entries = sftpc.listdir_attr(remroot + '/' + rel if rel else remroot)
+        except IOError:
+            continue
+        dirs.add(rel)
+        for attr in entries:
+            relpath = rel + '/' + attr.filename if rel else attr.filename
+            if stat.S_ISDIR(attr.st_mode):
+                pending.append(relpath)
+            else:
+                files[relpath] = [attr.st_size, int(attr.st_mtime)]
+    return files, dirs
+
+# Send only new or changed files under parent to remdirvar. Sent files get the local mtime so the next
+# run sees them as unchanged. Returns the number of directories created, files sent and files skipped.
+def sftpDirSync(pssh, sftpc, servvar, uservar, dirvar, base, parent, remdirvar, term_width):
+    remroot = os.path.normpath(os.path.join(remdirvar, parent)).replace('\\', '/')
+    localfiles, localdirs = localTree(os.path.join(base, parent))
+
+    manifest = manifestPath(servvar, uservar, dirvar, remdirvar)
+    try:
+        with open(manifest) as mf:
+            if json.load(mf) == localfiles:
+                print(f"{g_}Up to date{_nc}: nothing changed locally since the last sync to {b_}{servvar}{_nc}:{p_}{remroot}{_nc}")
+                return 0, 0, len(localfiles)
+    except (IOError, ValueError):
+        pass
+
+    remote = remoteTree(pssh, remroot)
+    if remote is None:
+        remote = remoteTreeSftp(sftpc, remroot)
+    remfiles, remdirs = remote
+
+    dirnum = 0
+    filenum = 0
+    for rel in localdirs:
+        if rel in remdirs:
+            continue
+        remdir_create = remroot + '/' + rel if rel else remroot
+        try:
+            pretty_remdir = remdirCreating(remdir_create, term_width)
+            sftpc.mkdir(remdir_create)
+            dirnum += 1
+        except Exception as e:
+            progress.println(f"{r_}Can't create dir{_nc} {p_}{pretty_remdir}{_nc}{r_}; already exists or bad permissions{_nc}")
+            print("")
+
+    progress.expect(servvar, sum(size for rel, (size, mtime) in localfiles.items() if remfiles.get(rel) != [size, mtime]))
+    for rel, (size, mtime) in localfiles.items():
+        if remfiles.get(rel) == [size, mtime]:
+            continue
+        fileTransferring(os.path.basename(rel), term_width)
+        sftpPut(sftpc, os.path.join(base, parent, rel).replace('\\', '/'), remroot + '/' + rel)
+        sftpc.utime(remroot + '/' + rel, (mtime, mtime))
+        filenum += 1
+
+    os.makedirs(os.path.dirname(manifest), exist_ok=True)
+    with open(manifest, 'w') as mf:
+        json.dump(localfiles, mf)
+    return dirnum, filenum, len(localfiles) - filenum
+
+
+# Upload the local directory dirvar (recursively) to an S3 bucket under remdirvar, keeping the same layout as
+# the SFTP directory upload. One paginated listing of the prefix decides which objects already match, and the
+# rest are uploaded concurrently.
+def s3DirUpload(bucketvar, dirvar, remdirvar):
+    import boto3
+    from botocore.exceptions import NoCredentialsError, ClientError
+
+    bucket, _, bucketprefix = bucketvar.partition('/')
+    base, parent = localRoot(dirvar)
+    keyroot = "/".join(p for p in (bucketprefix.strip('/'), remdirvar.strip('/'), parent) if p)
+    print(f"\nStarting directory transfer to {y_}s3://{_nc}{p_}{bucket}/{keyroot}{_nc}: ")
+    progress.start("s3", f"s3://{bucketvar}")
+
+    try:
+        s3 = boto3.client('s3')
+        localfiles, localdirs = localTree(os.path.join(base, parent))
+        remote = {}
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=keyroot + '/'):
+            for obj in page.get('Contents', []):
+                remote[obj['Key']] = (obj['Size'], obj['ETag'])
+
+        keys = {os.path.join(base, parent, rel): keyroot + '/' + rel for rel in localfiles}
+        remotehashes = s3Hashes(s3, bucket, keys, remote)
+        pairs = [(localfile, objkey) for localfile, objkey in keys.items()
+                 if remotehashes.get(localfile) != hashes.get(localfile)['sha256']]
+        extra = {objkey: s3Metadata(localfile) for localfile, objkey in pairs}
+        hashes.save()
+
+        if pairs:
+            s3Engine(s3, pairs, bucket, extra=extra, objects=max(args.s3_objects, 8))
+            progress.flush()
+            print("")
+        print(f"Finished transferring {y_}{len(pairs)}{_nc} files. "
+              f"{y_}{len(localfiles) - len(pairs)}{_nc} unchanged files skipped.")
+        return True
+    except NoCredentialsError:
+        print(f"""
+{r_}<ERROR>
+Could not determine valid credentials for AWS. Install and configure {y_}awscli{_nc}{r_} and try again.{_nc}\n""")
+    except ClientError as e:
+        print(f"""
+{r_}<ERROR>
+The server raised an exception: {e} {_nc}\n""")
+    errPause()
+    return False
 
 
 def mpfuDirUpload():
+    import paramiko
     # If serverlist file NOT supplied as CLI argument
     if not args.list:
         print(f"""
@@ -895,28 +3954,11 @@ If you wish to upload to multiple machines, provide a serverlist when running {b
         print(f"\nCurrently only {y_}SFTP{_nc} (and therefore Linux systems) are supported for this function.\n")
         servvar = servPrompt()
         uservar = input("\nUsername: ")
-        passvar = ""
-        
-        term_width, term_height = os.get_terminal_size()
-        try:
-            pssh = paramiko.SSHClient()
-            pssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            pssh.connect(hostname=servvar, username=uservar,
-                         timeout=8)
-            sftpc = pssh.open_sftp()
 
-        except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
-            print(
-               f"\n{y_}No SSH key matching this host to authenticate with.{_nc}\n\nEnter password for {y_}{uservar}{_nc}: ", end=" ")
-            passvar = getpass.getpass('')
+        term_width, term_height = os.get_terminal_size()
+        pssh, passvar = sshLogin(servvar, uservar)
+        sftpc = pssh.open_sftp()
 
-            pssh = paramiko.SSHClient()
-            pssh.load_system_host_keys()
-            pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-            pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                        timeout=8)
-            sftpc = pssh.open_sftp()
-        
         remdirvar = input(
             "\nRemote directory on server to upload local directory (if nonexistent, it will be created): ")
         readline.set_completer(t.pathCompleter)
@@ -925,43 +3967,7 @@ If you wish to upload to multiple machines, provide a serverlist when running {b
         protvar = "SFTP"
 
         try:
-            dirvar = dirvar.replace('\\', '/').rstrip("/")
-            os.chdir(os.path.split(dirvar)[0])
-            parent = os.path.split(dirvar)[1]
-            dirnum = 0
-            filenum = 0
-
-            if plat_type == 'Linux':
-                os.system('setterm -cursor off')
-            for walker in os.walk(parent):
-                try:
-                    remdir_create = os.path.normpath(os.path.join(
-                        remdirvar, walker[0])).replace('\\', '/')
-                    pretty_remdir = (
-                        remdir_create[:20] + "..." + remdir_create[-35:]) if len(remdir_create) > term_width - 15 else remdir_create
-                    remdir_creation = f"Creating {p_}{pretty_remdir}{_nc}=>"
-                    print(remdir_creation + " "
-                          * (term_width - len(remdir_creation) - 1))
-                    sftpc.mkdir(os.path.normpath(os.path.join(
-                        remdirvar, walker[0])).replace('\\', '/'))
-                    dirnum += 1
-                except Exception as e:
-                    print(f"{r_}Can't create dir{_nc} {p_}{pretty_remdir}{_nc}{r_}; already exists or bad permissions{_nc}")
-                    print("")
-
-                for file in walker[2]:
-                    print(f"Transferring: {g_}{file}{_nc}", end="\r")
-                    transferprog = f"Transferring: {g_}{file}{_nc}"
-                    print(transferprog + " " * (term_width
-                                                - len(transferprog) - 1), end="\r")
-                    sftpc.put(os.path.normpath(os.path.join(walker[0], file)).replace(
-                        '\\', '/'), os.path.join(remdirvar, walker[0], file).replace('\\', '/'))
-                    filenum += 1
-
-            if plat_type == 'Linux':
-                os.system('setterm -cursor on')
-            sftpc.close()
-            print(f"Finished transferring {y_}{dirnum}{_nc} directories and {y_}{filenum}{_nc} files.")
+            sftpDirUpload(pssh, sftpc, servvar, uservar, dirvar, remdirvar, term_width)
 
         except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.BadAuthenticationType):
             print(f"""
@@ -977,12 +3983,15 @@ If you wish to upload to multiple machines, provide a serverlist when running {b
             input("Press a key to continue...")
             print(" ")
             return
+        finally:
+            connpool.release(pssh)
 
     elif args.list:
         print(
             f"""
-Currently only {y_}SFTP{_nc} (and therefore Linux systems) are supported for this function. Other protocols and
-systems from the list will be ignored.""")
+Currently only {y_}SFTP{_nc} (and therefore Linux systems), {y_}SMB{_nc} shares and {y_}S3{_nc} buckets are supported for this function.
+Other protocols and systems from the list will be ignored. S3 entries may include a key prefix ({g_}s3{_nc}:{p_}bucketname/prefix{_nc}).
+For SMB and S3 entries the remote directory is relative to the share path or prefix in the list.""")
         
         remdirvar = input(
             "\nRemote directory on servers to upload local directory (if nonexistent, it will be created): ")
@@ -991,113 +4000,20 @@ systems from the list will be ignored.""")
         print(" ")
         term_width, term_height = os.get_terminal_size()
 
-        with open(args.list, 'r') as serv_file:
-            ufile_input = serv_file.read()
-            sfile_input = ufile_input.strip()
-
-            # Loop through input list and parse into variables
-            split_input = sfile_input.split("\n")
-            for e in range(len(split_input)):
-                pop_input = split_input.pop()
-                elem = pop_input.split(":")
-                protvar = elem[0]
-                if protvar == "sftp":
-                    servvar = elem[1].strip()
-                    uservar = elem[3].strip()
-                    passvar = elem[4].strip()
-                else:
-                    continue
-                try:
-                    pssh = paramiko.SSHClient()
-                    pssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    pssh.connect(hostname=servvar, username=uservar,
-                                timeout=8)
-                    sftpc = pssh.open_sftp()
-                except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
-                    print(
-                        f"\n{r_}No SSH key matching this host to authenticate with.{_nc}\n")
-                    print(f"Enter password for {y_}{uservar}{_nc}: ")
-
-                    passvar = getpass.getpass('')
-
-                    pssh = paramiko.SSHClient()
-                    pssh.load_system_host_keys()
-                    pssh.set_missing_host_key_policy(paramiko.WarningPolicy())
-                    pssh.connect(hostname=servvar, username=uservar, password=passvar,
-                                timeout=8)
-                    sftpc = pssh.open_sftp()
-                try:
-                    print(f"\nStarting directory transfer to {b_}{servvar}{_nc}: ")
-                    pssh = paramiko.SSHClient()
-                    pssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                    pssh.connect(hostname=servvar, username=uservar,
-                                 password=passvar, timeout=8)
-                    sftpc = pssh.open_sftp()
-
-                    dirvar = dirvar.replace('\\', '/').rstrip("/")
-                    os.chdir(os.path.split(dirvar)[0])
-                    parent = os.path.split(dirvar)[1]
-                    dirnum = 0
-                    filenum = 0
-
-                    if plat_type == 'Linux':
-                        os.system('setterm -cursor off')
-                    for walker in os.walk(parent):
-                        try:
-                            remdir_create = os.path.normpath(os.path.join(
-                                remdirvar, walker[0])).replace('\\', '/')
-                            pretty_remdir = (
-                                remdir_create[:20] + "..." + remdir_create[-35:]) if len(remdir_create) > term_width - 15 else remdir_create
-                            remdir_creation = f"Creating {p_}{pretty_remdir}{_nc}=>"
-                            print(remdir_creation + " "
-                                  * (term_width - len(remdir_creation) - 1))
-                            sftpc.mkdir(os.path.normpath(os.path.join(
-                                remdirvar, walker[0])).replace('\\', '/'))
-                            dirnum += 1
-                        except Exception as e:
-                            print(f"{r_}Can't create dir{_nc} {p_}{pretty_remdir}{_nc}{r_}; already exists or bad permissions{_nc}")
-                            print("")
-
-                        for file in walker[2]:
-                            print(f"Transferring: {g_}{file}{_nc}", end="\r")
-                            transferprog = f"Transferring: {g_}{file}{_nc}"
-                            print(transferprog + " " * (term_width
-                                                        - len(transferprog) - 1), end="\r")
-                            sftpc.put(os.path.normpath(os.path.join(walker[0], file)).replace(
-                                '\\', '/'), os.path.join(remdirvar, walker[0], file).replace('\\', '/'))
-                            filenum += 1
-                    if plat_type == 'Linux':
-                        os.system('setterm -cursor on')
-                    sftpc.close()
-                    print(f"Finished transferring {y_}{dirnum}{_nc} directories and {y_}{filenum}{_nc} files.")
-
-                except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.BadAuthenticationType):
-                    print(f"""
-{r_}<ERROR>
-Username, password, or SSH key are incorrect, or the server is not accepting the type of authentication attempted{_nc}.\n""")
-                    input("Press a key to continue...")
-                    print(" ")
-                    return
-                except (BlockingIOError, socket.timeout):
-                    print(f"""
-{r_}<ERROR>
-Server is offline, unavailable, or otherwise not responding. Check the hostname or IP and try again.{_nc}\n""")
-                    input("Press a key to continue...")
-                    print(" ")
-                    return
-                except (Exception, IOError) as e:
-                    print(f"""
-{r_}<ERROR>
-The server raised an exception: {e} {_nc}\n""")
-                    input("Press a key to continue...")
-                    print(" ")
-                    return
+        # A host that fails is reported (destTask prints the error) and the rest carry on
+        entries, skipped = dirPreflight(loadInventory(), dirvar, remdirvar)
+        results = []
+        started = time.time()
+        for entry in entries:
+            if entry.protvar == "sftp":
+                print(f"\nStarting directory transfer to {b_}{entry.servvar}{_nc}: ")
+            results.append(destTaskRetrying(entry.protvar, entry.servvar, ",".join(entry.remdirs),
+                                            functools.partial(dirUploadEntry, entry, dirvar, remdirvar, term_width)))
+        fanOutSummary(results + skipped, time.time() - started)
+        metrics.flush()
 
 
 def mpfuSSH():
-    import fabric
-    import fabric.exceptions
-
     # Load in previous connections for tab completion
     _, lastserv_f = lastServ()
     t.createListCompleter(lastserv_f)
@@ -1120,44 +4036,17 @@ If you wish to issue commands to multiple machines, provide a serverlist when ru
                 login_prompt = f"\nEnter user and server for command ({y_}username@server.address.net{_nc}): "
                 ssh_prompt = input(login_prompt).strip()
                 uservar, servvar = ssh_prompt.split('@')[0], ssh_prompt.split('@')[1]
-                conn = fabric.Connection(servvar, user=uservar)
 
                 with open(os.path.join(homepath, 'sav.mpfu'), 'a') as lastserv_u:
                     lastserv_u.write('\n' + servvar)
 
                 try:
-                    conn.open()
-                except (paramiko.ssh_exception.AuthenticationException, paramiko.ssh_exception.SSHException):
-                    print(
-                        f"\n{y_}No SSH key matching this host to authenticate with.{_nc}\n\nEnter password for {y_}{uservar}{_nc}: ", end=" ")
-                    passvar = getpass.getpass('')
-
-                    passauth_conn = fabric.Connection(servvar, user=uservar, connect_kwargs={
-                                                  "password": passvar})
-
-                    passauth_conn.open()
-
-                    passauthloop = 1
-                    while passauthloop == 1:
-                        print(f"\nConnecting to {b_}{servvar}{_nc} =>", end="")
-                        cmdvar = input(
-                            "\nEnter command to run on server (Ctrl-D to return to menu): ")
-                        print(" ")
-                        cmdresult = passauth_conn.run(cmdvar)
-
-                        # Create list of cmd output lines, append them to buffer each cmd, and deduplicate
-                        outputlist = [c for c in cmdresult.stdout.split("\n")]
-                        bufferlist.extend(outputlist)
-                        bufferset = set(bufferlist)
-
-                        t.createListCompleter(bufferset)
-                        readline.set_completer(t.listCompleter)
-
-                        print(" ")
+                    pssh, passvar = sshLogin(servvar, uservar)
                 except socket.gaierror as e:
                     print(f"{r_}The command returned an error{_nc}: {e}")
                     continue
-
+                # Commands take their own lease (sshCommand), this one was only for logging in
+                connpool.release(pssh)
 
                 cmdloop = 1
                 while cmdloop == 1:
@@ -1166,10 +4055,12 @@ If you wish to issue commands to multiple machines, provide a serverlist when ru
                         cmdvar = input(
                             "\nEnter command to run on server (Ctrl-D to return to menu): ")
                         print(" ")
-                        cmdresult = conn.run(cmdvar)
+                        rc, cmdout, cmderr = sshCommand(servvar, uservar, passvar, cmdvar, echo=True)
+                        if rc != 0:
+                            print(f"{r_}The command returned an error{_nc}: exit code {rc}\n")
 
                         # Create list of cmd output lines, append them to buffer each cmd, and deduplicate
-                        outputlist = [c for c in cmdresult.stdout]
+                        outputlist = [c for c in cmdout.split("\n")]
                         bufferlist.extend(outputlist)
                         bufferset = set(bufferlist)
 
@@ -1186,38 +4077,119 @@ If you wish to issue commands to multiple machines, provide a serverlist when ru
     elif args.list:
         cmdvar = input(
             "\nEnter command to run on servers in list (Ctrl-D to return to menu): ")
-        with open(args.list, 'r') as serv_file:
-            ufile_input = serv_file.read()
-            sfile_input = ufile_input.strip()
-
-            # Loop through input list and parse into variables
-            split_input = sfile_input.split("\n")
-            for e in range(len(split_input)):
-                pop_input = split_input.pop()
-                elem = pop_input.split(":")
-                protvar = elem[0].strip()
-                if protvar != "s3":
-                    servvar = elem[1].strip()
-                    remdirvar = elem[2].strip()
-                    uservar = elem[3].strip()
-                    passvar = elem[4].strip()
-                if protvar == "s3":
-                    continue
-                try:
-                    print(f"\nConnecting to {b_}{servvar}{_nc} =>")
-                    print(" ")
-                    cmdresult = fabric.Connection(servvar, user=uservar, connect_kwargs={
-                                                  "password": passvar}).run(cmdvar)
-                    print(" ")
-                    input("Press a key to continue (Ctrl-D to return to menu)...")
-                except EOFError:
-                    break
-                except Exception as e:
-                    print(f"{r_}The command returned an error{_nc}: {e}\n")
-                    try:
-                        input("Press a key to continue (Ctrl-D to return to menu)...")
-                    except EOFError:
-                        break
+        hostlist, skipped = commandPreflight(loadInventory())
+
+        # Run on every host at once (bounded by --parallel) without waiting for keypresses
+        if args.parallel > 1:
+            mpfuSSHParallel(hostlist, cmdvar, skipped)
+            return
+
+        # Hosts that can't be reached are noted and skipped without waiting for a keypress, and listed at the end
+        failed = [(res['host'], res['reason']) for res in skipped]
+        for servvar, uservar, passvar in hostlist:
+            try:
+                print(f"\nConnecting to {b_}{servvar}{_nc} =>")
+                print(" ")
+                commandConnection(servvar, uservar, passvar)
+                rc, cmdout, cmderr = sshCommand(servvar, uservar, passvar, cmdvar, echo=True,
+                                                timeout=args.cmd_timeout)
+                if rc != 0:
+                    print(f"{r_}The command returned an error{_nc}: exit code {rc}\n")
+                print(" ")
+                input("Press a key to continue (Ctrl-D to return to menu)...")
+            except EOFError:
+                break
+            except Exception as e:
+                print(f"{r_}The command returned an error{_nc}: {e}\n")
+                failed.append((servvar, str(e)))
+        if failed:
+            print(f"\n{r_}Command failed to run on {len(failed)} hosts{_nc}:")
+            for servvar, reason in failed:
+                print(f"  {b_}{servvar}{_nc}: {r_}{reason}{_nc}")
+            print(" ")
+
+# The (server, user, password) logins of an inventory that commands can be run on, each host once
+def inventoryHosts(inventory):
+    return list(dict.fromkeys((entry.servvar, entry.uservar, entry.passvar)
+                              for entry in inventory if entry.protvar != "s3"))
+
+# Preflight for SSH commands: every host with a login is checked on the SSH port. Returns the hosts to run
+# on (as inventoryHosts) and a mpfuSSHParallel result row for each host left out.
+def commandPreflight(inventory):
+    entries, skipped = preflight([entry._replace(protvar="ssh") for entry in inventory if entry.protvar != "s3"])
+    rows = {res['host']: {'host': res['host'], 'rc': None, 'stdout': "", 'stderr': "", 'reason': res['reason'],
+                          'seconds': 0.0} for res in skipped}
+    return inventoryHosts(entries), list(rows.values())
+
+# Open the pooled SSH connection to a serverlist host for running a command. Commands themselves are never run
+# twice, but network errors while connecting are retried like destinations (retryDelay), and a host whose circuit
+# breaker is open fails right away.
+def commandConnection(servvar, uservar, passvar):
+    for attempt in itertools.count():
+        breakers.check(servvar)
+        try:
+            connpool.release(connpool.get(servvar, uservar, passvar))
+        except Exception as e:
+            if not transientError(e):
+                raise
+            breakers.failure(servvar)
+            delay = retryDelay({'ok': False, 'transient': True, 'host': servvar}, attempt)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        breakers.success(servvar)
+        return
+
+# Runs cmdvar on one host for mpfuSSHParallel and returns its result row
+def sshParallelWorker(servvar, uservar, passvar, cmdvar):
+    started = time.time()
+    try:
+        commandConnection(servvar, uservar, passvar)
+        rc, cmdout, cmderr = sshCommand(servvar, uservar, passvar, cmdvar, timeout=args.cmd_timeout)
+        reason = ""
+    except socket.timeout as e:
+        rc, cmdout, cmderr, reason = None, "", "", str(e) or "timed out"
+    except Exception as e:
+        rc, cmdout, cmderr, reason = None, "", "", str(e)
+    return {'host': servvar, 'rc': rc, 'stdout': cmdout, 'stderr': cmderr,
+            'reason': reason, 'seconds': time.time() - started}
+
+# Run cmdvar on every host in hostlist, up to args.parallel hosts at a time. Output of each host is printed
+# as it finishes, followed by a table of exit codes that also lists the rows of hosts skipped by preflight.
+def mpfuSSHParallel(hostlist, cmdvar, skipped=()):
+    workers = max(1, min(args.parallel, len(hostlist)))
+    print(f"\nRunning command on {y_}{len(hostlist)}{_nc} hosts, {y_}{workers}{_nc} at a time =>")
+    results = []
+    started = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(sshParallelWorker, servvar, uservar, passvar, cmdvar)
+                   for servvar, uservar, passvar in hostlist]
+        for future in concurrent.futures.as_completed(futures):
+            res = future.result()
+            results.append(res)
+            status = f"{g_}exit 0{_nc}" if res['rc'] == 0 else f"{r_}exit {res['rc']}{_nc}" if res['rc'] is not None \
+                else f"{r_}{res['reason']}{_nc}"
+            print(f"\n[{len(results)}/{len(hostlist)}] {b_}{res['host']}{_nc}: {status} ({round(res['seconds'], 2)}s)")
+            if res['stdout']:
+                print(res['stdout'].rstrip("\n"))
+            if res['stderr']:
+                print(f"{r_}{res['stderr'].rstrip()}{_nc}")
+
+    results += skipped
+    hostwidth = max([len(res['host']) for res in results] + [4])
+    print(f"\n{bld_}{'HOST'.ljust(hostwidth)}  EXIT  TIME(s)  DETAIL{_nc}")
+    for res in sorted(results, key=lambda res: (res['rc'] == 0, res['host'])):
+        exitcode = "-" if res['rc'] is None else str(res['rc'])
+        color = g_ if res['rc'] == 0 else r_
+        detail = res['reason'] or (res['stderr'].strip().split("\n")[-1] if res['rc'] != 0 and res['stderr'] else "")
+        print(f"{res['host'].ljust(hostwidth)}  {color}{exitcode.ljust(4)}{_nc}  {str(round(res['seconds'], 2)).ljust(7)}  {detail}")
+    failed = len([res for res in results if res['rc'] != 0])
+    print(f"\nCommand succeeded on {y_}{len(results) - failed}{_nc} of {y_}{len(results)}{_nc} hosts "
+          f"in {y_}{round(time.time() - started, 2)}{_nc}s ({r_}{failed}{_nc} failed).\n")
+    metrics.flush()
+    return results
+
 # MPFU menu function
 def mpfuMenu():
 
@@ -1239,7 +4211,7 @@ def mpfuMenu():
  1) Upload local files to {y_}one{_nc} destination (server, share, bucket, etc.)
  2) Upload local files to {y_}multiple{_nc} destinations from manual INPUT
  3) Upload local files to {y_}multiple{_nc} destinations from a {y_}list{_nc} entered at CLI (mpfu -l serverlist.txt)
- 4) Upload a {y_}directory{_nc} recursively (all subdirectories and files) to one or more destinations (SFTP only)\n
+ 4) Upload a {y_}directory{_nc} recursively (all subdirectories and files) to one or more destinations (SFTP, SMB and S3 only)\n
 
  {bld_}|Control|{_nc}
 
@@ -1263,17 +4235,98 @@ def mpfuMenu():
         mpfuSSH()
     elif choicevar == "q" or choicevar == "Q":
         print("\n")
+        connpool.closeAll()
         sys.exit()
     else:
         print(f"\n{r_}Not an option!{_nc}")
-metaloop = 1
-while metaloop == 1:
+
+# Library API. Destinations are serverlist-format lines ("sftp:host:/remote/path/:user:password",
+# "s3:bucketname"); if none are given, the -l serverlist is used (restricted to --group).
+# Calls run unattended (no prompts or progress bars) and return one result row per host. options are
+# command line options by their long name (as in a job spec) and only apply to that call.
+
+# Run one library call unattended, with options set on args for its length only
+@contextlib.contextmanager
+def libraryCall(options=None):
+    global batchmode
+    saved, savedargs = batchmode, vars(args).copy()
+    batchmode = True
+    for option, value in (options or {}).items():
+        setattr(args, option.replace('-', '_'), value)
     try:
-        menuloop = 1
-        while menuloop == 1:
-            try:
-                mpfuMenu()
-            except EOFError:
-                pass
-    except Exception as e:
-        print(f"{r_}An exception occurred: {e}{_nc}")
+        yield
+    finally:
+        batchmode = saved
+        vars(args).clear()
+        vars(args).update(savedargs)
+
+# Compile destinations into inventory entries
+def destEntries(destinations):
+    return compileServerlist(destinations) if destinations else loadInventory()
+
+# Upload files (paths or wildcards) to every destination
+def uploadFiles(destinations, files, options=None):
+    with libraryCall(options):
+        fileglob = sorted(set(itertools.chain.from_iterable(
+            glob.glob(os.path.abspath(os.path.expanduser(f))) for f in files)))
+        dirvar = os.path.dirname(fileglob[0]) if fileglob else ""
+        return mpfuFanOut(destEntries(destinations), dirvar, "", fileglob)
+
+# Upload a local directory recursively to every SFTP, SMB and S3 destination, under remote_dir
+def uploadDirectory(destinations, directory, remote_dir, options=None):
+    with libraryCall(options):
+        directory = os.path.abspath(os.path.expanduser(directory))
+        entries, skipped = dirPreflight(destEntries(destinations), directory, remote_dir)
+        tasklist = [(entry.protvar, entry.servvar, ",".join(entry.remdirs),
+                     functools.partial(dirUploadEntry, entry, directory, remote_dir))
+                    for entry in entries]
+        progress.reset()
+        return fanOut(tasklist, "Uploading directory to", skipped)
+
+# Run a command over SSH on every destination that isn't S3
+def runCommand(destinations, command, options=None):
+    with libraryCall(options):
+        hostlist, skipped = commandPreflight(destEntries(destinations))
+        return mpfuSSHParallel(hostlist, command, skipped)
+
+# Run a job spec (see --job) and return True if every upload and command succeeded
+def runJob(spec):
+    jobstart = time.time()
+    with libraryCall(spec.get('options')):
+        destinations = spec.get('destinations')
+        if not destinations and not args.list:
+            print(f"{r_}No destinations in the job and no serverlist given with -l{_nc}")
+            return False
+
+        ok = True
+        if spec.get('files'):
+            ok = all(res['ok'] for res in uploadFiles(destinations, spec['files'])) and ok
+        if spec.get('directory'):
+            ok = all(res['ok'] for res in uploadDirectory(destinations, spec['directory'],
+                                                          spec.get('remote_dir', ""))) and ok
+        for command in spec.get('commands', []):
+            ok = all(res['rc'] == 0 for res in runCommand(destinations, command)) and ok
+        connpool.closeAll()
+        metrics.flush()
+    print(f"Job {g_ + 'succeeded' if ok else r_ + 'failed'}{_nc} in {y_}{round(time.time() - jobstart, 2)}{_nc}s "
+          f"(MPFU startup {y_}{round((jobstart - starttime) * 1000)}{_nc} ms)")
+    return ok
+
+
+if __name__ == '__main__':
+    if args.job:
+        with open(args.job) as jobfile:
+            sys.exit(0 if runJob(json.load(jobfile)) else 1)
+
+    metaloop = 1
+    while metaloop == 1:
+        try:
+            menuloop = 1
+            while menuloop == 1:
+                try:
+                    mpfuMenu()
+                except EOFError:
+                    pass
+                metrics.flush()
+        except Exception as e:
+            print(f"{r_}An exception occurred: {e}{_nc}")
@@ -0,0 +1,634 @@
+#!/usr/bin/env python3
+
+# MPFU benchmark. Starts local stand-in servers for every protocol MPFU speaks (paramiko SFTP/SSH, pyftpdlib
+# with TLS, moto S3 and impacket SMB), runs MPFU's upload functions against them over synthetic datasets and
+# reports files/s and MB/s, compared against a stored baseline.
+#
+# Needs paramiko, scp, pyftpdlib, pyOpenSSL, moto[server], boto3, pysmb and impacket. Benchmarks whose
+# stand-in can't be started are skipped.
+
+import os
+import sys
+import socket
+import shutil
+import tempfile
+import subprocess
+import threading
+import argparse
+import json
+import time
+import glob
+import logging
+import queue
+import functools
+
+import mpfu
+
+parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description="""
+Benchmark MPFU uploads against local stand-in servers
+
+""")
+parser.add_argument('-b','--baseline', required=False, default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                             'mpfubench_baseline.json'), help="""
+Baseline results to compare against (default mpfubench_baseline.json next to this script). If the file
+doesn't exist, this run's results are stored there
+
+""")
+parser.add_argument('--save-baseline', required=False, action='store_true', help="""
+Store this run's results as the new baseline
+
+""")
+parser.add_argument('-o','--output', required=False, help="""
+Also write this run's results to this JSON file
+
+""")
+parser.add_argument('--only', required=False, help="""
+Only run these benchmarks (comma separated names, or prefixes such as sftp or s3)
+
+""")
+parser.add_argument('--scale', required=False, type=float, default=1.0, help="""
+Multiply dataset sizes by this factor (default 1)
+
+""")
+parser.add_argument('--latency', required=False, type=float, default=50, help="""
+One-way delay in milliseconds added by the latency proxy used by the sftp-wan benchmarks (default 50)
+
+""")
+parser.add_argument('--tolerance', required=False, type=float, default=15, help="""
+Percent of MB/s or files/s below the baseline that counts as a regression (default 15)
+
+""")
+args = parser.parse_args() if __name__ == '__main__' else parser.parse_args([])
+
+b_ = '\033[95m'
+g_ = '\033[92m'
+r_ = '\033[91m'
+y_ = '\033[1;33m'
+bld_ = '\033[1m'
+_nc = '\033[0m'
+
+user = "mpfubench"
+password = "mpfubench"
+
+# Shutdown functions of the stand-ins that run non-daemon threads
+stoppers = []
+
+
+# A free TCP port on the loopback interface
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Synthetic datasets. Returns {name: (directory, [files])}.
+def makeDatasets(root, scale):
+    datasets = {}
+
+    large = os.path.join(root, 'large')
+    os.makedirs(large)
+    for n in range(4):
+        with open(os.path.join(large, f'large{n}.bin'), 'wb') as f:
+            f.write(os.urandom(int(32 * pow(2, 20) * scale)))
+    datasets['large'] = large
+
+    tiny = os.path.join(root, 'tiny')
+    os.makedirs(tiny)
+    for n in range(int(1000 * scale)):
+        with open(os.path.join(tiny, f'tiny{n}.txt'), 'wb') as f:
+            f.write(os.urandom(1024))
+    datasets['tiny'] = tiny
+
+    # 6 levels, 2 subdirectories and 4 small files per directory
+    deep = os.path.join(root, 'deep')
+    level = [deep]
+    for depth in range(6):
+        nextlevel = []
+        for d in level:
+            os.makedirs(d, exist_ok=True)
+            for n in range(4):
+                with open(os.path.join(d, f'f{n}.dat'), 'wb') as f:
+                    f.write(os.urandom(int(4096 * scale) or 1))
+            nextlevel += [os.path.join(d, f'd{n}') for n in range(2)]
+        level = nextlevel
+    datasets['deep'] = deep
+    return datasets
+
+
+# Number of files and bytes under a local directory
+def treeSize(path):
+    files = 0
+    size = 0
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+# Forward connections on a new port to port on the loopback, holding every chunk back for latency
+# milliseconds in each direction, like a long-distance link with plenty of bandwidth
+def startLatencyProxy(port, latency):
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(50)
+
+    def pump(src, dst):
+        held = queue.Queue()
+
+        def deliver():
+            while True:
+                due, data = held.get()
+                time.sleep(max(0, due - time.time()))
+                try:
+                    if not data:
+                        dst.shutdown(socket.SHUT_WR)
+                        return
+                    dst.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=deliver, daemon=True).start()
+        while True:
+            try:
+                data = src.recv(262144)
+            except OSError:
+                data = b""
+            held.put((time.time() + latency / 1000, data))
+            if not data:
+                return
+
+    def serve():
+        while True:
+            client, addr = listener.accept()
+            upstream = socket.create_connection(('127.0.0.1', port))
+            for src, dst in ((client, upstream), (upstream, client)):
+                threading.Thread(target=pump, args=(src, dst), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+# SFTP/SSH stand-in: paramiko server with the local filesystem as the remote side, and exec requests
+# (scp -t, tar -x, find, python3) run through the local shell
+def startSSH():
+    import paramiko
+    from paramiko import SFTPServerInterface, SFTPServer, SFTPAttributes, SFTPHandle, SFTP_OK, AUTH_SUCCESSFUL, \
+        AUTH_FAILED, OPEN_SUCCEEDED
+
+    hostkey = paramiko.RSAKey.generate(2048)
+
+    class benchHandle(SFTPHandle):
+        def stat(self):
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+        def chattr(self, attr):
+            return SFTP_OK
+
+    class benchSFTP(SFTPServerInterface):
+        def list_folder(self, path):
+            out = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+                attr.filename = name
+                out.append(attr)
+            return out
+
+        def stat(self, path):
+            return SFTPAttributes.from_stat(os.stat(path))
+
+        def lstat(self, path):
+            return SFTPAttributes.from_stat(os.lstat(path))
+
+        def open(self, path, flags, attr):
+            fd = os.open(path, flags, 0o644)
+            mode = 'rb' if not flags & (os.O_WRONLY | os.O_RDWR) else 'r+b' if flags & os.O_RDWR else 'wb'
+            handle = benchHandle(flags)
+            handle.readfile = handle.writefile = os.fdopen(fd, mode)
+            return handle
+
+        def remove(self, path):
+            os.remove(path)
+            return SFTP_OK
+
+        def rename(self, old, new):
+            os.rename(old, new)
+            return SFTP_OK
+
+        def mkdir(self, path, attr):
+            os.mkdir(path)
+            return SFTP_OK
+
+        def rmdir(self, path):
+            os.rmdir(path)
+            return SFTP_OK
+
+        def chattr(self, path, attr):
+            if attr.st_mtime is not None:
+                os.utime(path, (attr.st_atime, attr.st_mtime))
+            return SFTP_OK
+
+    class benchServer(paramiko.ServerInterface):
+        def check_auth_password(self, username, passwd):
+            return AUTH_SUCCESSFUL if passwd == password else AUTH_FAILED
+
+        def get_allowed_auths(self, username):
+            return 'password'
+
+        def check_channel_request(self, kind, chanid):
+            return OPEN_SUCCEEDED
+
+        def check_channel_exec_request(self, chan, command):
+            threading.Thread(target=execCommand, args=(chan, command.decode()), daemon=True).start()
+            return True
+
+    def execCommand(chan, command):
+        proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+
+        def pumpIn():
+            try:
+                for data in iter(lambda: chan.recv(262144), b''):
+                    proc.stdin.write(data)
+                    proc.stdin.flush()
+            except (IOError, OSError):
+                pass
+            try:
+                proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+        def pumpErr():
+            for data in iter(lambda: proc.stderr.read1(65536), b''):
+                chan.sendall_stderr(data)
+
+        threading.Thread(target=pumpIn, daemon=True).start()
+        errthread = threading.Thread(target=pumpErr, daemon=True)
+        errthread.start()
+        for data in iter(lambda: proc.stdout.read1(65536), b''):
+            chan.sendall(data)
+        errthread.join()
+        chan.send_exit_status(proc.wait())
+        chan.close()
+
+    port = freePort()
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(100)
+
+    def serve():
+        while True:
+            conn, addr = listener.accept()
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(hostkey)
+            transport.set_subsystem_handler('sftp', SFTPServer, benchSFTP)
+            try:
+                transport.start_server(server=benchServer())
+            except (paramiko.SSHException, EOFError):
+                # Port probes (mpfu's preflight) connect and hang up without a handshake
+                transport.close()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return port
+
+
+# FTP stand-in: pyftpdlib with TLS offered (MPFU logs in without AUTH TLS, so it stays optional)
+def startFTP(root, certdir):
+    from OpenSSL import crypto
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import TLS_FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = "localhost"
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(86400)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    certfile = os.path.join(certdir, 'ftpcert.pem')
+    with open(certfile, 'wb') as f:
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key) + crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(user, password, root, perm='elradfmwMT')
+    handler = TLS_FTPHandler
+    handler.certfile = certfile
+    handler.authorizer = authorizer
+    port = freePort()
+    server = ThreadedFTPServer(('127.0.0.1', port), handler)
+    # pyftpdlib logs every command unless logging is already set up
+    logging.getLogger('pyftpdlib').addHandler(logging.NullHandler())
+    threading.Thread(target=server.serve_forever, kwargs={'handle_exit': False}, daemon=True).start()
+    return port
+
+
+# S3 stand-in: moto's server mode. boto3 is pointed at it through AWS_ENDPOINT_URL.
+def startS3():
+    from moto.server import ThreadedMotoServer
+    import boto3
+
+    port = freePort()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    stoppers.append(server.stop)
+    os.environ.update(AWS_ENDPOINT_URL=f"http://127.0.0.1:{port}", AWS_ACCESS_KEY_ID="mpfubench",
+                      AWS_SECRET_ACCESS_KEY="mpfubench", AWS_DEFAULT_REGION="us-east-1")
+    boto3.client('s3').create_bucket(Bucket='mpfubench')
+    return port
+
+
+# SMB stand-in: impacket's SMB server sharing root as BENCH
+def startSMB(root):
+    from impacket import smbserver
+    from impacket.ntlm import compute_lmhash, compute_nthash
+
+    port = freePort()
+    server = smbserver.SimpleSMBServer(listenAddress='127.0.0.1', listenPort=port)
+    server.addShare('BENCH', root, '')
+    server.setSMB2Support(True)
+    server.addCredential(user, 0, compute_lmhash(password), compute_nthash(password))
+    # impacket turns on debug logging for everything, keep only warnings
+    logging.getLogger().setLevel(logging.WARNING)
+    threading.Thread(target=server.start, daemon=True).start()
+    stoppers.append(server.stop)
+    return port
+
+
+# Fresh, empty remote directory for one benchmark run
+def remoteDir(root, name):
+    path = os.path.join(root, name)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    return path
+
+
+def benchFTP(env, dataset):
+    remdir = remoteDir(env['ftproot'], 'ftp-' + os.path.basename(dataset))
+    fileglob = sorted(glob.glob(os.path.join(dataset, '*')))
+    return mpfu.ftpUpload("ftp", "127.0.0.1", user, password, dataset, "*", "/" + os.path.basename(remdir) + "/",
+                          fileglob), remdir
+
+
+# FTP over TLS with 4 sessions (--ftps --ftp-sessions 4)
+def benchFTPSessions(env, dataset):
+    mpfu.args.ftps, mpfu.args.ftp_sessions = True, 4
+    try:
+        remdir = remoteDir(env['ftproot'], 'ftps-' + os.path.basename(dataset))
+        fileglob = sorted(glob.glob(os.path.join(dataset, '*')))
+        ok = mpfu.ftpUpload("ftp", "127.0.0.1", user, password, dataset, "*", "/" + os.path.basename(remdir) + "/",
+                            fileglob)
+    finally:
+        mpfu.args.ftps, mpfu.args.ftp_sessions = False, 1
+    return ok, remdir
+
+
+def benchSFTP(env, dataset):
+    remdir = remoteDir(env['sshroot'], 'sftp-' + os.path.basename(dataset))
+    sftpc = mpfu.connpool.get("127.0.0.1", user, password).open_sftp()
+    fileglob = sorted(glob.glob(os.path.join(dataset, '*')))
+    return mpfu.sftpUpload("sftp", "127.0.0.1", user, password, dataset, "*", remdir + "/", fileglob, sftpc), remdir
+
+
+def benchSCP(env, dataset):
+    import scp
+    remdir = remoteDir(env['sshroot'], 'scp-' + os.path.basename(dataset))
+    pscp = scp.SCPClient(mpfu.connpool.get("127.0.0.1", user, password).get_transport(), progress=mpfu.sbar)
+    fileglob = sorted(glob.glob(os.path.join(dataset, '*')))
+    return mpfu.scpUpload("scp", "127.0.0.1", user, password, dataset, "*", remdir + "/", fileglob, pscp), remdir
+
+
+def benchSMB(env, dataset):
+    remdir = remoteDir(env['smbroot'], 'smb-' + os.path.basename(dataset))
+    fileglob = sorted(glob.glob(os.path.join(dataset, '*')))
+    return mpfu.smbUpload("smb", "127.0.0.1", user, password, dataset, "*",
+                          "/BENCH/" + os.path.basename(remdir) + "/", fileglob), remdir
+
+
+def benchS3(env, dataset):
+    fileglob = sorted(glob.glob(os.path.join(dataset, '*')))
+    return mpfu.s3Upload(dataset, "*", fileglob, 'mpfubench'), None
+
+
+def benchSFTPDir(env, dataset):
+    remdir = remoteDir(env['sshroot'], 'sftpdir-' + os.path.basename(dataset))
+    pssh = mpfu.connpool.get("127.0.0.1", user, password)
+    mpfu.sftpDirUpload(pssh, pssh.open_sftp(), "127.0.0.1", user, dataset, remdir + "/", 80)
+    return True, os.path.join(remdir, os.path.basename(dataset))
+
+
+def benchTarDir(env, dataset):
+    mpfu.args.tar = "plain"
+    try:
+        remdir = remoteDir(env['sshroot'], 'tardir-' + os.path.basename(dataset))
+        pssh = mpfu.connpool.get("127.0.0.1", user, password)
+        mpfu.sftpDirUpload(pssh, pssh.open_sftp(), "127.0.0.1", user, dataset, remdir + "/", 80)
+    finally:
+        mpfu.args.tar = None
+    return True, os.path.join(remdir, os.path.basename(dataset))
+
+
+def benchSMBDir(env, dataset):
+    remdir = remoteDir(env['smbroot'], 'smbdir-' + os.path.basename(dataset))
+    entry = mpfu.invEntry("smb", "127.0.0.1", ["/BENCH/" + os.path.basename(remdir) + "/"], user, password, "")
+    return mpfu.dirUploadEntry(entry, dataset, ""), os.path.join(remdir, os.path.basename(dataset))
+
+
+def benchS3Dir(env, dataset):
+    return mpfu.s3DirUpload('mpfubench/dir-' + str(time.time()), dataset, ""), None
+
+
+# SFTP through the latency proxy (--latency) with the given --ssh-profile, on a connection of its own
+def benchWAN(env, dataset, profile="default"):
+    mpfu.args.ssh_profile = profile
+    mpfu.connpool.closeAll()
+    try:
+        remdir = remoteDir(env['sshroot'], f'wan-{profile}-' + os.path.basename(dataset))
+        sftpc = mpfu.connpool.get("127.0.0.1", user, password, port=env['wanport']).open_sftp()
+        fileglob = sorted(glob.glob(os.path.join(dataset, '*')))
+        ok = mpfu.sftpUpload("sftp", "127.0.0.1", user, password, dataset, "*", remdir + "/", fileglob, sftpc)
+    finally:
+        mpfu.args.ssh_profile = "default"
+        mpfu.connpool.closeAll()
+    return ok, remdir
+
+
+# Same files to count SFTP destinations, 4 at a time (-p 4). Each destination logs in as a different user, so each
+# gets its own connection like separate hosts would. With relay, MPFU only sends to relay of them (--relay).
+def benchMulti(env, dataset, shared=False, relay=0, count=4):
+    mpfu.args.parallel = 4
+    mpfu.args.shared_read = shared
+    mpfu.args.relay = relay
+    try:
+        remdirs = [remoteDir(env['sshroot'], f'multi{n}-' + os.path.basename(dataset)) for n in range(count)]
+        results = mpfu.uploadFiles([f"sftp:127.0.0.1:{remdir}/:{user}{n}:{password}" for n, remdir in enumerate(remdirs)],
+                                   [os.path.join(dataset, '*')])
+    finally:
+        mpfu.args.parallel = 1
+        mpfu.args.shared_read = False
+        mpfu.args.relay = 0
+    return all(res['ok'] for res in results), remdirs[-1]
+
+
+# name: (stand-in, function, dataset, number of destinations)
+benchmarks = {
+    'ftp-large': ('ftp', benchFTP, 'large', 1),
+    'ftp-tiny': ('ftp', benchFTP, 'tiny', 1),
+    'ftps-sessions-tiny': ('ftp', benchFTPSessions, 'tiny', 1),
+    'sftp-large': ('ssh', benchSFTP, 'large', 1),
+    'sftp-tiny': ('ssh', benchSFTP, 'tiny', 1),
+    'sftp-wan-large': ('wan', benchWAN, 'large', 1),
+    'sftp-wan-large-throughput': ('wan', functools.partial(benchWAN, profile="throughput"), 'large', 1),
+    'scp-large': ('ssh', benchSCP, 'large', 1),
+    'scp-tiny': ('ssh', benchSCP, 'tiny', 1),
+    'smb-large': ('smb', benchSMB, 'large', 1),
+    'smb-tiny': ('smb', benchSMB, 'tiny', 1),
+    's3-large': ('s3', benchS3, 'large', 1),
+    's3-tiny': ('s3', benchS3, 'tiny', 1),
+    'sftp-dir-deep': ('ssh', benchSFTPDir, 'deep', 1),
+    'tar-dir-deep': ('ssh', benchTarDir, 'deep', 1),
+    'smb-dir-deep': ('smb', benchSMBDir, 'deep', 1),
+    's3-dir-deep': ('s3', benchS3Dir, 'deep', 1),
+    'multi-sftp-large': ('ssh', benchMulti, 'large', 4),
+    'multi-sftp-large-shared': ('ssh', functools.partial(benchMulti, shared=True), 'large', 4),
+    'multi-sftp-tiny': ('ssh', benchMulti, 'tiny', 4),
+    'relay-sftp-large': ('ssh', functools.partial(benchMulti, relay=2, count=8), 'large', 8),
+}
+
+
+# Start the stand-ins the selected benchmarks need. Returns the environment and {stand-in: error} for the
+# ones that failed to start.
+def startServers(needed, root):
+    env = {}
+    failed = {}
+    starters = {
+        'ssh': lambda: startSSH(),
+        'ftp': lambda: startFTP(env.setdefault('ftproot', remoteDir(root, 'ftproot')), root),
+        's3': lambda: startS3(),
+        'smb': lambda: startSMB(env.setdefault('smbroot', remoteDir(root, 'smbroot'))),
+        'wan': lambda: startLatencyProxy(mpfu.serviceports['ssh'], args.latency),
+    }
+    # The latency proxy sits in front of the SSH stand-in, which sorts before it
+    if 'wan' in needed:
+        needed = set(needed) | {'ssh'}
+    for server in sorted(needed):
+        if server == 'wan' and 'ssh' in failed:
+            failed[server] = failed['ssh']
+            continue
+        try:
+            port = starters[server]()
+            if server in mpfu.serviceports:
+                mpfu.serviceports[server] = port
+            env[server + 'port'] = port
+            print(f"Started {y_}{server}{_nc} stand-in on port {y_}{port}{_nc}")
+        except Exception as e:
+            failed[server] = f"{type(e).__name__}: {e}"
+            print(f"{r_}Could not start {server} stand-in{_nc}: {failed[server]}")
+    env['sshroot'] = remoteDir(root, 'sshroot')
+    return env, failed
+
+
+def runBenchmarks(selected, env, failed, datasets):
+    results = {}
+    for name in selected:
+        server, func, dataset, dests = benchmarks[name]
+        if server in failed:
+            results[name] = {'skipped': failed[server]}
+            continue
+        files, size = treeSize(datasets[dataset])
+        started = time.time()
+        try:
+            ok, remdir = func(env, datasets[dataset])
+        except Exception as e:
+            ok, remdir = False, None
+            print(f"{r_}{name} raised{_nc}: {e}")
+        seconds = time.time() - started
+        if ok and remdir and treeSize(remdir) != (files, size):
+            print(f"{r_}{name}: remote copy doesn't match the dataset{_nc}")
+            ok = False
+        files, size = files * dests, size * dests
+        results[name] = {'ok': bool(ok), 'files': files, 'bytes': size, 'seconds': round(seconds, 4),
+                         'files_s': round(files / seconds, 2), 'mb_s': round(size / seconds / pow(2, 20), 2)}
+    return results
+
+
+# Print the results table with the change against the baseline. Returns the names of regressed benchmarks.
+def report(results, baseline):
+    regressions = []
+    namewidth = max(len(name) for name in results)
+    print(f"\n{bld_}{'BENCHMARK'.ljust(namewidth)}  {'FILES':>6}  {'MB':>8}  {'SECONDS':>8}  {'FILES/S':>9}  {'MB/S':>8}  "
+          f"{'BASE MB/S':>9}  CHANGE{_nc}")
+    for name, res in results.items():
+        if 'skipped' in res:
+            print(f"{name.ljust(namewidth)}  {y_}skipped{_nc} ({res['skipped']})")
+            continue
+        if not res['ok']:
+            print(f"{name.ljust(namewidth)}  {r_}FAILED{_nc}")
+            regressions.append(name)
+            continue
+        line = (f"{name.ljust(namewidth)}  {res['files']:>6}  {round(res['bytes'] / pow(2, 20), 1):>8}  "
+                f"{res['seconds']:>8}  {res['files_s']:>9}  {res['mb_s']:>8}  ")
+        base = baseline.get(name)
+        if base and base.get('ok'):
+            # Tiny-file runs are bound by files/s, everything else by MB/s
+            metric = 'files_s' if res['bytes'] / max(res['files'], 1) < 65536 else 'mb_s'
+            change = (res[metric] - base[metric]) / base[metric] * 100 if base[metric] else 0
+            color = r_ if change < -args.tolerance else g_ if change > args.tolerance else ""
+            line += f"{base['mb_s']:>9}  {color}{'+' if change >= 0 else ''}{round(change, 1)}% {metric.replace('_s', '/s')}{_nc}"
+            if change < -args.tolerance:
+                regressions.append(name)
+        else:
+            line += f"{'-':>9}  -"
+        print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    selected = [name for name in benchmarks
+                if not args.only or any(name == o or name.startswith(o + '-') for o in args.only.split(','))]
+    if not selected:
+        sys.exit(f"No benchmarks match {args.only}")
+
+    mpfu.batchmode = True
+    mpfu.args.progress = "quiet"
+    root = tempfile.mkdtemp(prefix='mpfubench-')
+    try:
+        print(f"Generating datasets in {b_}{root}{_nc} (scale {args.scale})")
+        datasets = makeDatasets(os.path.join(root, 'data'), args.scale)
+        env, failed = startServers({benchmarks[name][0] for name in selected}, root)
+        results = runBenchmarks(selected, env, failed, datasets)
+    finally:
+        mpfu.connpool.closeAll()
+        for stop in stoppers:
+            try:
+                stop()
+            except Exception:
+                pass
+        shutil.rmtree(root, ignore_errors=True)
+
+    # The numbers only mean something on the machine that produced them, so none is shipped: the first run
+    # on a machine stores its results as the baseline
+    first = not os.path.exists(args.baseline)
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (IOError, ValueError):
+        baseline = {}
+    regressions = report(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline or first:
+        baseline.update({name: res for name, res in results.items() if 'skipped' not in res})
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"\nBaseline saved to {b_}{args.baseline}{_nc}")
+    if regressions:
+        print(f"\n{r_}Regressed or failed{_nc}: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# mpfubench's SFTP/SCP stand-in, serving the local filesystem to mpfubench.user / mpfubench.password
+@pytest.fixture(scope="session")
+def sshserver():
+    import mpfu
+    import mpfubench
+    mpfu.serviceports['ssh'] = mpfubench.startSSH()
+    return mpfubench
+
+
+# Empty S3 bucket "bucket" in moto's mock of AWS, with the hash cache kept in tmp_path
+@pytest.fixture
+def bucket(monkeypatch, tmp_path):
+    import mpfu
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(mpfu, "hashes", mpfu.hashCache(str(tmp_path / "hashes.mpfu")))
+    with moto.mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="bucket")
+        yield s3
+
+
+# mpfubench's FTP stand-in (TLS optional), serving the returned directory
+@pytest.fixture(scope="session")
+def ftproot(tmp_path_factory):
+    import mpfu
+    import mpfubench
+    pytest.importorskip("pyftpdlib")
+    root = tmp_path_factory.mktemp("ftproot")
+    mpfu.serviceports['ftp'] = mpfubench.startFTP(str(root), str(tmp_path_factory.mktemp("cert")))
+    return root
+
+
+# mpfubench's SMB stand-in, sharing the returned directory as BENCH
+@pytest.fixture(scope="session")
+def smbroot(tmp_path_factory):
+    import mpfu
+    import mpfubench
+    pytest.importorskip("impacket")
+    root = tmp_path_factory.mktemp("smbroot")
+    mpfu.serviceports['smb'] = mpfubench.startSMB(str(root))
+    return root
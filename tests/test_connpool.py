@@ -0,0 +1,57 @@
+import time
+
+import mpfu
+
+
+class FakeTransport(object):
+    def is_active(self):
+        return True
+
+    def send_ignore(self):
+        pass
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.closed = False
+
+    def get_transport(self):
+        return FakeTransport()
+
+    def close(self):
+        self.closed = True
+
+
+def pooled(pool, host, last, leases):
+    pssh = FakeClient()
+    pool.conns[pool.poolKey(host, 22, "u", "pw")] = [pssh, last, leases]
+    return pssh
+
+
+def test_idle_connection_is_evicted():
+    pool = mpfu.sshConnPool(300)
+    pssh = pooled(pool, "a", time.time() - 301, 0)
+    pool.evictIdle()
+    assert pssh.closed and not pool.conns
+
+
+def test_leased_connection_is_not_evicted():
+    pool = mpfu.sshConnPool(300)
+    pssh = pooled(pool, "a", time.time() - 301, 1)
+    pool.evictIdle()
+    assert not pssh.closed
+
+
+def test_get_takes_and_release_gives_back_a_lease():
+    pool = mpfu.sshConnPool(300)
+    pssh = pooled(pool, "a", time.time(), 0)
+    with pool.lease("a", "u", "pw") as got:
+        assert got is pssh
+        # A get by another worker evicts idle connections, but not this one
+        other = pooled(pool, "b", 0, 0)
+        pool.conns[pool.poolKey("a", 22, "u", "pw")][1] = 0
+        pool.evictIdle()
+        assert other.closed and not pssh.closed
+    pool.conns[pool.poolKey("a", 22, "u", "pw")][1] = 0
+    pool.evictIdle()
+    assert pssh.closed
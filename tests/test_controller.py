@@ -0,0 +1,73 @@
+import pytest
+
+import mpfu
+
+
+@pytest.fixture
+def controller(monkeypatch):
+    monkeypatch.setattr(mpfu.args, "adaptive", True)
+    monkeypatch.setattr(mpfu.args, "adapt_interval", 3600)
+    monkeypatch.setattr(mpfu.args, "max_streams", 4)
+    sent = [0]
+    monkeypatch.setattr(mpfu.progress, "sent", lambda: sent[0])
+    monkeypatch.setattr(mpfu.progress, "println", lambda line: None)
+    controller = mpfu.concurrencyController()
+    controller.begin(8)
+    controller.sent = sent
+    yield controller
+    controller.end()
+
+
+def interval(controller, nbytes, transfers=0, failures=0):
+    controller.active = controller.limit
+    controller.sent[0] += nbytes
+    controller.laststamp -= 1
+    for _ in range(transfers):
+        controller.transferred()
+    for _ in range(failures):
+        controller.error(ConnectionResetError())
+    controller.adjust()
+
+
+def test_rising_throughput_adds_destinations_then_streams(controller):
+    interval(controller, 100)
+    assert (controller.limit, controller.streams) == (3, 1)
+    interval(controller, 200)
+    assert (controller.limit, controller.streams) == (4, 1)
+    # No gain: the last destination is taken back and streams are tried
+    interval(controller, 200)
+    interval(controller, 300)
+    assert (controller.limit, controller.streams) == (3, 2)
+
+
+def test_an_occasional_failure_is_tolerated(controller):
+    interval(controller, 100)
+    interval(controller, 200, transfers=20, failures=1)
+    assert controller.limit == 4
+
+
+def test_a_high_failure_rate_halves_both(controller):
+    for rate in (100, 200, 300, 400):
+        interval(controller, rate)
+    assert controller.limit == 6
+    interval(controller, 500, transfers=5, failures=1)
+    assert (controller.limit, controller.streams) == (3, 1)
+
+
+def test_login_errors_do_not_count(controller):
+    interval(controller, 100)
+    controller.error(PermissionError("refused"))
+    interval(controller, 200)
+    assert controller.limit == 4
+
+
+def test_fan_out_stops_the_controller_when_it_raises(monkeypatch, controller):
+    def broken(res, attempt):
+        raise RuntimeError("broken")
+
+    monkeypatch.setattr(mpfu, "controller", controller)
+    monkeypatch.setattr(mpfu, "retryDelay", broken)
+    with pytest.raises(RuntimeError):
+        mpfu.fanOut([("sftp", "a", "/", lambda: True)], "Uploading to")
+    assert not controller.running
+    assert mpfu.streamCount(6) == 6
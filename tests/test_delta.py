@@ -0,0 +1,55 @@
+import os
+import random
+import re
+
+import pytest
+
+import mpfu
+
+
+@pytest.fixture
+def delta(sshserver, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(mpfu.args, "delta_block", 4096)
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    old = random.Random(6).randbytes(256 * 1024)
+    remote, local = tmp_path / "remote.bin", tmp_path / "local.bin"
+
+    def upload(new):
+        remote.write_bytes(old)
+        local.write_bytes(new)
+        capsys.readouterr()
+        with mpfu.connpool.lease("127.0.0.1", sshserver.user, sshserver.password) as pssh:
+            used = mpfu.deltaUpload(pssh.get_transport(), str(local), str(remote))
+        assert remote.read_bytes() == new
+        printed = re.sub(r"\x1b\[[0-9;]*m", "", capsys.readouterr().out)
+        return used, int(re.search(r"sent (\d+) of", printed).group(1)) if used else None
+
+    upload.old = old
+    return upload
+
+
+def test_shifted_and_changed_data_is_matched(delta):
+    old = delta.old
+    new = b"inserted" * 12 + old[:50000] + old[50123:150000] + b"x" * 300 + old[150000:]
+    used, sent = delta(new)
+    assert used
+    # The new bytes, and the blocks they break, but not the other 240 KB
+    assert sent < 8 * 4096
+
+
+def test_appended_data_only_sends_the_tail(delta):
+    used, sent = delta(delta.old + b"tail" * 1000)
+    assert used and sent == 4000
+
+
+def test_unrelated_file_is_sent_whole(delta):
+    new = os.urandom(100 * 1024)
+    assert delta(new) == (True, len(new))
+
+
+def test_no_remote_copy_falls_back(sshserver, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "delta_block", 4096)
+    local = tmp_path / "local.bin"
+    local.write_bytes(b"x" * 65536)
+    with mpfu.connpool.lease("127.0.0.1", sshserver.user, sshserver.password) as pssh:
+        assert not mpfu.deltaUpload(pssh.get_transport(), str(local), str(tmp_path / "missing.bin"))
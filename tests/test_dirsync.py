@@ -0,0 +1,49 @@
+import os
+
+import mpfu
+
+
+def tree(root):
+    (root / "sub" / "deeper").mkdir(parents=True)
+    (root / "a.txt").write_bytes(b"a" * 1000)
+    (root / "sub" / "b.txt").write_bytes(b"b" * 2000)
+    (root / "sub" / "deeper" / "c.txt").write_bytes(b"c" * 3000)
+
+
+def synced(sshserver, monkeypatch, src, dst):
+    sent = []
+    sftpPut = mpfu.sftpPut
+
+    def counted(sftpc, localfile, remotefile):
+        sent.append(os.path.relpath(localfile, str(src)))
+        return sftpPut(sftpc, localfile, remotefile)
+
+    monkeypatch.setattr(mpfu, "sftpPut", counted)
+    entry = mpfu.invEntry("sftp", "127.0.0.1", [str(dst) + "/"], sshserver.user, sshserver.password, "")
+    assert mpfu.dirUploadEntry(entry, str(src), str(dst) + "/")
+    return sorted(sent)
+
+
+def test_sync_sends_only_new_or_changed_files(sshserver, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "sync", True)
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu, "homepath", str(tmp_path))
+    src, dst = tmp_path / "tree", tmp_path / "dst"
+    dst.mkdir()
+    tree(src)
+    assert synced(sshserver, monkeypatch, src, dst) == ["a.txt", "sub/b.txt", "sub/deeper/c.txt"]
+    assert (dst / "tree" / "sub" / "deeper" / "c.txt").read_bytes() == b"c" * 3000
+    assert os.stat(dst / "tree" / "a.txt").st_mtime == int(os.stat(src / "a.txt").st_mtime)
+
+    # Unchanged: the manifest says so without looking at the server
+    assert synced(sshserver, monkeypatch, src, dst) == []
+
+    (src / "sub" / "b.txt").write_bytes(b"B" * 2001)
+    (src / "new.txt").write_bytes(b"n")
+    assert synced(sshserver, monkeypatch, src, dst) == ["new.txt", "sub/b.txt"]
+    assert (dst / "tree" / "sub" / "b.txt").read_bytes() == b"B" * 2001
+
+    # Without a manifest the remote tree decides
+    for manifest in os.listdir(tmp_path / "manifests"):
+        os.remove(tmp_path / "manifests" / manifest)
+    assert synced(sshserver, monkeypatch, src, dst) == []
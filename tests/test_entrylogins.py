@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+import mpfu
+import mpfubench
+
+
+def counted(monkeypatch, name):
+    calls = []
+    original = getattr(mpfu, name)
+    monkeypatch.setattr(mpfu, name, lambda *args, **kwargs: calls.append(args) or original(*args, **kwargs))
+    return calls
+
+
+def localFiles(tmp_path):
+    files = []
+    for n in range(3):
+        path = tmp_path / f"f{n}.bin"
+        path.write_bytes(os.urandom(5000 + n))
+        files.append(str(path))
+    return files
+
+
+def arrived(root, remdirs, files):
+    return all(open(f, 'rb').read() == (root / remdir / os.path.basename(f)).read_bytes()
+               for remdir in remdirs for f in files)
+
+
+@pytest.mark.parametrize("sessions", [1, 2])
+def test_ftp_entry_logs_in_once_for_all_paths(ftproot, tmp_path, monkeypatch, sessions):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu.args, "ftp_sessions", sessions)
+    remdirs = [f"s{sessions}/p{n}" for n in range(3)]
+    for remdir in remdirs:
+        (ftproot / remdir).mkdir(parents=True)
+    logins = counted(monkeypatch, "ftpConnect")
+    files = localFiles(tmp_path)
+    entry = mpfu.invEntry("ftp", "127.0.0.1", ["/" + d + "/" for d in remdirs[:2]] + [remdirs[2]],
+                          mpfubench.user, mpfubench.password, "")
+    assert mpfu.mpfuSendEntry(entry, str(tmp_path), "*", files)
+    assert len(logins) == sessions
+    assert arrived(ftproot, remdirs, files)
+
+
+def test_smb_entry_connects_once_for_all_paths(smbroot, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu.args, "smb_connections", 2)
+    remdirs = ["a", "b/c"]
+    for remdir in remdirs:
+        (smbroot / remdir).mkdir(parents=True)
+    logins = counted(monkeypatch, "smbConnections")
+    files = localFiles(tmp_path)
+    entry = mpfu.invEntry("smb", "127.0.0.1", ["/BENCH/" + d + "/" for d in remdirs],
+                          mpfubench.user, mpfubench.password, "")
+    assert mpfu.mpfuSendEntry(entry, str(tmp_path), "*", files)
+    assert len(logins) == 1
+    assert arrived(smbroot, remdirs, files)
@@ -0,0 +1,44 @@
+import threading
+import time
+
+import mpfu
+
+
+def test_runs_up_to_parallel_destinations_at_once(monkeypatch):
+    monkeypatch.setattr(mpfu.args, "parallel", 3)
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def task():
+        with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return True
+
+    results = mpfu.fanOut([("sftp", f"host{n}", "/", task) for n in range(8)], "Uploading to")
+    assert running[1] == 3
+    assert sorted(res['host'] for res in results) == sorted(f"host{n}" for n in range(8))
+    assert all(res['ok'] for res in results)
+
+
+def test_a_failed_destination_does_not_stop_the_others(monkeypatch):
+    monkeypatch.setattr(mpfu.args, "parallel", 2)
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+
+    def refused():
+        raise PermissionError("login refused")
+
+    skipped = [{'prot': "sftp", 'host': "dead", 'remote': "/", 'ok': False, 'reason': "unreachable",
+                'seconds': 0.0, 'transient': False}]
+    results = mpfu.fanOut([("sftp", "a", "/", lambda: True), ("sftp", "b", "/", refused),
+                           ("ftp", "c", "/", lambda: None)], "Uploading to", skipped)
+    byhost = {res['host']: res for res in results}
+    assert byhost['a']['ok']
+    assert not byhost['b']['ok'] and byhost['b']['reason'] == "login refused"
+    assert not byhost['b']['transient']
+    assert not byhost['c']['ok']
+    assert byhost['dead']['reason'] == "unreachable"
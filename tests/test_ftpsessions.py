@@ -0,0 +1,91 @@
+import ftplib
+import os
+import ssl
+
+import pytest
+
+import mpfu
+import mpfubench
+
+
+@pytest.fixture
+def ftpargs(monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu.args, "ftp_sessions", 3)
+
+
+def localFiles(tmp_path, count=6):
+    files = []
+    for n in range(count):
+        path = tmp_path / f"f{n}.bin"
+        path.write_bytes(os.urandom(200000 + n))
+        files.append(str(path))
+    return files
+
+
+def upload(ftproot, name, files):
+    (ftproot / name).mkdir()
+    return mpfu.ftpUpload("ftp", "127.0.0.1", mpfubench.user, mpfubench.password, os.path.dirname(files[0]), "*",
+                          "/" + name + "/", files)
+
+
+def arrived(ftproot, name, files):
+    return all(open(f, 'rb').read() == (ftproot / name / os.path.basename(f)).read_bytes() for f in files)
+
+
+def test_files_are_spread_over_tls_sessions_in_ftp_blocks(ftproot, ftpargs, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "ftps", True)
+    monkeypatch.setattr(mpfu.args, "ftp_block", 64)
+    logins, blocks, threads, sessions = [], [], set(), []
+    ftpConnect, storbinary, wrap_socket = mpfu.ftpConnect, ftplib.FTP.storbinary, ssl.SSLContext.wrap_socket
+
+    def stor(session, cmd, fp, blocksize=8192, *rest, **kwargs):
+        blocks.append(blocksize)
+        threads.add(id(session))
+        return storbinary(session, cmd, fp, blocksize, *rest, **kwargs)
+
+    def wrap(context, sock, *rest, **kwargs):
+        sessions.append(kwargs.get('session'))
+        return wrap_socket(context, sock, *rest, **kwargs)
+
+    monkeypatch.setattr(mpfu, "ftpConnect", lambda *args: logins.append(args) or ftpConnect(*args))
+    monkeypatch.setattr(ftplib.FTP, "storbinary", stor)
+    monkeypatch.setattr(ssl.SSLContext, "wrap_socket", wrap)
+    files = localFiles(tmp_path)
+    assert upload(ftproot, "tls", files)
+    assert arrived(ftproot, "tls", files)
+    assert len(logins) == len(threads) == 3
+    assert blocks == [64 * 1024] * len(files)
+    # Every data connection offers its control connection's TLS session
+    assert sessions.count(None) == 3
+    assert len([session for session in sessions if session is not None]) == len(files)
+
+
+def test_refused_extra_sessions_leave_the_ones_logged_in(ftproot, ftpargs, tmp_path, monkeypatch):
+    ftpConnect = mpfu.ftpConnect
+    logins = []
+
+    def connect(*args):
+        logins.append(args)
+        if len(logins) > 1:
+            raise ftplib.error_temp("421 Too many connections from the same IP address.")
+        return ftpConnect(*args)
+
+    monkeypatch.setattr(mpfu, "ftpConnect", connect)
+    files = localFiles(tmp_path)
+    assert upload(ftproot, "refused", files)
+    assert len(logins) == 2
+    assert arrived(ftproot, "refused", files)
+
+
+def test_a_failed_session_fails_the_upload(ftproot, ftpargs, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu, "errPause", lambda: None)
+    storbinary = ftplib.FTP.storbinary
+
+    def stor(session, cmd, *rest, **kwargs):
+        if cmd.endswith("f3.bin"):
+            raise ftplib.error_perm("553 Could not create file.")
+        return storbinary(session, cmd, *rest, **kwargs)
+
+    monkeypatch.setattr(ftplib.FTP, "storbinary", stor)
+    assert not upload(ftproot, "failed", localFiles(tmp_path))
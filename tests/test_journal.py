@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+import mpfu
+
+
+def test_entries_survive_a_restart_and_follow_the_local_file(tmp_path):
+    local = tmp_path / "big.bin"
+    local.write_bytes(b"x" * 100)
+    journal = mpfu.transferJournal(str(tmp_path / "journal.mpfu"))
+    key = journal.key("sftp", "host", "/remote/big.bin", str(local))
+    journal.set(key, {'offset': 50})
+    assert mpfu.transferJournal(journal.path).get(key) == {'offset': 50}
+    local.write_bytes(b"x" * 101)
+    assert journal.key("sftp", "host", "/remote/big.bin", str(local)) != key
+    journal.drop(key)
+    assert mpfu.transferJournal(journal.path).get(key) is None
+
+
+def test_damaged_journal_starts_empty(tmp_path):
+    (tmp_path / "journal.mpfu").write_text("{not json")
+    assert mpfu.transferJournal(str(tmp_path / "journal.mpfu")).entries == {}
+
+
+def test_interrupted_sftp_upload_resumes_where_it_stopped(sshserver, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "resume", True)
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu, "journal", mpfu.transferJournal(str(tmp_path / "journal.mpfu")))
+    local, remote = tmp_path / "big.bin", tmp_path / "remote.bin"
+    local.write_bytes(os.urandom(40 * pow(2, 20)))
+    add = mpfu.fileProgress.add
+
+    def cut(fp, n):
+        if fp.bytes > 20 * pow(2, 20):
+            raise ConnectionResetError("link dropped")
+        add(fp, n)
+
+    monkeypatch.setattr(mpfu.fileProgress, "add", cut)
+    with mpfu.connpool.lease("127.0.0.1", sshserver.user, sshserver.password) as pssh:
+        sftpc = pssh.open_sftp()
+        with pytest.raises(ConnectionResetError):
+            mpfu.sftpPut(sftpc, str(local), str(remote))
+        assert list(mpfu.journal.entries.values()) == [{'offset': 16 * pow(2, 20)}]
+
+        monkeypatch.setattr(mpfu.fileProgress, "add", add)
+        skipped = []
+        skip = mpfu.fileProgress.skip
+        monkeypatch.setattr(mpfu.fileProgress, "skip", lambda fp, n: skipped.append(n) or skip(fp, n))
+        mpfu.sftpPut(sftpc, str(local), str(remote))
+        sftpc.close()
+    assert skipped == [16 * pow(2, 20)]
+    assert remote.read_bytes() == local.read_bytes()
+    assert mpfu.journal.entries == {}
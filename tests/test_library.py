@@ -0,0 +1,27 @@
+import os
+
+import mpfu
+
+
+def test_library_call_options_do_not_leak():
+    parallel, batchmode = mpfu.args.parallel, mpfu.batchmode
+    with mpfu.libraryCall({'parallel': 7, 'skip-identical': True}):
+        assert mpfu.args.parallel == 7 and mpfu.args.skip_identical
+        assert mpfu.inWorker()
+    assert mpfu.args.parallel == parallel and not mpfu.args.skip_identical
+    assert mpfu.batchmode == batchmode
+
+
+def test_library_call_restores_options_after_an_error():
+    parallel = mpfu.args.parallel
+    try:
+        with mpfu.libraryCall({'parallel': 7}):
+            raise ValueError
+    except ValueError:
+        pass
+    assert mpfu.args.parallel == parallel
+
+
+def test_local_root_is_absolute():
+    base, parent = mpfu.localRoot("some/dir/")
+    assert base == os.path.join(os.getcwd(), "some") and parent == "dir"
@@ -0,0 +1,32 @@
+import json
+
+import mpfu
+
+
+def test_file_records_count_only_the_bytes_sent(monkeypatch, tmp_path):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu.args, "metrics", str(tmp_path / "run.jsonl"))
+    monkeypatch.setattr(mpfu, "metrics", mpfu.metricsSink())
+    progress = mpfu.progressRenderer()
+    progress.start("sftp", "host")
+    # A delta or resumed upload: 30 bytes sent, the rest already on the server
+    with progress.begin("f", size=100) as fp:
+        fp.add(30)
+        fp.skip(70)
+    mpfu.metrics.flush()
+    rec = json.loads((tmp_path / "run.jsonl").read_text())
+    assert (rec['kind'], rec['protocol'], rec['host'], rec['outcome']) == ("file", "sftp", "host", "ok")
+    assert rec['bytes'] == 30 and rec['skipped'] == 70 and rec['size'] == 100
+
+
+def test_prometheus_textfile_has_totals_per_host(monkeypatch, tmp_path):
+    monkeypatch.setattr(mpfu.args, "prom", str(tmp_path / "mpfu.prom"))
+    sink = mpfu.metricsSink()
+    sink.record("file", "sftp", 'we"b', "ok", 100, 2.0)
+    sink.record("file", "sftp", 'we"b', "ok", 50, 1.0, retries=1)
+    sink.flush()
+    text = (tmp_path / "mpfu.prom").read_text()
+    labels = 'host="we\\"b",protocol="sftp",outcome="ok"'
+    assert f"mpfu_file_transfers_total{{{labels}}} 2" in text
+    assert f"mpfu_file_transfers_bytes_total{{{labels}}} 150" in text
+    assert f"mpfu_file_transfers_retries_total{{{labels}}} 1" in text
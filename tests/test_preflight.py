@@ -0,0 +1,82 @@
+import socket
+import time
+
+import pytest
+
+import mpfu
+
+
+@pytest.fixture
+def fresh(monkeypatch):
+    monkeypatch.setattr(mpfu, "dnscache", {})
+    monkeypatch.setattr(mpfu.args, "no_preflight", False)
+    monkeypatch.setattr(mpfu.args, "probe_timeout", 3)
+
+
+def entry(protvar, servvar, remdir="/tmp/", uservar="u", passvar="p"):
+    return mpfu.invEntry(protvar, servvar, [remdir], uservar, passvar, None)
+
+
+def closedPort():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_unresolved_and_unreachable_hosts_are_left_out(fresh, monkeypatch):
+    lookups = []
+    gethostbyname = socket.gethostbyname
+
+    def lookup(name):
+        lookups.append(name)
+        if name.endswith(".invalid"):
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return gethostbyname(name)
+
+    monkeypatch.setattr(socket, "gethostbyname", lookup)
+    monkeypatch.setitem(mpfu.serviceports, "ftp", closedPort())
+    inventory = [entry("ftp", "gone.invalid"), entry("smb", "gone.invalid"), entry("ftp", "127.0.0.1"),
+                 entry("s3", "", "bucket/prefix")]
+    healthy, skipped = mpfu.preflight(inventory)
+    assert healthy == [inventory[3]]
+    assert [(res['prot'], res['host']) for res in skipped] == [("ftp", "gone.invalid"), ("smb", "gone.invalid"),
+                                                              ("ftp", "127.0.0.1")]
+    assert all(not res['ok'] for res in skipped)
+    assert skipped[0]['reason'].startswith("DNS lookup failed")
+    assert skipped[2]['reason'].startswith(f"port {mpfu.serviceports['ftp']} unreachable")
+    # Each host is looked up once, and the failure is remembered for the upload
+    assert sorted(lookups) == ["127.0.0.1", "gone.invalid"]
+    with pytest.raises(socket.gaierror):
+        mpfu.resolveHost("gone.invalid")
+    assert len(lookups) == 2
+
+
+def test_hosts_are_probed_at_the_same_time(fresh, monkeypatch):
+    probed = []
+
+    def slow(target, timeout=None):
+        probed.append(target)
+        time.sleep(0.5)
+        return socket.socket()
+
+    monkeypatch.setattr(socket, "create_connection", slow)
+    inventory = [entry("ftp", f"127.0.0.{n}") for n in range(1, 9)]
+    started = time.time()
+    healthy, skipped = mpfu.preflight(inventory)
+    assert time.time() - started < 2
+    assert healthy == inventory and skipped == []
+    assert len(probed) == 8
+
+
+def test_ssh_destinations_without_room_are_left_out(sshserver, fresh, tmp_path):
+    inventory = [entry("sftp", "127.0.0.1", str(tmp_path) + "/", sshserver.user, sshserver.password)]
+    assert mpfu.preflight(inventory, pow(2, 20)) == (inventory, [])
+    healthy, skipped = mpfu.preflight(inventory, pow(2, 60))
+    assert healthy == []
+    assert skipped[0]['reason'].startswith("only ") and "MB to send" in skipped[0]['reason']
+
+
+def test_no_preflight_keeps_every_destination(fresh, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "no_preflight", True)
+    inventory = [entry("ftp", "gone.invalid")]
+    assert mpfu.preflight(inventory) == (inventory, [])
@@ -0,0 +1,44 @@
+import threading
+
+import mpfu
+
+
+def renderer(monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    progress = mpfu.progressRenderer()
+    progress.start("sftp", "host")
+    return progress
+
+
+def test_bytes_count_towards_this_threads_destination(monkeypatch):
+    progress = renderer(monkeypatch)
+    fp = progress.begin("f", size=100)
+    fp.to(60)
+    fp.to(100)
+    fp.finish()
+    assert progress.dests["host"]['bytes'] == 100 and progress.dests["host"]['files'] == 1
+
+
+def test_helper_threads_report_under_the_adopted_destination(monkeypatch):
+    progress = renderer(monkeypatch)
+    context = progress.context()
+
+    def helper():
+        progress.adopt(context)
+        with progress.begin("f", size=10) as fp:
+            fp.add(10)
+
+    thread = threading.Thread(target=helper)
+    thread.start()
+    thread.join()
+    assert "" not in progress.dests
+    assert progress.dests["host"]['bytes'] == 10 and progress.dests["host"]['files'] == 1
+
+
+def test_resumed_bytes_count_towards_completion_but_not_throughput(monkeypatch):
+    progress = renderer(monkeypatch)
+    fp = progress.begin("f", size=100)
+    fp.skip(40)
+    fp.add(60)
+    fp.finish()
+    assert progress.sent() == 60 and progress.dests["host"]['bytes'] == 100
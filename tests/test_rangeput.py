@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+
+import paramiko
+
+import mpfu
+
+
+# sftpPutLarge over a pooled connection. Returns the bytes counted and the extra SFTP channels it opened;
+# with fail, the server refuses them.
+def put(sshserver, monkeypatch, local, remote, fail=False):
+    clients = []
+    fromTransport = paramiko.SFTPClient.from_transport
+
+    def counted(transport, *rest, **kwargs):
+        if fail:
+            raise paramiko.ssh_exception.SSHException("administratively prohibited")
+        clients.append(fromTransport(transport, *rest, **kwargs))
+        return clients[-1]
+
+    with mpfu.connpool.lease("127.0.0.1", sshserver.user, sshserver.password) as pssh:
+        sftpc = pssh.open_sftp()
+        with monkeypatch.context() as patch:
+            patch.setattr(paramiko.SFTPClient, "from_transport", counted)
+            with mpfu.progress.begin(str(local)) as fp:
+                mpfu.sftpPutLarge(sftpc, str(local), str(remote), fp)
+                sent = fp.bytes
+        sftpc.close()
+    return sent, clients
+
+
+def test_large_files_are_written_in_ranges_over_several_channels(sshserver, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu.args, "ssh_profile", "throughput")
+    # Writers wait in the bandwidth shaper side by side, not one at a time
+    inside, most = [0], [0]
+    lock = threading.Lock()
+
+    def take(nbytes, dest=None):
+        with lock:
+            inside[0] += 1
+            most[0] = max(most[0], inside[0])
+        time.sleep(0.001)
+        with lock:
+            inside[0] -= 1
+        return 0.0
+
+    monkeypatch.setattr(mpfu.shaper, "take", take)
+    local, remote = tmp_path / "big.bin", tmp_path / "remote.bin"
+    local.write_bytes(os.urandom(18 * pow(2, 20) + 12345))
+    sent, clients = put(sshserver, monkeypatch, local, remote)
+    assert sent == local.stat().st_size
+    assert remote.read_bytes() == local.read_bytes()
+    assert len(clients) == mpfu.sshprofiles['throughput']['streams'] - 1
+    assert all(client.sock.closed for client in clients)
+    assert most[0] > 1
+
+
+def test_ranges_fall_back_to_one_channel_when_the_server_refuses_more(sshserver, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu.args, "ssh_profile", "throughput")
+    local, remote = tmp_path / "big.bin", tmp_path / "remote.bin"
+    local.write_bytes(os.urandom(17 * pow(2, 20)))
+    assert put(sshserver, monkeypatch, local, remote, fail=True)[0] == local.stat().st_size
+    assert remote.read_bytes() == local.read_bytes()
+
+
+def test_small_files_use_one_channel(sshserver, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu.args, "ssh_profile", "throughput")
+    local, remote = tmp_path / "small.bin", tmp_path / "remote.bin"
+    local.write_bytes(os.urandom(300000))
+    assert put(sshserver, monkeypatch, local, remote) == (local.stat().st_size, [])
+    assert remote.read_bytes() == local.read_bytes()
@@ -0,0 +1,63 @@
+import hashlib
+import json
+import socket
+import subprocess
+import sys
+
+import pytest
+
+import mpfu
+
+
+@pytest.fixture
+def server(tmp_path):
+    src = tmp_path / "src.bin"
+    src.write_bytes(b"relay" * 50000)
+    tls = mpfu.relayCertificate()
+    proc = subprocess.Popen([sys.executable, "-c", mpfu.RELAY_SERVE_SCRIPT, "0"],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc.stdin.write(json.dumps({'token': "t0ken", 'cert': tls[0], 'key': tls[1],
+                                 'paths': [str(src)]}).encode() + b"\n")
+    proc.stdin.flush()
+    port = int(proc.stdout.readline())
+    yield port, tls, hashlib.sha256(src.read_bytes()).hexdigest()
+    proc.stdin.close()
+    proc.wait(10)
+
+
+def pull(tmp_path, port, cert, want):
+    out = tmp_path / "out"
+    spec = {'token': "t0ken", 'cert': cert, 'dirs': [str(out)], 'files': [[0, "src.bin", want]]}
+    return subprocess.run([sys.executable, "-c", mpfu.RELAY_PULL_SCRIPT, "127.0.0.1", str(port)],
+                          input=json.dumps(spec).encode(), capture_output=True), out / "src.bin"
+
+
+def test_pull_over_tls(tmp_path, server):
+    port, tls, want = server
+    done, copy = pull(tmp_path, port, tls[0], want)
+    assert done.stdout.split() == [b"OK"]
+    assert hashlib.sha256(copy.read_bytes()).hexdigest() == want
+
+
+def test_pull_refuses_other_certificate(tmp_path, server):
+    port, tls, want = server
+    done, copy = pull(tmp_path, port, mpfu.relayCertificate()[0], want)
+    assert done.returncode != 0 and b"CERTIFICATE_VERIFY_FAILED" in done.stderr
+    assert not copy.exists()
+
+
+def test_plain_client_gets_nothing(server):
+    port = server[0]
+    conn = socket.create_connection(("127.0.0.1", port), timeout=10)
+    conn.sendall(b"t0ken\n[0]\n")
+    data = b""
+    try:
+        while True:
+            got = conn.recv(65536)
+            if not got:
+                break
+            data += got
+    except (ConnectionResetError, socket.timeout):
+        pass
+    conn.close()
+    assert b"relay" not in data
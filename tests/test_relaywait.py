@@ -0,0 +1,55 @@
+import threading
+import time
+
+import mpfu
+
+
+def relayUpload(sshserver, tmp_path, results, **options):
+    (tmp_path / "f.bin").write_bytes(b"relay" * 1000)
+    destinations = [f"sftp:127.0.0.1:{tmp_path}/a/:{sshserver.user}:{sshserver.password}",
+                    f"sftp:localhost:{tmp_path}/b/:{sshserver.user}1:{sshserver.password}"]
+    for remdir in ("a", "b"):
+        (tmp_path / remdir).mkdir()
+    options.update({'relay': 1, 'parallel': 2, 'progress': "quiet", 'no-preflight': True})
+    thread = threading.Thread(target=lambda: results.extend(mpfu.uploadFiles(destinations, [str(tmp_path / "f.bin")],
+                                                                             options)), daemon=True)
+    thread.start()
+    return thread
+
+
+def test_a_parent_set_aside_by_its_breaker_lets_its_children_go(sshserver, tmp_path, monkeypatch):
+    check = mpfu.breakers.check
+
+    def openFor(host):
+        if host == "127.0.0.1":
+            raise mpfu.CircuitOpenError(f"{host} is set aside")
+        return check(host)
+
+    monkeypatch.setattr(mpfu.breakers, "check", openFor)
+    results = []
+    relayUpload(sshserver, tmp_path, results).join(30)
+    assert {res['host']: res['ok'] for res in results} == {"127.0.0.1": False, "localhost": True}
+    assert (tmp_path / "b" / "f.bin").read_bytes() == (tmp_path / "f.bin").read_bytes()
+
+
+def test_children_send_directly_when_the_parent_takes_too_long(sshserver, tmp_path, monkeypatch):
+    stuck = threading.Event()
+    mpfuSendEntry = mpfu.mpfuSendEntry
+
+    def slow(entry, *rest):
+        if entry.servvar == "127.0.0.1":
+            stuck.wait(30)
+        return mpfuSendEntry(entry, *rest)
+
+    monkeypatch.setattr(mpfu, "mpfuSendEntry", slow)
+    results = []
+    thread = relayUpload(sshserver, tmp_path, results, **{'relay-wait': 0.5})
+    started = time.time()
+    while not (tmp_path / "b" / "f.bin").exists() and time.time() - started < 20:
+        time.sleep(0.1)
+    # The child got its copy while the parent was still stuck
+    assert not stuck.is_set() and (tmp_path / "b" / "f.bin").exists()
+    stuck.set()
+    thread.join(30)
+    assert [res['ok'] for res in results] == [True, True]
+    assert (tmp_path / "a" / "f.bin").read_bytes() == (tmp_path / "b" / "f.bin").read_bytes()
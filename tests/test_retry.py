@@ -0,0 +1,74 @@
+import ftplib
+import socket
+import time
+
+import pytest
+
+import mpfu
+
+
+@pytest.fixture
+def retries(monkeypatch):
+    monkeypatch.setattr(mpfu.args, "retries", 3)
+    monkeypatch.setattr(mpfu.args, "retry_base", 1)
+    monkeypatch.setattr(mpfu.args, "retry_max", 3)
+    monkeypatch.setattr(mpfu.args, "breaker", 2)
+    monkeypatch.setattr(mpfu.args, "breaker_cooldown", 60)
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu, "breakers", mpfu.circuitBreakers())
+
+
+def failed(host="a", transient=True):
+    return {'prot': "sftp", 'host': host, 'ok': False, 'transient': transient}
+
+
+def test_only_network_errors_are_transient():
+    assert mpfu.transientError(ConnectionResetError())
+    assert mpfu.transientError(socket.timeout())
+    assert mpfu.transientError(ftplib.error_temp("421"))
+    assert not mpfu.transientError(PermissionError())
+    assert not mpfu.transientError(FileNotFoundError())
+    assert not mpfu.transientError(socket.gaierror())
+    assert not mpfu.transientError(ValueError())
+    assert not mpfu.transientError(None)
+
+
+def test_retry_delay_doubles_up_to_the_maximum(retries):
+    for attempt, most in ((0, 1), (1, 2), (2, 3)):
+        delay = mpfu.retryDelay(failed(), attempt)
+        assert most / 2 <= delay <= most
+    assert mpfu.retryDelay(failed(), 3) is None
+    assert mpfu.retryDelay(failed(transient=False), 0) is None
+    assert mpfu.retryDelay({'host': "a", 'ok': True}, 0) is None
+
+
+def test_breaker_opens_after_failures_in_a_row(retries):
+    mpfu.breakers.failure("a")
+    mpfu.breakers.success("a")
+    mpfu.breakers.failure("a")
+    mpfu.breakers.check("a")
+    mpfu.breakers.failure("a")
+    with pytest.raises(mpfu.CircuitOpenError):
+        mpfu.breakers.check("a")
+    assert mpfu.retryDelay(failed(), 0) is None
+    mpfu.breakers.check("b")
+
+
+def test_fan_out_retries_without_spinning(retries, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "retry_base", 0.6)
+    monkeypatch.setattr(mpfu.args, "retries", 1)
+    monkeypatch.setattr(mpfu.args, "breaker", 0)
+    monkeypatch.setattr(mpfu.random, "uniform", lambda low, high: high)
+    calls = []
+
+    def flaky():
+        calls.append(time.time())
+        if len(calls) == 1:
+            raise ConnectionResetError("reset")
+        return True
+
+    cpu = time.process_time()
+    results = mpfu.fanOut([("sftp", "a", "/", flaky)], "Uploading to")
+    assert [res['ok'] for res in results] == [True]
+    assert calls[1] - calls[0] >= 0.55
+    assert time.process_time() - cpu < 0.3
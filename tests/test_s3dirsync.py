@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+import mpfu
+
+boto3 = pytest.importorskip("boto3")
+
+
+def upload(monkeypatch, tmp_path, bucketvar="bucket/prefix"):
+    sent = []
+    s3Engine = mpfu.s3Engine
+
+    def counted(s3, pairs, *rest, **kwargs):
+        sent.extend(objkey for localfile, objkey in pairs)
+        return s3Engine(s3, pairs, *rest, **kwargs)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(mpfu, "s3Engine", counted)
+        assert mpfu.s3DirUpload(bucketvar, str(tmp_path / "tree"), "remote/")
+    return sorted(sent)
+
+
+def test_only_new_or_changed_files_are_uploaded(bucket, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu.args, "s3_chunk", 5)
+    (tmp_path / "tree" / "sub").mkdir(parents=True)
+    (tmp_path / "tree" / "a.txt").write_bytes(b"a" * 100)
+    (tmp_path / "tree" / "sub" / "big.bin").write_bytes(os.urandom(11 * pow(2, 20)))
+    assert upload(monkeypatch, tmp_path) == ["prefix/remote/tree/a.txt", "prefix/remote/tree/sub/big.bin"]
+    body = bucket.get_object(Bucket="bucket", Key="prefix/remote/tree/sub/big.bin")['Body'].read()
+    assert body == (tmp_path / "tree" / "sub" / "big.bin").read_bytes()
+
+    assert upload(monkeypatch, tmp_path) == []
+
+    (tmp_path / "tree" / "a.txt").write_bytes(b"A" * 100)
+    (tmp_path / "tree" / "sub" / "new.txt").write_bytes(b"n")
+    assert upload(monkeypatch, tmp_path) == ["prefix/remote/tree/a.txt", "prefix/remote/tree/sub/new.txt"]
+
+
+def test_multipart_objects_from_other_chunk_sizes_match(bucket, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu.args, "s3_chunk", 5)
+    (tmp_path / "tree").mkdir()
+    data = os.urandom(20 * pow(2, 20))
+    (tmp_path / "tree" / "big.bin").write_bytes(data)
+    # The AWS CLI's 8 MB parts, not the 5 MB of --s3-chunk
+    config = boto3.s3.transfer.TransferConfig(multipart_threshold=8 * pow(2, 20), multipart_chunksize=8 * pow(2, 20))
+    (tmp_path / "up").write_bytes(data)
+    bucket.upload_file(str(tmp_path / "up"), "bucket", "remote/tree/big.bin", Config=config)
+    assert upload(monkeypatch, tmp_path, "bucket") == []
+
+
+def test_stored_sha256_decides_when_the_etag_cannot(bucket, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    (tmp_path / "tree").mkdir()
+    (tmp_path / "tree" / "a.txt").write_bytes(b"a" * 100)
+    assert upload(monkeypatch, tmp_path, "bucket") == ["remote/tree/a.txt"]
+    head = bucket.head_object(Bucket="bucket", Key="remote/tree/a.txt")
+    assert head['Metadata'] == {'mpfu-sha256': mpfu.hashes.get(str(tmp_path / "tree" / "a.txt"))['sha256']}
+    # Same size, other ETag (as with KMS encryption), but the stored hash says it is the same file
+    bucket.put_object(Bucket="bucket", Key="remote/tree/a.txt", Body=b"z" * 100, Metadata=head['Metadata'])
+    assert upload(monkeypatch, tmp_path, "bucket") == []
@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+import mpfu
+
+pytest.importorskip("boto3")
+
+
+@pytest.fixture
+def s3args(monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu.args, "s3_chunk", 5)
+    monkeypatch.setattr(mpfu.args, "s3_concurrency", 3)
+
+
+def test_transfer_config_follows_the_options(s3args):
+    config = mpfu.s3TransferConfig(objects=4)
+    assert config.multipart_chunksize == config.multipart_threshold == 5 * pow(2, 20)
+    assert config.max_concurrency == 12
+
+
+def test_objects_are_sent_several_at_a_time(bucket, s3args, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "s3_objects", 3)
+    engine = []
+    s3Engine = mpfu.s3Engine
+    monkeypatch.setattr(mpfu, "s3Engine", lambda s3, pairs, *rest, **kwargs:
+                        engine.append(kwargs['objects']) or s3Engine(s3, pairs, *rest, **kwargs))
+    files = {}
+    for n in range(5):
+        path = tmp_path / f"f{n}"
+        path.write_bytes(os.urandom(1000 + n))
+        files[path.name] = path.read_bytes()
+    big = tmp_path / "big"
+    big.write_bytes(os.urandom(11 * pow(2, 20)))
+    files["big"] = big.read_bytes()
+    assert mpfu.s3Upload(str(tmp_path), "*", sorted(str(tmp_path / name) for name in files), "bucket")
+    assert engine == [3]
+    for name, data in files.items():
+        assert bucket.get_object(Bucket="bucket", Key=name)['Body'].read() == data
+    # Sent in --s3-chunk parts
+    assert bucket.head_object(Bucket="bucket", Key="big")['ETag'].strip('"').endswith("-3")
+
+
+def test_a_failed_object_fails_the_upload(bucket, s3args, tmp_path):
+    path = tmp_path / "f"
+    path.write_bytes(b"x")
+    with pytest.raises(Exception):
+        mpfu.s3Engine(bucket, [(str(path), "ok"), (str(path), "gone")], "no-such-bucket", objects=2)
+
+
+@pytest.mark.parametrize("mb", [6, 12])
+def test_resumable_uploads_use_the_chunk_size_and_store_the_hash(bucket, s3args, tmp_path, monkeypatch, mb):
+    monkeypatch.setattr(mpfu.args, "resume", True)
+    monkeypatch.setattr(mpfu.args, "skip_identical", True)
+    monkeypatch.setattr(mpfu, "journal", mpfu.transferJournal(str(tmp_path / "journal.mpfu")))
+    path = tmp_path / "big"
+    path.write_bytes(os.urandom(mb * pow(2, 20)))
+    assert mpfu.s3Upload(str(tmp_path), "big", [str(path)], "bucket")
+    head = bucket.head_object(Bucket="bucket", Key="big")
+    assert head['Metadata'] == {'mpfu-sha256': mpfu.hashes.get(str(path))['sha256']}
+    # Small files in one go, the rest in --s3-chunk parts
+    assert head['ETag'].strip('"').endswith("-3") == (mb == 12)
+    assert bucket.get_object(Bucket="bucket", Key="big")['Body'].read() == path.read_bytes()
@@ -0,0 +1,49 @@
+import hashlib
+
+import pytest
+
+import mpfu
+
+boto3 = pytest.importorskip("boto3")
+
+
+class CountingS3(object):
+    def __init__(self, s3):
+        self.s3 = s3
+        self.heads = 0
+
+    def head_object(self, **kwargs):
+        self.heads += 1
+        return self.s3.head_object(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.s3, name)
+
+
+def local(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_listing_decides_without_a_head_per_object(bucket, tmp_path):
+    same = local(tmp_path, "same", b"a" * 100)
+    changed = local(tmp_path, "changed", b"b" * 100)
+    missing = local(tmp_path, "missing", b"c" * 100)
+    bucket.put_object(Bucket="bucket", Key="dir/same", Body=b"a" * 100)
+    bucket.put_object(Bucket="bucket", Key="dir/changed", Body=b"x" * 100)
+    bucket.put_object(Bucket="bucket", Key="other", Body=b"a" * 100)
+    s3 = CountingS3(bucket)
+    found = mpfu.s3Hashes(s3, "bucket", {same: "dir/same", changed: "dir/changed", missing: "dir/missing"})
+    assert found == {same: hashlib.sha256(b"a" * 100).hexdigest()}
+    # changed has the right size but another ETag, so only its metadata is asked for
+    assert s3.heads == 1
+
+
+def test_multipart_objects_fall_back_to_stored_sha256(bucket, tmp_path):
+    data = b"d" * (6 * pow(2, 20))
+    path = local(tmp_path, "big", data)
+    sha256 = hashlib.sha256(data).hexdigest()
+    config = boto3.s3.transfer.TransferConfig(multipart_threshold=5 * pow(2, 20), multipart_chunksize=5 * pow(2, 20))
+    bucket.upload_file(path, "bucket", "big", Config=config, ExtraArgs={'Metadata': {'mpfu-sha256': sha256}})
+    assert mpfu.s3Hashes(bucket, "bucket", {path: "big"}) == {path: sha256}
@@ -0,0 +1,30 @@
+import mpfu
+
+
+def test_expand_hosts_keeps_zero_padding():
+    assert list(mpfu.expandHosts("web[08-10].example.com")) == ["web08.example.com", "web09.example.com",
+                                                                 "web10.example.com"]
+    assert list(mpfu.expandHosts("10.0.[1-2].[5-6]")) == ["10.0.1.5", "10.0.1.6", "10.0.2.5", "10.0.2.6"]
+
+
+def test_invalid_lines_are_skipped(capsys):
+    entries = mpfu.compileServerlist(["# comment", "", "gopher:host:/x/:u:p", "sftp:host:/x/",
+                                      "sftp:host:/x/:u:p:with:colons", "s3:bucket"])
+    assert [(e.protvar, e.servvar, e.passvar) for e in entries] == [("sftp", "host", "p:with:colons"),
+                                                                     ("s3", "", "")]
+    out = capsys.readouterr().out
+    assert "line 3" in out and "line 4" in out
+
+
+def test_lines_for_the_same_login_are_merged():
+    entries = mpfu.compileServerlist(["sftp:Host:/a/:u:p", "sftp:other:/a/:u:p", "sftp:host:/b/:u:p",
+                                      "sftp:host:/a/:u:p", "sftp:host:/c/:v:p"])
+    assert [(e.servvar, e.remdirs, e.uservar) for e in entries] == [("Host", ["/a/", "/b/"], "u"),
+                                                                    ("other", ["/a/"], "u"),
+                                                                    ("host", ["/c/"], "v")]
+
+
+def test_groups_select_sections():
+    lines = ["sftp:a:/x/:u:p", "[web]", "sftp:w[1-2]:/x/:u:p", "[db]", "sftp:d:/x/:u:p"]
+    assert [e.servvar for e in mpfu.compileServerlist(lines, ("web",))] == ["w1", "w2"]
+    assert [e.group for e in mpfu.compileServerlist(lines)] == ["", "web", "web", "db"]
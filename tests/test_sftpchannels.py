@@ -0,0 +1,33 @@
+import paramiko
+
+import mpfu
+
+
+def test_files_are_spread_over_several_channels(sshserver, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    opened = []
+    fromTransport = paramiko.SFTPClient.from_transport
+
+    def counted(transport, *rest, **kwargs):
+        client = fromTransport(transport, *rest, **kwargs)
+        opened.append(client)
+        return client
+
+    monkeypatch.setattr(paramiko.SFTPClient, "from_transport", counted)
+    src, dst = tmp_path / "src", tmp_path / "dst"
+    src.mkdir()
+    dst.mkdir()
+    sendlist = []
+    for n in range(6):
+        path = src / f"f{n}"
+        path.write_bytes(bytes([n]) * (20000 + n))
+        sendlist.append(str(path))
+    with mpfu.connpool.lease("127.0.0.1", sshserver.user, sshserver.password) as pssh:
+        sftpc = pssh.open_sftp()
+        opened.clear()
+        mpfu.sftpMultiChannel(sftpc, sendlist, str(dst) + "/", 3)
+        sftpc.close()
+    assert len(opened) == 2
+    assert all(client.sock.closed for client in opened)
+    for g in sendlist:
+        assert (dst / g.rsplit("/", 1)[1]).read_bytes() == open(g, 'rb').read()
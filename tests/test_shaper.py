@@ -0,0 +1,72 @@
+import collections
+
+import mpfu
+
+
+def limited(monkeypatch, bwlimit=0, host=0, site="", parallel=1):
+    monkeypatch.setattr(mpfu.args, "bwlimit", bwlimit)
+    monkeypatch.setattr(mpfu.args, "host_bwlimit", host)
+    monkeypatch.setattr(mpfu.args, "site_bwlimit", site)
+    monkeypatch.setattr(mpfu.args, "parallel", parallel)
+
+
+def test_bucket_allows_a_burst_then_paces(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(mpfu.time, "time", lambda: now[0])
+    bucket = mpfu.tokenBucket(1000)
+    assert bucket.reserve(250) == 0.0
+    assert bucket.reserve(500) == 0.5
+    now[0] += 0.5
+    assert bucket.reserve(0) == 0.0
+
+
+def test_slowest_limit_decides_the_wait(monkeypatch):
+    limited(monkeypatch, bwlimit=100, host=1)
+    monkeypatch.setattr(mpfu.time, "time", lambda: 100.0)
+    monkeypatch.setattr(mpfu.time, "sleep", lambda seconds: None)
+    shaper = mpfu.bandwidthShaper()
+    shaper.take(pow(2, 20) // 4, "a")
+    assert shaper.take(pow(2, 20) // 2, "a") == 0.5
+    assert shaper.take(pow(2, 20) // 4, "b") == 0.0
+
+
+def test_site_limits_per_group(monkeypatch):
+    limited(monkeypatch, site="dc1=100,5")
+    shaper = mpfu.bandwidthShaper()
+    Entry = collections.namedtuple("Entry", "protvar servvar remdirs group")
+    shaper.assign([Entry("sftp", "a", ["/"], "dc1"), Entry("sftp", "b", ["/"], "branch"),
+                   Entry("sftp", "c", ["/"], None)])
+    assert shaper.limits("a") == [("site:dc1", 100.0)]
+    assert shaper.limits("b") == [("site:branch", 5.0)]
+    assert shaper.limits("c") == []
+
+
+def test_share_splits_limits_over_what_runs_at_once(monkeypatch):
+    limited(monkeypatch, bwlimit=4, host=2, parallel=4)
+    shaper = mpfu.bandwidthShaper()
+    assert shaper.share("a", 2) == pow(2, 20) / 2
+    limited(monkeypatch, host=2, parallel=4)
+    assert shaper.share("a", 4) == pow(2, 20) / 2
+    limited(monkeypatch)
+    assert shaper.share("a") is None
+
+
+class FakeSMB(object):
+    def storeFile(self, share, path, file, timeout):
+        self.timeout = timeout
+        while file.read(65536):
+            pass
+
+
+def test_smb_timeout_follows_the_limit(monkeypatch, tmp_path):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    local = tmp_path / "big.bin"
+    local.write_bytes(b"\0" * pow(2, 20) * 4)
+    smbc = FakeSMB()
+    limited(monkeypatch)
+    mpfu.smbStore(smbc, "share", str(local), "/big.bin")
+    assert smbc.timeout == 15 + 4
+    limited(monkeypatch, host=0.5)
+    monkeypatch.setattr(mpfu.time, "sleep", lambda seconds: None)
+    mpfu.smbStore(smbc, "share", str(local), "/big.bin", streams=2)
+    assert smbc.timeout == 15 + 16
@@ -0,0 +1,104 @@
+import os
+import threading
+
+import mpfu
+
+
+def files(tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "shared_depth", 2)
+    paths = []
+    for n, size in enumerate((3000, 0, 2500)):
+        path = tmp_path / f"f{n}"
+        path.write_bytes(bytes([n + 1]) * size)
+        paths.append((str(path), size))
+    return paths
+
+
+def readAll(member, paths):
+    got = {}
+    for path, size in paths:
+        with member.open(path) as reader:
+            got[path] = reader.read()
+    return got
+
+
+def test_members_that_join_before_the_start_share_one_read(tmp_path, monkeypatch):
+    paths = files(tmp_path, monkeypatch)
+    reads = mpfu.sharedReads(paths)
+    members = [reads.join() for n in range(3)]
+    assert len(set(id(member.shared) for member in members)) == 1
+    results = [None] * 3
+
+    def worker(n):
+        results[n] = readAll(members[n], paths)
+        members[n].leave()
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    expected = {path: open(path, 'rb').read() for path, size in paths}
+    assert results == [expected] * 3
+
+
+def test_a_member_joining_after_the_start_gets_a_new_read(tmp_path, monkeypatch):
+    paths = files(tmp_path, monkeypatch)
+    reads = mpfu.sharedReads(paths)
+    first = reads.join()
+    first.shared.start()
+    second = reads.join()
+    assert second.shared is not first.shared
+    assert reads.join().shared is second.shared
+    first.leave()
+
+
+def test_leaving_members_do_not_hold_the_read_up(tmp_path, monkeypatch):
+    paths = files(tmp_path, monkeypatch)
+    read = mpfu.sharedRead(paths, chunk=1000)
+    stays, leaves = read.join(), read.join()
+    leaves.leave()
+    # A file that is skipped is passed over
+    with stays.open(paths[2][0]) as reader:
+        assert reader.read(100) == b"\x03" * 100
+        assert reader.tell() == 100
+    assert stays.next() is None
+
+
+def test_reads_slice_the_chunks_and_join_across_them(tmp_path, monkeypatch):
+    paths = files(tmp_path, monkeypatch)
+    read = mpfu.sharedRead(paths, chunk=1000)
+    member = read.join()
+    with member.open(paths[0][0]) as reader:
+        first = reader.read(600)
+        assert isinstance(first, memoryview) and bytes(first) == b"\x01" * 600
+        # The rest of the first chunk and the start of the second
+        assert bytes(reader.read(600)) == b"\x01" * 600
+        assert reader.tell() == 1200
+        assert bytes(reader.read()) == b"\x01" * 1800
+        assert not reader.read(10)
+    with member.open(paths[2][0]) as reader:
+        assert bytes(reader.read(5000)) == b"\x03" * 2500
+    member.leave()
+
+
+def test_every_protocol_takes_the_shared_chunks(sshserver, ftproot, smbroot, bucket, tmp_path, monkeypatch):
+    for n, size in enumerate((3 * pow(2, 20) + 7, 1000)):
+        (tmp_path / f"f{n}").write_bytes(os.urandom(size))
+    (ftproot / "shared").mkdir()
+    (smbroot / "shared").mkdir()
+    for prot in ("sftp", "scp"):
+        (tmp_path / prot).mkdir()
+    destinations = [f"ftp:127.0.0.1:/shared/:{sshserver.user}:{sshserver.password}",
+                    f"smb:127.0.0.1:/BENCH/shared/:{sshserver.user}:{sshserver.password}",
+                    f"sftp:127.0.0.1:{tmp_path}/sftp/:{sshserver.user}1:{sshserver.password}",
+                    f"scp:127.0.0.1:{tmp_path}/scp/:{sshserver.user}2:{sshserver.password}",
+                    "s3:bucket"]
+    results = mpfu.uploadFiles(destinations, [str(tmp_path / "f*")],
+                               {'parallel': 5, 'shared-read': True, 'progress': "quiet", 'no-preflight': True})
+    assert [res['ok'] for res in results] == [True] * 5
+    for n in range(2):
+        data = (tmp_path / f"f{n}").read_bytes()
+        for remote in (ftproot / "shared", smbroot / "shared", tmp_path / "sftp", tmp_path / "scp"):
+            assert (remote / f"f{n}").read_bytes() == data
+        assert bucket.get_object(Bucket="bucket", Key=f"f{n}")['Body'].read() == data
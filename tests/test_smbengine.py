@@ -0,0 +1,97 @@
+import os
+
+import pytest
+
+import mpfu
+import mpfubench
+
+pytest.importorskip("smb")
+from smb.SMBConnection import SMBConnection
+
+
+@pytest.fixture
+def smbargs(monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu.args, "smb_connections", 3)
+
+
+def entry(remdir):
+    return mpfu.invEntry("smb", "127.0.0.1", [remdir], mpfubench.user, mpfubench.password, "")
+
+
+def storedBy(monkeypatch):
+    conns = []
+    storeFile = SMBConnection.storeFile
+    monkeypatch.setattr(SMBConnection, "storeFile",
+                        lambda smbc, *args, **kwargs: conns.append(id(smbc)) or storeFile(smbc, *args, **kwargs))
+    return conns
+
+
+def localFiles(tmp_path, count=6):
+    files = []
+    for n in range(count):
+        path = tmp_path / f"f{n}.bin"
+        path.write_bytes(os.urandom(100000 + n))
+        files.append(str(path))
+    return files
+
+
+def layout(root):
+    found = {}
+    for walkroot, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(walkroot, name)
+            found[os.path.relpath(path, root)] = None if os.path.isdir(path) else open(path, 'rb').read()
+    return found
+
+
+def test_files_are_spread_over_the_connection_pool(smbroot, smbargs, tmp_path, monkeypatch):
+    (smbroot / "pool").mkdir()
+    conns = storedBy(monkeypatch)
+    files = localFiles(tmp_path)
+    assert mpfu.smbUpload("smb", "127.0.0.1", mpfubench.user, mpfubench.password, str(tmp_path), "*",
+                          "/BENCH/pool/", files)
+    assert len(conns) == len(files) and len(set(conns)) == 3
+    assert layout(smbroot / "pool") == {os.path.basename(f): open(f, 'rb').read() for f in files}
+
+
+def test_a_short_pool_still_uploads_everything(smbroot, smbargs, tmp_path, monkeypatch):
+    (smbroot / "short").mkdir()
+    connect = SMBConnection.connect
+    opened = []
+
+    def once(smbc, *args, **kwargs):
+        opened.append(smbc)
+        if len(opened) > 1:
+            raise ConnectionRefusedError("too many sessions")
+        return connect(smbc, *args, **kwargs)
+
+    monkeypatch.setattr(SMBConnection, "connect", once)
+    conns = storedBy(monkeypatch)
+    files = localFiles(tmp_path)
+    assert mpfu.smbUpload("smb", "127.0.0.1", mpfubench.user, mpfubench.password, str(tmp_path), "*",
+                          "/BENCH/short/", files)
+    assert len(set(conns)) == 1
+    assert layout(smbroot / "short") == {os.path.basename(f): open(f, 'rb').read() for f in files}
+
+
+def test_directory_upload_creates_each_directory_once(smbroot, smbargs, tmp_path, monkeypatch):
+    src = tmp_path / "tree"
+    (src / "a" / "b").mkdir(parents=True)
+    (src / "a" / "c").mkdir()
+    (src / "empty").mkdir()
+    (src / "top.txt").write_bytes(b"top")
+    (src / "a" / "b" / "deep.bin").write_bytes(os.urandom(300000))
+    (src / "a" / "c" / "side.txt").write_bytes(b"side")
+    created = []
+    createDirectory = SMBConnection.createDirectory
+    monkeypatch.setattr(SMBConnection, "createDirectory",
+                        lambda smbc, share, path, *args, **kwargs:
+                        created.append(path) or createDirectory(smbc, share, path, *args, **kwargs))
+    conns = storedBy(monkeypatch)
+    assert mpfu.smbDirUpload(entry("/BENCH/dirs/"), str(src), "dst")
+    assert len(set(conns)) == 3
+    # Again over the existing tree
+    assert mpfu.smbDirUpload(entry("/BENCH/dirs/"), str(src), "dst")
+    assert len(created) == 2 * len(set(created))
+    assert layout(smbroot / "dirs" / "dst") == layout(tmp_path)
@@ -0,0 +1,68 @@
+import mpfu
+
+
+# Channel whose exit status is ready at once, but whose output only arrives some polls later
+class LateChannel(object):
+    def __init__(self):
+        self.polls = 0
+        self.out = [b"first ", b"last\n"]
+        self.err = [b"warning\n"]
+        self.eof_received = False
+        self.closed = False
+
+    def exec_command(self, command):
+        pass
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_exit_status(self):
+        return 0
+
+    def recv_ready(self):
+        self.polls += 1
+        return self.polls > 3 and bool(self.out)
+
+    def recv(self, size):
+        data = self.out.pop(0)
+        if not self.out and not self.err:
+            self.eof_received = True
+        return data
+
+    def recv_stderr_ready(self):
+        return self.polls > 5 and bool(self.err)
+
+    def recv_stderr(self, size):
+        data = self.err.pop(0)
+        if not self.out:
+            self.eof_received = True
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class LateClient(object):
+    def __init__(self, chan):
+        self.chan = chan
+
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        return self.chan
+
+
+def test_output_after_the_exit_status_is_kept():
+    assert mpfu.sshExec(LateClient(LateChannel()), "true") == (0, "first last\n", "warning\n")
+
+
+def test_parallel_run_reports_output_exit_codes_and_timeouts(sshserver, monkeypatch, capsys):
+    monkeypatch.setattr(mpfu.args, "parallel", 3)
+    monkeypatch.setattr(mpfu.args, "cmd_timeout", 2)
+    hosts = [("127.0.0.1", sshserver.user + str(n), sshserver.password) for n in range(3)]
+    results = mpfu.mpfuSSHParallel(hosts, 'seq 1 20000 | tail -n 1; echo oops >&2; exit 3')
+    assert [(res['rc'], res['stdout'], res['stderr']) for res in results] == [(3, "20000\n", "oops\n")] * 3
+    slow = mpfu.mpfuSSHParallel(hosts[:1], "sleep 10")
+    assert slow[0]['rc'] is None and "timed out" in slow[0]['reason']
+    assert "failed" in capsys.readouterr().out
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+import mpfu
+
+
+def layout(root):
+    found = {}
+    for walkroot, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(walkroot, name)
+            found[os.path.relpath(path, root)] = None if os.path.isdir(path) else open(path, 'rb').read()
+    return found
+
+
+@pytest.mark.parametrize("mode", ["plain", "gz"])
+def test_tar_stream_gives_the_same_layout_as_sftp(sshserver, tmp_path, monkeypatch, mode):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    src = tmp_path / "tree"
+    (src / "a" / "b").mkdir(parents=True)
+    (src / "empty").mkdir()
+    (src / "top.txt").write_bytes(b"top")
+    (src / "a" / "b" / "deep.bin").write_bytes(os.urandom(300000))
+    entry = mpfu.invEntry("sftp", "127.0.0.1", [], sshserver.user, sshserver.password, "")
+    for tar, dst in ((None, tmp_path / "sftp"), (mode, tmp_path / "tar" / "new")):
+        monkeypatch.setattr(mpfu.args, "tar", tar)
+        if not tar:
+            dst.mkdir()
+        assert mpfu.dirUploadEntry(entry, str(src), str(dst) + "/")
+    assert layout(tmp_path / "tar" / "new") == layout(tmp_path / "sftp")
+    assert layout(tmp_path / "sftp")[os.path.join("tree", "a", "b", "deep.bin")] == (src / "a" / "b" / "deep.bin").read_bytes()
+
+
+def test_remote_tar_failure_is_raised(sshserver, tmp_path, monkeypatch):
+    monkeypatch.setattr(mpfu.args, "progress", "quiet")
+    monkeypatch.setattr(mpfu.args, "tar", "plain")
+    (tmp_path / "tree").mkdir()
+    (tmp_path / "tree" / "f").write_bytes(b"f")
+    (tmp_path / "file").write_bytes(b"not a directory")
+    entry = mpfu.invEntry("sftp", "127.0.0.1", [], sshserver.user, sshserver.password, "")
+    with pytest.raises(IOError, match="remote tar exited"):
+        mpfu.dirUploadEntry(entry, str(tmp_path / "tree"), str(tmp_path / "file") + "/")